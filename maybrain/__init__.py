@@ -5,4 +5,6 @@ Initialisation file for Maybrain
 """
 
 from . import brain
+from . import cohort
+from . import metrics
 from . import utils
@@ -5,7 +5,6 @@ Functions for degeneration of a brain object
 """
 import random
 
-import networkx as nx
 import numpy as np
 
 from maybrain import constants as ct
@@ -38,7 +37,8 @@ def random_degenerate(brain, weight_loss=0.1, edges_removed_limit=1,
     The distances option records the edge length of edges lost.
 
     The adjacency matrix can optionally be updated to record lost edges by
-    setting update_adj_mat to be True (the default option).
+    setting update_adj_mat to be True (the default option). The changed edges
+    are written in adjMat in one pass, when it is next read.
 
     """
 
@@ -83,81 +83,91 @@ def random_degenerate(brain, weight_loss=0.1, edges_removed_limit=1,
             node_list = brain.G.nodes()
 
         # generate list of at risk edges
-        brain.risk_edges = [v for v in nx.edges(brain.G, node_list)
-                            if brain.G.edge[v[0]][v[1]][ct.WEIGHT] != 0.]
+        brain.risk_edges = [v for v in brain.G.edges(node_list)
+                            if brain.G[v[0]][v[1]][ct.WEIGHT] != 0.]
     else:
         redefine_edges = False
 
     if spread:
         node_list = []
 
-    # check if there are enough weights left
-    risk_edge_wt_sum = np.sum([brain.G.edge[v[0]][v[1]][ct.WEIGHT]
-                               for v in brain.risk_edges])
-    if limit > risk_edge_wt_sum:
-        print("Not enough weight left to remove")
-        return node_list
-
-    while limit > 0.:
-        if not brain.risk_edges and spatial_search:
-            # find spatially closest nodes if no edges exist
-            # is it necessary to do this for all nodes?? - waste of computing power
-            # choose node first, then calculated spatially nearest of a single node
-            new_node = brain.find_spatially_nearest(node_list)
-            if new_node:
-                print("Found spatially nearest node")
-                node_list.append(new_node)
-                brain.risk_edges = nx.edges(brain.G, node_list)
+    # the weights lost are only written in adjMat when it is next read
+    defer_adj_mat_sync = brain.defer_adj_mat_sync
+    brain.defer_adj_mat_sync = True
+    changed_edges = []
+    try:
+        # check if there are enough weights left
+        risk_edge_wt_sum = np.sum([brain.G[v[0]][v[1]][ct.WEIGHT]
+                                   for v in brain.risk_edges])
+        if limit > risk_edge_wt_sum:
+            print("Not enough weight left to remove")
+            return node_list
+
+        while limit > 0.:
+            if not brain.risk_edges and spatial_search:
+                # find spatially closest nodes if no edges exist
+                # is it necessary to do this for all nodes?? - waste of computing power
+                # choose node first, then calculated spatially nearest of a single node
+                new_node = brain.find_spatially_nearest(node_list)
+                if new_node:
+                    print("Found spatially nearest node")
+                    node_list.append(new_node)
+                    brain.risk_edges = list(brain.G.edges(node_list))
+                else:
+                    print("No further edges to degenerate")
+                    break
+            # choose at risk edge to degenerate from
+            dying_edge = random.choice(brain.risk_edges)
+            changed_edges.append(dying_edge)
+
+            # remove specified weight from edge
+            wei = brain.G[dying_edge[0]][dying_edge[1]][ct.WEIGHT]
+
+            if np.absolute(wei) < weight_loss:
+                loss = np.absolute(wei)
+                brain.G.remove_edge(dying_edge[0], dying_edge[1])
+                brain.risk_edges.remove(dying_edge)
+                if not weight_loss_limit:
+                    limit -= 1
+
+            elif wei > 0:
+                loss = weight_loss
+                brain.G[dying_edge[0]][dying_edge[1]][ct.WEIGHT] -= weight_loss
+
             else:
-                print("No further edges to degenerate")
-                break
-        # choose at risk edge to degenerate from
-        dying_edge = random.choice(brain.risk_edges)
-
-        # remove specified weight from edge
-        wei = brain.G[dying_edge[0]][dying_edge[1]][ct.WEIGHT]
-
-        if np.absolute(wei) < weight_loss:
-            loss = np.absolute(wei)
-            brain.G.remove_edge(dying_edge[0], dying_edge[1])
-            brain.risk_edges.remove(dying_edge)
-            if not weight_loss_limit:
-                limit -= 1
-
-        elif wei > 0:
-            loss = weight_loss
-            brain.G[dying_edge[0]][dying_edge[1]][ct.WEIGHT] -= weight_loss
-
-        else:
-            loss = weight_loss
-            brain.G[dying_edge[0]][dying_edge[1]][ct.WEIGHT] += weight_loss
-
-        # record the edge length of edges lost
-        if distances:
-            brain.dying_edges[dying_edge] = brain.G[dying_edge[0]][dying_edge[1]]
-            brain.dying_edges[dying_edge][ct.DISTANCE] = \
-                np.linalg.norm(np.array((brain.G.node[dying_edge[0]][ct.XYZ]))
-                               - np.array((brain.G.node[dying_edge[1]][ct.XYZ])))
-
-        # update the adjacency matrix (essential if robustness is to be calculated)
-        if update_adj_mat:
-            brain.update_adj_mat(dying_edge)
-
-        # add nodes to toxic list if the spread option is selected
-        if spread:
-            for node in dying_edge:
-                if not (node in node_list or not (brain.G.edge[dying_edge[0]][dying_edge[1]] > spread)):
-                    node_list.append(node)
-
-        if weight_loss_limit:
-            limit -= loss
-
-        # redefine at risk edges
-        if redefine_edges or spread:
-            brain.risk_edges = nx.edges(brain.G, node_list)
+                loss = weight_loss
+                brain.G[dying_edge[0]][dying_edge[1]][ct.WEIGHT] += weight_loss
+
+            # record the edge length of edges lost
+            if distances:
+                brain.dying_edges[dying_edge] = dict(brain.G.get_edge_data(dying_edge[0], dying_edge[1], {}))
+                brain.dying_edges[dying_edge][ct.DISTANCE] = \
+                    np.linalg.norm(np.array((brain.G.nodes[dying_edge[0]][ct.XYZ]))
+                                   - np.array((brain.G.nodes[dying_edge[1]][ct.XYZ])))
+
+            # update the adjacency matrix (essential if robustness is to be calculated)
+            if update_adj_mat:
+                brain.update_adj_mat(dying_edge)
+
+            # add nodes to toxic list if the spread option is selected
+            if spread:
+                dying_wei = brain.G.get_edge_data(dying_edge[0], dying_edge[1], {}).get(ct.WEIGHT, 0.)
+                for node in dying_edge:
+                    if not (node in node_list or not (dying_wei > spread)):
+                        node_list.append(node)
+
+            if weight_loss_limit:
+                limit -= loss
+
+            # redefine at risk edges
+            if redefine_edges or spread:
+                brain.risk_edges = list(brain.G.edges(node_list))
+    finally:
+        # the edges of G were changed directly (only removed or made lighter)
+        brain.invalidate_metrics(edges=changed_edges)
+        brain.defer_adj_mat_sync = defer_adj_mat_sync
 
     print("Number of toxic nodes: " + str(len(node_list)))
-
     return node_list
 
 
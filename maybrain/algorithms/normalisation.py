@@ -1,13 +1,24 @@
 """
 Module for normalisation of the graphs representing the brain and respective measures
 """
+import itertools
 import numbers
+import random
 
 from random import shuffle
 import numpy as np
 import networkx as nx
+from scipy import sparse
 
 from maybrain import constants as ct
+from maybrain.utils.brain_utils import graph_to_csr
+
+# Maximum number of elements of the stacks of adjacency matrices given to func() with `stacked`
+_STACK_ELEMENTS = 2 ** 24
+# Rounds of vectorised pairing of the edges of a random graph, and attempts to pair each edge left
+# afterwards by swapping it with an edge already paired
+_PAIRING_ROUNDS = 10
+_SWAP_ATTEMPTS = 100
 
 
 class RandomGenerationError(Exception):
@@ -133,7 +144,7 @@ def generate_rand_from_degree(brain, throw_exception=False, node_attrs=None, edg
 
 
 def normalise_single(brain, func, init_val=None, n_iter=500, ret_normalised=True, exact_random=False,
-                     node_attrs=None, edge_attrs=None, random_location=None, **kwargs):
+                     node_attrs=None, edge_attrs=None, random_location=None, stacked=False, **kwargs):
     """
     See `normalise()` method's documentation for explanation. This method just expects a single
     initial measure (init_val) to be averaged, instead of a dictionary
@@ -145,11 +156,12 @@ def normalise_single(brain, func, init_val=None, n_iter=500, ret_normalised=True
 
     return normalise(brain, func, init_vals=init_val, n_iter=n_iter,
                      ret_normalised=ret_normalised, exact_random=exact_random,
-                     node_attrs=node_attrs, edge_attrs=edge_attrs, random_location=random_location, **kwargs)
+                     node_attrs=node_attrs, edge_attrs=edge_attrs, random_location=random_location,
+                     stacked=stacked, **kwargs)
 
 
 def normalise_node_wise(brain, func, init_vals=None, n_iter=500, ret_normalised=True, exact_random=False,
-                        node_attrs=None, edge_attrs=None, random_location=None, **kwargs):
+                        node_attrs=None, edge_attrs=None, random_location=None, stacked=False, **kwargs):
     """
     See `normalise()` method's documentation for explanation. This method just expects init_vals
     to be a dictionary with the measures, for each node, that will be averaged
@@ -161,11 +173,12 @@ def normalise_node_wise(brain, func, init_vals=None, n_iter=500, ret_normalised=
 
     return normalise(brain, func, init_vals=init_vals, n_iter=n_iter,
                      ret_normalised=ret_normalised, exact_random=exact_random,
-                     node_attrs=node_attrs, edge_attrs=edge_attrs, random_location=random_location, **kwargs)
+                     node_attrs=node_attrs, edge_attrs=edge_attrs, random_location=random_location,
+                     stacked=stacked, **kwargs)
 
 
 def normalise(brain, func, init_vals=None, n_iter=500, ret_normalised=True, exact_random=False,
-              node_attrs=None, edge_attrs=None, random_location=None, **kwargs):
+              node_attrs=None, edge_attrs=None, random_location=None, stacked=False, **kwargs):
     """
     It normalises measures taken from a brain by generating a series of n random graphs and averaging them.
 
@@ -180,7 +193,8 @@ def normalise(brain, func, init_vals=None, n_iter=500, ret_normalised=True, exac
     init_vals: dictionary or number
         the initial measures calculated from brain.G that will be averaged.
         If this is None, this will be equal to func(brain.G, **kwargs)
-        If this is a dictionary, this will be a normalisation node-wise
+        If this is a dictionary (or an array with a value for each node of brain.G), this will be a
+        normalisation node-wise
         Otherwise, it will be treated as a single measure to be averaged
     n_iter: int
         number of iteratios that will be used to generate the random graphs
@@ -205,6 +219,14 @@ def normalise(brain, func, init_vals=None, n_iter=500, ret_normalised=True, exac
         Consider that for each iteration `i = 0...n_iter`, "i" will be added at the end of this path to get
         each random graph. Otherwise, `algorithms.generate_rand_from_degree()` will be used to
         create the random graphs
+    stacked: bool
+        If True, func() is called with arrays with shape (B, N, N) with the weighted adjacency matrices
+        of B random graphs at a time (nodes in the order of brain.G.nodes(), and 0 where there is no
+        edge), in batches of up to 2**24 elements. It must return a value (or an array with a value for
+        each node) for each random graph, like the functions in `maybrain.metrics`, e.g.
+        `metrics.clustering`. Unless `random_location` is used, the random graphs are generated directly
+        as arrays, with the degrees and (shuffled) weights of the brain, so `node_attrs` and `edge_attrs`
+        are not used
     kwargs
         Keyword arguments if you need to pass them to func()
 
@@ -222,8 +244,14 @@ def normalise(brain, func, init_vals=None, n_iter=500, ret_normalised=True, exac
     """
 #    if brain.directed:
 #        raise TypeError("normalise() not available for directed graphs")
+    nodes = list(brain.G.nodes())
     if init_vals is None:
-        init_vals = func(brain.G, **kwargs)
+        if stacked:
+            init_vals = func(brain.to_csr(nodes).toarray()[np.newaxis], **kwargs)[0]
+        else:
+            init_vals = func(brain.G, **kwargs)
+    if isinstance(init_vals, np.ndarray):
+        init_vals = dict(zip(nodes, init_vals.tolist())) if init_vals.ndim else init_vals.item()
     if node_attrs is None:
         node_attrs = []
     if edge_attrs is None:
@@ -244,25 +272,21 @@ def normalise(brain, func, init_vals=None, n_iter=500, ret_normalised=True, exac
     else:
         vals = []
 
-    for i in range(n_iter):
-        if random_location is not None:
-            rand = nx.read_gpickle(random_location + str(i))
-        else:
-            edge_attrs.append(ct.WEIGHT)
-            while True:
-                try:
-                    rand = generate_rand_from_degree(brain, throw_exception=exact_random,
-                                                     node_attrs=node_attrs, edge_attrs=edge_attrs)
-                    break  # if it reaches here, means randomiser didn't throw any exception, so break While
-                except RandomGenerationError:
-                    pass
-
-        # Applying func() to the random graph
-        res = func(rand, **kwargs)
+    if stacked:
+        # Applying func() to batches of random graphs at once
+        stacks = _stacked_matrices(brain, nodes, n_iter, exact_random, random_location)
+        results = itertools.chain.from_iterable(func(stack, **kwargs) for stack in stacks)
+    else:
+        # Applying func() to each random graph
+        rands = _random_graphs(brain, n_iter, exact_random, node_attrs, edge_attrs, random_location)
+        results = (func(rand, **kwargs) for rand in rands)
 
+    for res in results:
         if isinstance(init_vals, dict):
             # convert results to a dictionary if not already so
-            if not isinstance(res, dict):
+            if isinstance(res, np.ndarray):
+                res = dict(zip(nodes, res.tolist()))
+            elif not isinstance(res, dict):
                 res = {v[0]:v[1] for v in res}
             for node in res:
                 nodes_dict[node].append(res[node])
@@ -278,3 +302,133 @@ def normalise(brain, func, init_vals=None, n_iter=500, ret_normalised=True, exac
     if ret_normalised:
         return init_vals / np.mean(vals)
     return vals
+
+
+def _random_graphs(brain, n_iter, exact_random, node_attrs, edge_attrs, random_location):
+    """ Generator of the random graphs used by normalise() """
+    if ct.WEIGHT not in edge_attrs:
+        edge_attrs = edge_attrs + [ct.WEIGHT]
+    for i in range(n_iter):
+        if random_location is not None:
+            yield nx.read_gpickle(random_location + str(i))
+            continue
+
+        while True:
+            try:
+                rand = generate_rand_from_degree(brain, throw_exception=exact_random,
+                                                 node_attrs=node_attrs, edge_attrs=edge_attrs)
+                break  # if it reaches here, means randomiser didn't throw any exception, so break While
+            except RandomGenerationError:
+                pass
+        yield rand
+
+
+def _stacked_matrices(brain, nodes, n_iter, exact_random, random_location):
+    """
+    Generator of arrays with shape (B, N, N) with the weighted adjacency matrices of the `n_iter`
+    random graphs used by normalise() with `stacked`, with up to _STACK_ELEMENTS elements each
+    """
+    if random_location is not None:
+        matrices = (graph_to_csr(graph, nodes).tocoo()
+                    for graph in _random_graphs(brain, n_iter, exact_random, [], [], random_location))
+        matrices = ((coo.row, coo.col, coo.data) for coo in matrices)
+    else:
+        matrices = _random_matrices(brain, nodes, n_iter, exact_random)
+
+    batch = max(1, _STACK_ELEMENTS // max(1, len(nodes)) ** 2)
+    for start in range(0, n_iter, batch):
+        stack = np.zeros((min(batch, n_iter - start), len(nodes), len(nodes)))
+        for matrix, (rows, cols, weights) in zip(stack, itertools.islice(matrices, batch)):
+            matrix[rows, cols] = weights
+            matrix[cols, rows] = weights
+        yield stack
+
+
+def _random_matrices(brain, nodes, n_iter, exact_random):
+    """
+    Generator of the edges (rows, cols, weights) between the positions of `nodes` of `n_iter` random
+    graphs with the same degree sequence as the brain, like generate_rand_from_degree(), but built
+    with arrays instead of networkx graphs.
+
+    The weights of the brain are shuffled among the edges of each random graph keeping the weights
+    around each node similar: each new edge (u, v) gets a score from a random original edge of u and
+    of v, and the original weights are assigned to the new edges in the order of their scores
+    """
+    upper = sparse.triu(brain.to_csr(nodes), format='coo')
+    stubs = np.concatenate((upper.row, upper.col))
+    stub_weights = np.concatenate((upper.data, upper.data))
+    order = np.argsort(stubs, kind='stable')
+    stubs, stub_weights = stubs[order], stub_weights[order]
+    degrees = np.bincount(stubs, minlength=len(nodes))
+    first_stub = np.concatenate(([0], np.cumsum(degrees)[:-1]))
+    weights = np.sort(upper.data)
+
+    for _ in range(n_iter):
+        while True:
+            try:
+                rows, cols = _random_edges(stubs, len(nodes), exact_random)
+                break  # if it reaches here, means randomiser didn't throw any exception, so break While
+            except RandomGenerationError:
+                pass
+
+        # Score of each new edge from random original edges of its nodes
+        scores = sum(stub_weights[first_stub[ends] + np.random.randint(0, degrees[ends])] for ends in (rows, cols))
+        kept = weights if len(rows) == len(weights) else np.sort(np.random.choice(weights, len(rows), replace=False))
+        new_weights = np.empty(len(rows))
+        new_weights[np.lexsort((np.random.rand(len(rows)), scores))] = kept
+        yield rows, cols, new_weights
+
+
+def _random_edges(stubs, n_nodes, exact_random):
+    """
+    Edges (rows, cols) of a random graph without self-loops or parallel edges, where each node has an
+    edge for each time its position is in `stubs`. The stubs are paired at random in a few vectorised
+    rounds, and the ones left are paired by swapping them with edges already paired. Stubs which can't
+    be paired are ignored, unless `exact_random`
+
+    Raises
+    ------
+    RandomGenerationError : Exception
+        If some stubs can't be paired and `exact_random`
+    """
+    keys = np.empty(0, dtype=np.int64)  # each edge (u, v) with u < v as u * n_nodes + v
+    left = np.asarray(stubs, dtype=np.int64)
+    for _ in range(_PAIRING_ROUNDS):
+        if len(left) < 2:
+            break
+        left = np.random.permutation(left)
+        ends1, ends2 = left[0:len(left) - 1:2], left[1::2]
+        pairs = np.minimum(ends1, ends2) * n_nodes + np.maximum(ends1, ends2)
+        valid = np.zeros(len(pairs), dtype=bool)
+        valid[np.unique(pairs, return_index=True)[1]] = True
+        valid &= (ends1 != ends2) & ~np.isin(pairs, keys)
+        keys = np.concatenate((keys, pairs[valid]))
+        left = np.concatenate((ends1[~valid], ends2[~valid], left[2 * len(ends2):]))
+
+    if len(left) >= 2:
+        # Each pair left (u, v) and an edge (x, y) become (u, x) and (v, y)
+        edges = keys.tolist()
+        edge_set = set(edges)
+        for end1, end2 in zip(left[0::2].tolist(), left[1::2].tolist()):
+            for _ in range(_SWAP_ATTEMPTS if edges else 0):
+                pos = random.randrange(len(edges))
+                other1, other2 = divmod(edges[pos], n_nodes)
+                if random.random() < 0.5:
+                    other1, other2 = other2, other1
+                new1 = min(end1, other1) * n_nodes + max(end1, other1)
+                new2 = min(end2, other2) * n_nodes + max(end2, other2)
+                if end1 != other1 and end2 != other2 and new1 != new2 and new1 not in edge_set \
+                        and new2 not in edge_set:
+                    edge_set.remove(edges[pos])
+                    edge_set.update((new1, new2))
+                    edges[pos] = new1
+                    edges.append(new2)
+                    break
+            else:
+                if exact_random:
+                    raise RandomGenerationError(str(end1) + " without pair")
+        keys = np.array(edges, dtype=np.int64)
+    elif len(left) and exact_random:
+        raise RandomGenerationError(str(left[0]) + " without pair")
+
+    return keys // n_nodes, keys % n_nodes
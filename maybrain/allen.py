@@ -113,38 +113,20 @@ class allenBrain:
         # key 1= allen, value= (n=id of closest allen node, d=distance to closest allen node)
         # key 2= mri, value= (n=id of closest other mri node, d=distance to closest mri node)
 
+        cNodes = list(self.c.G.nodes())
+        aNodes = list(self.a.G.nodes())
+        cXYZ = self.c.node_coords(cNodes)
+        aXYZ = self.a.node_coords(aNodes)
+
         nodeDictMRIs = {}
-      
-        for node in self.c.G.nodes():
-            dOther = (None, 999.) # dummy length of 999
-            dOwn = (None, 999.)
-      
-            for n in self.a.G.nodes():
-                d = np.linalg.norm(np.array(self.c.G.node[node]['xyz'] - np.array(self.a.G.node[n]['xyz'])))
-                if d < dOther[1]:
-                    dOther = (n,d)
-          
-            for n in [v for v in self.c.G.nodes() if not v==node]:
-                d = np.linalg.norm(np.array(self.c.G.node[node]['xyz'] - np.array(self.c.G.node[n]['xyz'])))
-                if d < dOwn[1]:
-                    dOwn = (n,d)
+        for node, dOther, dOwn in zip(cNodes, _closest_nodes(cXYZ, aXYZ, aNodes),
+                                      _closest_nodes(cXYZ, cXYZ, cNodes, same=True)):
             nodeDictMRIs[node] = {"allen":dOther, "MRIs":dOwn}
-      
+
         # set up dictionary to link nodes from probe data and graph
         nodeDictAllen = {}
-        for node in self.a.G.nodes():
-            dOther = (None, 999.)
-            dOwn = (None, 999.)
-          
-            for n in self.c.G.nodes():
-                d = np.linalg.norm(np.array(self.a.G.node[node]['xyz'] - np.array(self.c.G.node[n]['xyz'])))
-                if d < dOther[1]:
-                    dOther = (n,d)
-          
-            for n in [v for v in self.a.G.nodes() if not v==node]:
-                d = np.linalg.norm(np.array(self.a.G.node[node]['xyz'] - np.array(self.a.G.node[n]['xyz'])))
-                if d < dOwn[1]:
-                    dOwn = (n,d)
+        for node, dOther, dOwn in zip(aNodes, _closest_nodes(aXYZ, cXYZ, cNodes),
+                                      _closest_nodes(aXYZ, aXYZ, aNodes, same=True)):
             nodeDictAllen[node] = {"allen":dOwn, "MRIs":dOther}
       
         nodePairs = []
@@ -574,38 +556,20 @@ class multiSubj:
         key 1= allen, value= (n=id of closest allen node, d=distance to closest allen node)
         key 2= mri, value= (n=id of closest other mri node, d=distance to closest mri node)
         """
+        cNodes = list(self.c.G.nodes())
+        aNodes = list(self.a.G.nodes())
+        cXYZ = self.c.node_coords(cNodes)
+        aXYZ = self.a.node_coords(aNodes)
+
         nodeDictMRIs = {}
-       
-        for node in self.c.G.nodes():
-            dOther = (None, 999.) # dummy length of 999
-            dOwn = (None, 999.)
-       
-            for n in self.a.G.nodes():
-                d = np.linalg.norm(np.array(self.c.G.node[node]['xyz'] - np.array(self.a.G.node[n]['xyz'])))
-                if d < dOther[1]:
-                    dOther = (n,d)
-           
-            for n in [v for v in self.c.G.nodes() if not v==node]:
-                d = np.linalg.norm(np.array(self.c.G.node[node]['xyz'] - np.array(self.c.G.node[n]['xyz'])))
-                if d < dOwn[1]:
-                    dOwn = (n,d)
+        for node, dOther, dOwn in zip(cNodes, _closest_nodes(cXYZ, aXYZ, aNodes),
+                                      _closest_nodes(cXYZ, cXYZ, cNodes, same=True)):
             nodeDictMRIs[node] = {"allen":dOther, "MRIs":dOwn}
-       
+
         # set up dictionary to link nodes from probe data and graph
         nodeDictAllen = {}
-        for node in self.a.G.nodes():
-            dOther = (None, 999.)
-            dOwn = (None, 999.)
-           
-            for n in self.c.G.nodes():
-                d = np.linalg.norm(np.array(self.a.G.node[node]['xyz'] - np.array(self.c.G.node[n]['xyz'])))
-                if d < dOther[1]:
-                    dOther = (n,d)
-           
-            for n in [v for v in self.a.G.nodes() if not v==node]:
-                d = np.linalg.norm(np.array(self.a.G.node[node]['xyz'] - np.array(self.a.G.node[n]['xyz'])))
-                if d < dOwn[1]:
-                    dOwn = (n,d)
+        for node, dOther, dOwn in zip(aNodes, _closest_nodes(aXYZ, cXYZ, cNodes),
+                                      _closest_nodes(aXYZ, aXYZ, aNodes, same=True)):
             nodeDictAllen[node] = {"allen":dOwn, "MRIs":dOther}
        
         nodePairs = []
@@ -644,14 +608,10 @@ class multiSubj:
             self.a.G.node[n]['pairNodes'] = []
         
         # iterate through imaging nodes to find closes Allen node
-        for node in self.c.G.nodes():
-            dOther = (None, 999.) # dummy length of 999
-       
-            for n in self.a.G.nodes():
-                d = np.linalg.norm(np.array(self.c.G.node[node]['xyz'] - np.array(self.a.G.node[n]['xyz'])))
-                if d < dOther[1]:
-                    dOther = (n,d)
-                    
+        cNodes = list(self.c.G.nodes())
+        aNodes = list(self.a.G.nodes())
+        for node, dOther in zip(cNodes, _closest_nodes(self.c.node_coords(cNodes),
+                                                       self.a.node_coords(aNodes), aNodes)):
             self.a.G.node[dOther[0]]['pairNodes'].append(node)
        
         for node in self.a.G.nodes():
@@ -932,3 +892,23 @@ class multiSubj:
                 mDict["Subject"] = subj
                
                 writer.writerow(mDict)
+
+
+def _closest_nodes(xyz, otherXYZ, otherNodes, same=False):
+    """
+    For each position in xyz, the closest of otherNodes (with positions otherXYZ) as a tuple
+    (node, distance). It is (None, 999.) if no node is closer than the dummy length of 999.
+    If same is True, xyz are the positions of otherNodes and a node is not compared with itself.
+    """
+    dists = np.linalg.norm(xyz[:, np.newaxis, :] - otherXYZ[np.newaxis, :, :], axis=2)
+    if same:
+        np.fill_diagonal(dists, np.inf)
+
+    closest = []
+    for row in dists:
+        i = int(np.argmin(row)) if len(row) else None
+        if i is not None and row[i] < 999.:
+            closest.append((otherNodes[i], row[i]))
+        else:
+            closest.append((None, 999.))
+    return closest
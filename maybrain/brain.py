@@ -2,12 +2,22 @@
 """
 Module which contains the definition of Brain class.
 """
+import collections
+import itertools
+import json
 import random
+import sys
 
 import networkx as nx
 import numpy as np
+from scipy import sparse, stats
+from scipy.sparse import csgraph
 
 from maybrain import constants as ct
+from maybrain.utils import brain_utils, readers
+
+# Maximum number of elements of adjMat read at once when scanning it by blocks of rows
+_BLOCK_ELEMENTS = 2 ** 22
 
 
 class Brain:
@@ -24,7 +34,13 @@ class Brain:
         # is this a directed graph or not?
         self.directed = directed
         # adjacency matrix, containing weighting of edges. Should be square.
-        self.adjMat = None
+        # It can be a scipy.sparse.csr_matrix, in which missing elements are like np.nan
+        self._adj_mat = None
+        # If True, update_adj_mat() and reconstruct_adj_mat() only mark adjMat as outdated, and
+        # it is brought up to date from G in one pass when it is next read
+        self.defer_adj_mat_sync = False
+        self._adj_pending = []  # edges of G whose weight is still to be written in adjMat
+        self._adj_rebuild = False  # whether adjMat is still to be fully reconstructed from G
         # identification of the subject to which this brain object belongs
         self.subject = None
         # information about the scan which generated this brain object
@@ -35,110 +51,370 @@ class Brain:
 
         # background info imported by nibabel
         self.nbbackground = None  # the nibabel object
-        self.background = None  # coordinates of background
+        self.background = None  # coordinates of background (read lazily from nbbackground)
         self.background_header = None  # header of nibabel data
 
         # isosurface information imported by nibabel
         self.nbiso = None  # all the isosurface info, nibabel object
-        self.iso = None  # the isosurface
+        self.iso = None  # the isosurface (read lazily from nbiso)
         self.iso_header = None  # header information
         self.parcel_list = None
 
         self.risk_edges = None
 
-        # For the properties features
-        self.node_properties = []
-        self.edge_properties = []
+        # spatial information, where each row/position corresponds to a node number (as in adjMat)
+        self.coords = None  # array of floats with shape (N, 3)
+        self.anat_labels = None  # array with the anatomical label of each node
+        self._spatial_pending = False  # whether G still needs to receive the spatial information
+
+        # For the properties features: the imported properties (_PropertyColumn) by name
+        self._node_props = {}
+        self._edge_props = {}
+        self._node_props_set = False  # whether the nodes of G surely have all the node properties
         self.update_props_after_threshold = False
 
-        # create a new networkX graph object
+        # create a new networkX graph object, which always holds the nodes (and their attributes)
         if self.directed:
-            self.G = nx.DiGraph()
+            self._G = nx.DiGraph()
         else:
-            self.G = nx.Graph()
+            self._G = nx.Graph()
+        # compact store of the edges (_EdgeArrays), used instead of the edges of _G until G is accessed
+        self._edges = _EdgeArrays.empty()
+
+        # Results of metric(), as (result, size) by (name, parameters, fingerprint of the edges), from
+        # the least to the most recently used
+        self._metric_cache = collections.OrderedDict()
+        self._metric_cache_bytes = 0
+        self.metric_cache_size = 2 ** 28  # maximum memory (in bytes) of the results cached by metric()
+        self._edges_version = 0  # incremented whenever the edges (or their properties) are changed
+        # ((version, number of nodes), fingerprint) of the last fingerprint of the compact store
+        self._fingerprint_memo = (None, None)
+        # Shortest path lengths of path_lengths() (_PathLengths), or None until they are calculated
+        self._path_cache = None
+
+    @property
+    def adjMat(self):
+        """
+        The adjacency matrix of this brain. With `defer_adj_mat_sync`, the changes from G marked
+        by update_adj_mat() and reconstruct_adj_mat() are only written when it is read
+        """
+        if self._adj_pending or self._adj_rebuild:
+            self._sync_adj_mat()
+        return self._adj_mat
+
+    @adjMat.setter
+    def adjMat(self, adj_mat):
+        self.invalidate_metrics()
+        self._adj_pending = []
+        self._adj_rebuild = False
+        self._adj_mat = adj_mat
+
+    @property
+    def G(self):
+        """
+        The networkx graph of this brain.
+
+        Thresholding and the operations on edges' weights (e.g. binarise(), weight_to_distance())
+        keep the edges in compact arrays, which are only added to the graph when it is accessed.
+        From then on the graph is used for the edges, as it can be changed by the caller.
+        Spatial information (constants.XYZ and constants.ANAT_LABEL) is also projected into its
+        nodes from `coords` and `anat_labels` when the graph is accessed after import_spatial_info()
+        """
+        if self._edges is not None:
+            self._materialise_edges()
+        if self._spatial_pending:
+            self._project_spatial_info()
+        self._node_props_set = False  # the nodes might be changed by the caller
+        return self._G
+
+    @G.setter
+    def G(self, graph):
+        self.invalidate_metrics()
+        self._edges = None
+        self._node_props_set = False
+        self._G = graph
+
+    def _materialise_edges(self):
+        """
+        Adds the edges of the compact store to _G, with their properties, and then _G becomes
+        their only storage
+        """
+        attr_columns = self._edge_attr_columns()
+        edges, self._edges = self._edges, None
+        if edges.distances is None and not attr_columns:
+            self._G.add_weighted_edges_from(zip(edges.rows.tolist(), edges.cols.tolist(), edges.weights.tolist()),
+                                            weight=ct.WEIGHT)
+            return
+
+        attrs = [{ct.WEIGHT: w} for w in edges.weights.tolist()]
+        if edges.distances is not None:
+            for edge_attrs, dist in zip(attrs, edges.distances.tolist()):
+                edge_attrs[ct.DISTANCE] = dist
+        for prop_name, (positions, values) in attr_columns.items():
+            for pos, val in zip(positions.tolist(), values.tolist()):
+                attrs[pos][prop_name] = val
+        self._G.add_edges_from(zip(edges.rows.tolist(), edges.cols.tolist(), attrs))
 
-    def import_adj_file(self, fname, delimiter=None, nodes_to_exclude=None, na_vals=None):
+    def _set_edge_arrays(self, rows, cols, weights, distances=None):
+        """
+        It replaces the edges of G with the arrays of their nodes, weights (and distances), which are
+        kept in the compact store until G is accessed
+        """
+        self.invalidate_metrics()
+        self._G.clear_edges()
+        n_nodes = self._G.number_of_nodes()
+        self._G.add_nodes_from(np.unique(np.concatenate((rows, cols))).tolist())
+        if self._G.number_of_nodes() != n_nodes:
+            self._node_props_set = False
+        self._edges = _EdgeArrays(rows, cols, weights, distances)
+
+    def import_adj_file(self, fname, delimiter=None, nodes_to_exclude=None, na_vals=None, cache=False,
+                        mmap_file=None):
         """
         Imports an adjacency matrix from a file.
 
         Parameters
         ----------
         fname: str
-            File name
+            File name. It can be compressed with gzip or bzip2
         delimiter: str
             The delimiter of the values inside the matrix, like ","
         nodes_to_exclude: list of indexes
             Nodes you don't want to load, in an array format (nodes no. starts from zero)
         na_vals: list of str
             How the "Not a Number" values are represented in the file
+        cache: bool
+            If True, the parsed matrix is also saved in a binary sidecar file next to `fname`,
+            so later imports of the same (unchanged) file skip the text parsing.
+            See `utils.read_adj_matrix()`
+        mmap_file: str
+            If defined, adjMat is backed by this .npy file (created/overwritten) as a memory-mapped
+            array, instead of being fully held in memory. The file can be loaded again later with
+            `import_adj_npy()`
         """
-        if nodes_to_exclude is None:
-            nodes_to_exclude = []
-        if na_vals is None:
-            na_vals = ["NA"]
-        lines = []
         try:
-            with open(fname, "r") as file:
-                for line in file:
-                    line = line.strip()
-                    list_tmp = [v if v not in na_vals else np.nan for v in line.split(sep=delimiter)]
-                    lines.append(list(map(float, list_tmp)))
+            adj_mat = readers.read_adj_matrix(fname, delimiter=delimiter, na_vals=na_vals, cache=cache,
+                                              mmap_file=mmap_file)
         except IOError as error:
             error.strerror = 'Problem with opening file "' + fname + '": ' + error.strerror
             raise error
 
+        self.import_adj_array(adj_mat, nodes_to_exclude)
+
+    def import_adj_npy(self, fname, nodes_to_exclude=None, mmap_mode='r+'):
+        """
+        Imports an adjacency matrix from a numpy binary file (.npy), by default memory-mapping it.
+
+        Parameters
+        ----------
+        fname: str
+            File name
+        nodes_to_exclude: list of indexes
+            Nodes you don't want to load, in an array format (nodes no. starts from zero)
+        mmap_mode: {'r+', 'r', 'c', None}
+            How the file is memory-mapped, as in `numpy.load()`. With "r+" the changes in adjMat
+            (e.g. from `nodes_to_exclude` or `reconstruct_adj_mat()`) are written to the file;
+            use "c" to keep them in memory only. If None, the matrix is fully loaded into memory
+        """
+        try:
+            adj_mat = np.load(fname, mmap_mode=mmap_mode)
+        except IOError as error:
+            error.strerror = 'Problem with opening file "' + fname + '": ' + error.strerror
+            raise error
+
+        self.import_adj_array(adj_mat, nodes_to_exclude)
+
+    def import_adj_array(self, adj_mat, nodes_to_exclude=None):
+        """
+        Uses an existing square array as the adjacency matrix, without copying it.
+        Note that excluded nodes are set to np.nan in `adj_mat` itself.
+
+        A scipy.sparse matrix is converted to CSR instead, and the excluded nodes lose their elements.
+
+        Parameters
+        ----------
+        adj_mat: np.array or scipy.sparse matrix
+            The adjacency matrix (it can be a view of a bigger array, or a np.memmap)
+        nodes_to_exclude: list of indexes
+            Nodes you don't want to load, in an array format (nodes no. starts from zero)
+        """
+        if nodes_to_exclude is None:
+            nodes_to_exclude = []
+
+        if sparse.issparse(adj_mat):
+            adj_mat = sparse.coo_matrix(adj_mat)
+            kept = ~(np.isin(adj_mat.row, nodes_to_exclude) | np.isin(adj_mat.col, nodes_to_exclude))
+            adj_mat = sparse.csr_matrix((adj_mat.data[kept], (adj_mat.row[kept], adj_mat.col[kept])),
+                                        shape=adj_mat.shape)
+            adj_mat.sort_indices()
+
         # set adjacency matrix
-        self.adjMat = np.array(lines)
+        self.adjMat = adj_mat
 
         # add nodes
-        self.G.add_nodes_from([v for v in range(len(lines)) if v not in nodes_to_exclude])
+        excluded = set(nodes_to_exclude)
+        self._node_props_set = False
+        self._G.add_nodes_from([v for v in range(self.adjMat.shape[0]) if v not in excluded])
 
         # update adjacency matrix to null values of excluded nodes
-        if nodes_to_exclude:
-            for n_exc in nodes_to_exclude:
-                self.adjMat[:, n_exc] = np.nan
-                self.adjMat[n_exc, :] = np.nan
+        if nodes_to_exclude and not sparse.issparse(self.adjMat):
+            self.adjMat[:, nodes_to_exclude] = np.nan
+            self.adjMat[nodes_to_exclude, :] = np.nan
+
+    def import_edge_list(self, fname, delimiter=None, nodes_to_exclude=None, na_vals=None, n_nodes=None):
+        """
+        Imports the adjacency matrix from a list of edges or a MatrixMarket file (see
+        `utils.read_edge_list()`) into a sparse adjMat (scipy.sparse.csr_matrix), so the dense
+        matrix is never created. Missing elements are treated like np.nan in a dense adjMat.
+
+        In an undirected brain each edge can be given in any direction, and it is set in both.
+        If both directions are given, the value of (i, j) with i < j is used, as apply_threshold()
+        does with a dense adjMat. Repeated elements keep their first value.
+
+        Parameters
+        ----------
+        fname: str
+            File name. It can be compressed with gzip or bzip2
+        delimiter: str
+            The delimiter of the values in each line, like ","
+        nodes_to_exclude: list of indexes
+            Nodes you don't want to load, in an array format (nodes no. starts from zero)
+        na_vals: list of str
+            How the "Not a Number" values are represented in the file
+        n_nodes: int
+            The number of nodes. If None, the biggest node in the file plus one
+
+        Raises
+        ------
+        ValueError: Exception
+            If the file has an invalid structure, or nodes which are not below `n_nodes`
+        """
+        try:
+            rows, cols, weights, size = readers.read_edge_list(fname, delimiter=delimiter, na_vals=na_vals)
+        except IOError as error:
+            error.strerror = 'Problem with opening file "' + fname + '": ' + error.strerror
+            raise error
+
+        if n_nodes is None:
+            n_nodes = size
+        elif size > n_nodes:
+            raise ValueError('"' + fname + '" has nodes which are not below n_nodes')
+
+        if not self.directed:
+            # (i, j) with i <= j come first, so they are kept when both directions are given
+            order = np.argsort(rows > cols, kind='stable')
+            rows, cols, weights = (np.minimum(rows, cols)[order], np.maximum(rows, cols)[order],
+                                   weights[order])
+        _, first = np.unique(rows * n_nodes + cols, return_index=True)
+        rows, cols, weights = rows[first], cols[first], weights[first]
+
+        self.import_adj_array(brain_utils.coo_to_csr(rows, cols, weights, n_nodes, symmetric=not self.directed),
+                              nodes_to_exclude)
 
     def import_spatial_info(self, fname, delimiter=None, convert_mni=False):
         """
         Add 3D coordinate information for each node from a given file. It needs to be called after
         import_adj_file()
 
+        Each line of the file has the anatomical label of a node followed by its 3 coordinates.
+        They are kept in `coords` and `anat_labels`, and projected into the nodes of G
+        (constants.XYZ and constants.ANAT_LABEL properties) when G is next accessed.
+
         Parameters
         ----------
         fname: str
-            File name
+            File name. It can be compressed with gzip or bzip2
         delimiter: str
             The delimiter of the values inside the matrix, like ","
         convert_mni: bool
             Whether you want to convert coordinates from voxel-wise (2 mm) to MNI space
         """
-        # open file
         try:
-            file = open(fname, "r")
+            with readers.open_text(fname) as file:
+                tokens = np.loadtxt(file, dtype=str, delimiter=delimiter, comments=None, ndmin=2)
         except IOError as error:
             error.strerror = 'Problem with opening 3D position file "' \
                              + fname + '": ' + error.strerror
             raise error
 
-        # get data from file
-        lines = file.readlines()
-        node_count = 0
-        for line in lines:
-            line = line.strip().split(sep=delimiter)
+        coords = tokens[:, 1:4].astype(float)
+        if convert_mni:
+            coords[:, 0] = 45 - (coords[:, 0] / 2)
+            coords[:, 1] = 63 + (coords[:, 1] / 2)
+            coords[:, 2] = 36 + (coords[:, 2] / 2)
 
-            if convert_mni:
-                line[1] = 45 - (float(line[1]) / 2)
-                line[2] = 63 + (float(line[2]) / 2)
-                line[3] = 36 + (float(line[3]) / 2)
+        self.coords = coords
+        self.anat_labels = tokens[:, 0]
+        self._spatial_pending = True
 
-            if node_count in self.G.nodes():
-                self.G.nodes[node_count][ct.XYZ] = (float(line[1]), float(line[2]), float(line[3]))
-                self.G.nodes[node_count][ct.ANAT_LABEL] = line[0]
+    def _project_spatial_info(self):
+        """ Puts `coords` and `anat_labels` as properties of the nodes of G which exist in them """
+        self._spatial_pending = False
+        nodes = [n for n in self._G.nodes() if _is_index(n, len(self.coords))]
 
-            node_count += 1
+        nx.set_node_attributes(self._G, dict(zip(nodes, map(tuple, self.coords[nodes].tolist()))), ct.XYZ)
+        nx.set_node_attributes(self._G, dict(zip(nodes, self.anat_labels[nodes].tolist())), ct.ANAT_LABEL)
 
-        file.close()
+    def node_coords(self, nodes=None):
+        """
+        It returns the 3D coordinates of some nodes. They are taken from the constants.XYZ property
+        of the nodes in G, which can be changed after import_spatial_info(), and otherwise from `coords`.
+
+        Parameters
+        ----------
+        nodes: list
+            The nodes to look up. If None, all the nodes of G (in the same order)
+
+        Returns
+        -------
+        positions: np.array
+            Array with shape (len(nodes), 3). Nodes without spatial information have np.nan values
+        """
+        nodes = list(self._G.nodes()) if nodes is None else list(nodes)
+        positions = np.full((len(nodes), 3), np.nan)
+
+        in_coords = np.zeros(len(nodes), dtype=bool)
+        if self.coords is not None:
+            indexes = np.array([n if _is_index(n, len(self.coords)) else -1 for n in nodes], dtype=int)
+            in_coords = indexes >= 0
+            positions[in_coords] = self.coords[indexes[in_coords]]
+
+        # Until G is accessed after import_spatial_info(), its nodes don't have the new coordinates yet
+        for pos in np.flatnonzero(~in_coords) if self._spatial_pending else range(len(nodes)):
+            if nodes[pos] in self._G and ct.XYZ in self._G.nodes[nodes[pos]]:
+                positions[pos] = self._G.nodes[nodes[pos]][ct.XYZ]
+
+        return positions
+
+    @property
+    def node_properties(self):
+        """
+        The imported properties of the nodes, as a tuple of (property_name, node_id, property_value).
+        It is created on each access from the store of properties, in which each property is kept in
+        arrays, so it can't be changed in place: assign a new sequence of them, or use
+        import_node_props_from_dict()
+        """
+        return tuple((prop_name, node, val) for prop_name, column in self._node_props.items()
+                     for node, val in zip(_id_list(column.ids), column.values.tolist()))
+
+    @node_properties.setter
+    def node_properties(self, properties):
+        self._node_props, _ = _property_columns(properties)
+
+    @property
+    def edge_properties(self):
+        """
+        The imported properties of the edges, as a tuple of (property_name, node1, node2, property_value).
+        It is created on each access from the store of properties, in which each property is kept in
+        arrays, so it can't be changed in place: assign a new sequence of them, or use
+        import_edge_props_from_dict()
+        """
+        return tuple((prop_name, edge[0], edge[1], val) for prop_name, column in self._edge_props.items()
+                     for edge, val in zip(_id_list(column.ids), column.values.tolist()))
+
+    @edge_properties.setter
+    def edge_properties(self, properties):
+        _, self._edge_props = _property_columns(properties)
 
     def import_node_props_from_dict(self, prop_name, props):
         """
@@ -159,12 +435,8 @@ class Brain:
         """
         if not isinstance(props, dict):
             raise TypeError("import_node_props_from_dict() expects props to be a dict")
-        nodes_p = []
-        for prop in props.items():
-            nodes_p.append([prop_name, prop[0], prop[1]])
 
-        self._add_properties(nodes_p)
-        self.node_properties.extend(nodes_p)
+        self._import_property(prop_name, _id_array(props.keys()), _value_array(props.values()), edges=False)
 
     def import_edge_props_from_dict(self, prop_name, props):
         """
@@ -185,14 +457,11 @@ class Brain:
         """
         if not isinstance(props, dict):
             raise TypeError("import_edge_props_from_dict() expects props to be a dict")
-        edges_p = []
-        for prop in props.items():
-            edges_p.append([prop_name, prop[0][0], prop[0][1], prop[1]])
 
-        self._add_properties(edges_p)
-        self.edge_properties.extend(edges_p)
+        self._import_property(prop_name, _id_array(props.keys(), edges=True), _value_array(props.values()),
+                              edges=True)
 
-    def import_properties(self, filename):
+    def import_properties(self, filename, dtype=str):
         """
         Add properties from a file. First line should contain the property name and the following
         lines spaced node indices and property value e.g.:
@@ -203,61 +472,317 @@ class Brain:
             2 4 green
 
         Not that if 2 indices are given, the property is applied to edges instead.
-        Properties will be treated as strings.
+        Properties will be treated as strings, unless another `dtype` is given.
         You can mix nodes and edges in the same file.
 
+        The file is parsed in bulk into typed columns, which are kept as arrays and applied to G in
+        batches. Nodes or edges which don't exist in G are reported in a single warning per property.
+
         Parameters
         ----------
         filename: str
-            Filepath to properties
+            Filepath to properties. It can be compressed with gzip or bzip2
+        dtype: type
+            The type to which the values are converted, like `float` for tract lengths
 
         Raises
         ------
         ValueError : Exception
             If the file has some invalid structure
         """
-        edges_p = []
-        nodes_p = []
-        with open(filename, 'r') as file:
-            prop = file.readline().strip()
-            for line in file:
-                info = line.strip().split(' ')
-
-                if len(info) == 2:
-                    nodes_p.append([prop, int(info[0]), info[1]])
-                elif len(info) == 3:
-                    edges_p.append([prop, int(info[0]), int(info[1]), info[2]])
-                else:
-                    raise ValueError(
-                        'Problem in parsing %s, it has an invalid structure at line %d'
-                        % (filename, file.tell()))
-
-        self._add_properties(edges_p)
-        self._add_properties(nodes_p)
-
-        self.node_properties.extend(nodes_p)
-        self.edge_properties.extend(edges_p)
-
-    def _add_properties(self, properties):
-        """
-        It receives a list with properties and add them to either the nodes or edges according to
-        the structure.
-        For nodes properties, the format is:
-            [ [property_name_1, node_id_1, property_value_1],
-              [property_name_2, node_id_2, property_value_2], ...]
-
-        For edges properties, the format is:
-            [ [property_name_1, edge1, edge2, property_value_3],
-              [property_name_2, edge1, edge2, property_value_4], ...]
-        """
-        for prop in properties:
-            try:
-                if len(prop) == 3:  # nodes
-                    self.G.nodes[prop[1]][prop[0]] = prop[2]
-                elif len(prop) == 4:  # edges
-                    self.G.edges[prop[1], prop[2]][prop[0]] = prop[3]
-            except BaseException:
-                print('Warning! Unable to process property %s' % prop)
+        prop, (node_ids, node_vals), (edge_ids, edge_vals) = readers.read_properties(filename, dtype)
+
+        self._import_property(prop, edge_ids, edge_vals, edges=True)
+        self._import_property(prop, node_ids, node_vals, edges=False)
+
+    def _import_property(self, prop_name, ids, values, edges):
+        """
+        It adds the arrays with the ids (nodes, or rows (node1, node2) of edges) and values of a
+        property to the store of properties, and sets them in G
+        """
+        if not len(ids):
+            return
+        columns = self._edge_props if edges else self._node_props
+        columns.setdefault(prop_name, _PropertyColumn(edges)).append(ids, values)
+
+        if edges:
+            self._set_edges_property(prop_name, ids, values)
+        else:
+            self._set_nodes_property(prop_name, ids, values)
+
+    def _replay_properties(self):
+        """
+        If update_props_after_threshold is True, it sets again all the stored properties in G after
+        thresholding. The properties of the nodes are only set if the nodes might have changed since
+        they were last set, and the ones of the edges are looked up when the edges are added to G.
+        Nodes and edges which don't exist in G are ignored.
+        """
+        if not self.update_props_after_threshold:
+            return
+
+        if not self._node_props_set:
+            for prop_name, column in self._node_props.items():
+                self._set_nodes_property(prop_name, column.ids, column.values, warn=False)
+            self._node_props_set = True
+
+        if self._edges is not None:
+            self._edges.replay = True
+        else:
+            for prop_name, column in self._edge_props.items():
+                self._set_edges_property(prop_name, column.ids, column.values, warn=False)
+
+    def _set_nodes_property(self, prop_name, nodes, values, warn=True):
+        """
+        Sets the property `prop_name` of each node in `nodes` (array) to the value in the same
+        position of `values`, in a single batch. Nodes which don't exist in G are ignored and reported
+        together if `warn`.
+        """
+        found = _lookup(nodes, _id_array(self._G.nodes())) >= 0
+        nx.set_node_attributes(self._G, dict(zip(_id_list(nodes[found]), values[found].tolist())), prop_name)
+        if warn and not found.all():
+            _warn_unmatched(prop_name, 'nodes', _id_list(nodes[~found]))
+
+    def _set_edges_property(self, prop_name, edges, values, warn=True):
+        """
+        Sets the property `prop_name` of each edge in `edges` (array with rows (node1, node2)) to the
+        value in the same position of `values`, in a single batch. Edges which don't exist in G are
+        ignored and reported together if `warn`.
+        While the edges are in the compact store, the values are kept for when they are added to G.
+        """
+        self.invalidate_metrics()
+        if self._edges is None:
+            found = _lookup(edges, _id_array(self._G.edges(), edges=True), not self.directed) >= 0
+            nx.set_edge_attributes(self._G, dict(zip(_id_list(edges[found]), values[found].tolist())), prop_name)
+        else:
+            stored = np.column_stack((self._edges.rows, self._edges.cols))
+            found = _lookup(edges, stored, not self.directed) >= 0
+            positions = _lookup(stored, edges, not self.directed)
+            self._edges.attrs.setdefault(prop_name, []).append((np.flatnonzero(positions >= 0),
+                                                                values[positions[positions >= 0]]))
+        if warn and not found.all():
+            _warn_unmatched(prop_name, 'edges', _id_list(edges[~found]))
+
+    def _edge_attr_columns(self):
+        """
+        It returns the attributes of the edges in the compact store, other than their weight and
+        distance, as {attribute: (positions, values)}, where positions are indexes of the edges
+        """
+        edges = self._edges
+        parts = {}
+        if edges.replay:
+            stored = np.column_stack((edges.rows, edges.cols))
+            for prop_name, column in self._edge_props.items():
+                positions = _lookup(stored, column.ids, not self.directed)
+                parts.setdefault(prop_name, []).append((np.flatnonzero(positions >= 0),
+                                                        column.values[positions[positions >= 0]]))
+        for prop_name, attr_parts in edges.attrs.items():
+            parts.setdefault(prop_name, []).extend(attr_parts)
+
+        columns = {}
+        for prop_name, attr_parts in parts.items():
+            positions = np.concatenate([pos for pos, _ in attr_parts])
+            values = _concat_values([vals for _, vals in attr_parts])
+            # The last value set for each edge
+            _, last = np.unique(positions[::-1], return_index=True)
+            last = len(positions) - 1 - last
+            columns[prop_name] = (positions[last], values[last])
+        return columns
+
+    def save(self, fname, compressed=False):
+        """
+        Saves this brain (adjMat, G and its attributes) in a .npz bundle, to be restored with `Brain.load()`.
+        Other attributes of the nodes/edges can be numbers, strings, booleans, None, or lists/dicts of them
+        (tuples are restored as lists).
+
+        Parameters
+        ----------
+        fname: str
+            File name. If it does not end with ".npz", numpy adds that extension
+        compressed: bool
+            Whether the arrays are compressed. It saves disk space, but loading is slower
+
+        Raises
+        ------
+        TypeError: Exception
+            If an attribute of the nodes/edges has a value of another type
+        """
+        if self._spatial_pending:
+            self._project_spatial_info()
+        nodes = list(self._G.nodes())
+        int_nodes = all(isinstance(n, (int, np.integer)) for n in nodes)
+        if self._edges is not None:
+            edge_ids = np.column_stack((self._edges.rows, self._edges.cols))
+            edge_weights = self._edges.weights
+            edge_distances = self._edges.distances
+            edge_attrs = {attr: [positions, values] for attr, (positions, values) in self._edge_attr_columns().items()}
+        else:
+            edges = list(self._G.edges(data=True))
+            edge_ids = [(e[0], e[1]) for e in edges]
+            edge_weights = np.array([e[2].get(ct.WEIGHT, np.nan) for e in edges], dtype=float)
+            edge_distances = None
+            if edges and all(ct.DISTANCE in e[2] for e in edges):
+                edge_distances = np.array([e[2][ct.DISTANCE] for e in edges], dtype=float)
+            edge_attrs = _attr_columns((e[2] for e in edges), [ct.WEIGHT, ct.DISTANCE])
+
+        meta = {'directed': self.directed,
+                'subject': self.subject,
+                'scan': self.scan,
+                'update_props_after_threshold': self.update_props_after_threshold,
+                'node_properties': self.node_properties,
+                'edge_properties': self.edge_properties}
+        arrays = {}
+
+        if sparse.issparse(self.adjMat):
+            arrays['adj_data'] = self.adjMat.data
+            arrays['adj_indices'] = self.adjMat.indices
+            arrays['adj_indptr'] = self.adjMat.indptr
+            arrays['adj_shape'] = np.array(self.adjMat.shape)
+        elif self.adjMat is not None:
+            arrays['adj_mat'] = self.adjMat
+
+        # Nodes and edges are kept in arrays, unless there are nodes which are not integers
+        # (e.g. after copy_hemisphere())
+        if int_nodes:
+            arrays['nodes'] = np.array(nodes, dtype=int)
+            arrays['edges'] = np.array(edge_ids, dtype=int).reshape(-1, 2)
+        else:
+            meta['nodes'] = nodes
+            meta['edges'] = [tuple(e) for e in edge_ids]
+        arrays['edge_weights'] = edge_weights
+        if edge_distances is not None:
+            arrays['edge_distances'] = edge_distances
+
+        # Spatial information
+        if self.coords is not None:
+            arrays['coords'] = self.coords
+            arrays['anat_labels'] = self.anat_labels
+        spatial_index = [i for i, n in enumerate(nodes) if ct.XYZ in self._G.nodes[n]]
+        if spatial_index:
+            arrays['xyz_index'] = np.array(spatial_index, dtype=int)
+            arrays['xyz'] = np.array([self._G.nodes[nodes[i]][ct.XYZ] for i in spatial_index], dtype=float)
+
+        # Any other attribute (e.g. properties) is kept in columns of (positions, values)
+        meta['node_attrs'] = _attr_columns((n[1] for n in self._G.nodes(data=True)), [ct.XYZ])
+        meta['edge_attrs'] = edge_attrs
+
+        try:
+            arrays['meta'] = np.array(json.dumps(meta, default=_to_builtin))
+        except TypeError:
+            for kind in ('node', 'edge'):
+                for attr, (_, values) in meta[kind + '_attrs'].items():
+                    try:
+                        json.dumps(values, default=_to_builtin)
+                    except TypeError as error:
+                        raise TypeError("The %s attribute '%s' can't be saved: %s" % (kind, attr, error))
+            raise
+
+        if compressed:
+            np.savez_compressed(fname, **arrays)
+        else:
+            np.savez(fname, **arrays)
+
+    @classmethod
+    def load(cls, fname):
+        """
+        Creates a brain from a bundle previously saved with `save()`.
+
+        Parameters
+        ----------
+        fname: str
+            File name of the .npz bundle
+
+        Returns
+        -------
+        brain: Brain
+            The restored brain
+        """
+        try:
+            bundle = np.load(fname, allow_pickle=False)
+        except IOError as error:
+            error.strerror = 'Problem with opening file "' + fname + '": ' + error.strerror
+            raise error
+
+        with bundle:
+            meta = json.loads(str(bundle['meta']))
+            brain = cls(directed=meta['directed'])
+            brain.subject = meta['subject']
+            brain.scan = meta['scan']
+            brain.update_props_after_threshold = meta['update_props_after_threshold']
+
+            if 'adj_mat' in bundle:
+                brain.adjMat = bundle['adj_mat']
+            elif 'adj_data' in bundle:
+                brain.adjMat = sparse.csr_matrix((bundle['adj_data'], bundle['adj_indices'], bundle['adj_indptr']),
+                                                 shape=tuple(bundle['adj_shape']))
+
+            if 'nodes' in meta:
+                nodes = meta['nodes']
+                edges = list(map(tuple, meta['edges']))
+            else:
+                nodes = bundle['nodes'].tolist()
+                edges = list(map(tuple, bundle['edges'].tolist()))
+
+            brain._G.add_nodes_from(nodes)
+            weights = bundle['edge_weights']
+            distances = bundle['edge_distances'] if 'edge_distances' in bundle else None
+            if 'nodes' not in meta and not np.isnan(weights).any():
+                # The edges go back to the compact store
+                brain._edges = _EdgeArrays(bundle['edges'][:, 0], bundle['edges'][:, 1], weights, distances)
+                brain._edges.attrs = {attr: [(np.array(positions, dtype=int), _value_array(values))]
+                                      for attr, (positions, values) in meta.pop('edge_attrs').items()}
+            else:
+                # NaN is stored for edges without weight
+                edge_attrs = [{ct.WEIGHT: w} if w == w else {} for w in weights.tolist()]
+                if distances is not None:
+                    for attrs, dist in zip(edge_attrs, distances.tolist()):
+                        attrs[ct.DISTANCE] = dist
+                brain.G.add_edges_from((e[0], e[1], attrs) for e, attrs in zip(edges, edge_attrs))
+
+            if 'coords' in bundle:
+                brain.coords = bundle['coords']
+                brain.anat_labels = bundle['anat_labels']
+            if 'xyz' in bundle:
+                spatial_nodes = [nodes[i] for i in bundle['xyz_index'].tolist()]
+                nx.set_node_attributes(brain._G, dict(zip(spatial_nodes, map(tuple, bundle['xyz'].tolist()))),
+                                       ct.XYZ)
+
+        for attr, (positions, values) in meta['node_attrs'].items():
+            nx.set_node_attributes(brain._G, {nodes[i]: val for i, val in zip(positions, values)}, attr)
+        for attr, (positions, values) in meta.get('edge_attrs', {}).items():
+            nx.set_edge_attributes(brain.G, {edges[i]: val for i, val in zip(positions, values)}, attr)
+
+        brain.node_properties = meta['node_properties']
+        brain.edge_properties = meta['edge_properties']
+
+        return brain
+
+    @property
+    def background(self):
+        """
+        The data of the background image (float32), read when first needed and then kept.
+        It is memory-mapped when the file allows it
+        """
+        if self._background is None and self.nbbackground is not None:
+            self._background = _image_data(self.nbbackground)
+        return self._background
+
+    @background.setter
+    def background(self, data):
+        self._background = data
+
+    @property
+    def iso(self):
+        """
+        The labels of the isosurface image (integers), read when first needed and then kept.
+        It is memory-mapped when the file allows it
+        """
+        if self._iso is None and self.nbiso is not None:
+            self._iso = _image_data(self.nbiso, labels=True)
+        return self._iso
+
+    @iso.setter
+    def iso(self, data):
+        self._iso = data
 
     def import_background(self, fname):
         """
@@ -265,12 +790,14 @@ class Brain:
         gives a 3D array with data range 0 to 255 for test data
         could be 4d??
         defines an nibabel object, plus ndarrays with data and header info in
+
+        Only the header is read here, as the data is read when `background` is first used
         """
         import nibabel as nb
 
         self.nbbackground = nb.load(fname)
-        self.background = self.nbbackground.get_data()
-        self.background_header = self.nbbackground.get_header()
+        self.background = None
+        self.background_header = self.nbbackground.header
 
     def import_iso(self, fname):
         """
@@ -278,12 +805,14 @@ class Brain:
         gives a 3D array with data range 0 to 255 for test data
         defines an nibabel object, plus ndarrays with data and header info in
 
+        Only the header is read here, as the data is read when `iso` is first used
+
         fname: File Name with the isosurface
         """
         import nibabel as nb
         self.nbiso = nb.load(fname)
-        self.iso = self.nbiso.get_data()
-        self.iso_header = self.nbiso.get_header()
+        self.iso = None
+        self.iso_header = self.nbiso.header
 
     def parcels(self, node_list):
         """
@@ -292,16 +821,9 @@ class Brain:
         Note, values passed to this function should correspond with those in the
         iso image, not necessarily the node values.
         """
-
-        zero_arr = np.zeros(self.iso.shape)
-
-        for n in node_list:
-            n = float(n)
-            # parcel files start from 1, zero is for background
-            n_arr = np.ma.masked_where(self.iso != (n + 1), self.iso)
-            n_arr.fill_value = 0.0
-            zero_arr = zero_arr + n_arr
-            zero_arr.mask = None
+        # parcel files start from 1, zero is for background
+        labels, counts = np.unique(np.asarray(list(node_list), dtype=float) + 1, return_counts=True)
+        zero_arr = _map_labels(self.iso, labels, labels * counts)
 
         self.parcel_list = np.ma.masked_values(zero_arr, 0.0)
 
@@ -312,13 +834,12 @@ class Brain:
         """
         import nibabel as nb
         if value_dict:  # creates a numpy array based on the dictionary provided
-            out_mat = np.zeros(self.nbiso.get_data().shape, dtype="float64")
-            for n in list(value_dict.keys()):
-                out_mat[np.where(self.nbiso.get_data() == n + 1)] = value_dict[n]
+            labels = np.array(list(value_dict.keys()), dtype=float) + 1
+            out_mat = _map_labels(self.iso, labels, np.array(list(value_dict.values()), dtype="float64"))
         else:
             out_mat = self.parcel_list
 
-        n = nb.Nifti1Image(out_mat, self.nbiso.get_affine(), header=self.iso_header)
+        n = nb.Nifti1Image(out_mat, self.nbiso.affine, header=self.iso_header)
 
         nb.save(n, outname + '.nii')
 
@@ -356,81 +877,553 @@ class Brain:
         if threshold_type == "edgePC" and (value < 0 or value > 100):
             raise TypeError("Invalid value for edgePC in apply_threshold()")
 
-        # Creating the array with weights and edges
-        upper_values = np.triu_indices(np.shape(self.adjMat)[0], k=1)
-        weights = []
+        # The new edges replace the previous ones, in the compact store until G is accessed
+        self._set_edge_arrays(*self._threshold_edges(threshold_type, value, use_absolute))
 
-        # Creating weights in which each element is (node1, node2, weight)
-        for x in np.nditer(upper_values):
-            if not np.isnan(self.adjMat[x[0]][x[1]]):
-                weights.append((int(x[0]),
-                                int(x[1]),
-                                self.adjMat[x[0]][x[1]]))
+        # Apply existing properties
+        self._replay_properties()
 
-        # If directed, also add the lower down part of the adjacency matrix
-        if self.directed:
-            below_values = np.tril_indices(np.shape(self.adjMat)[0], k=-1)
-            for x in np.nditer(below_values):
-                if not np.isnan(self.adjMat[x[0]][x[1]]):
-                    weights.append((int(x[0]),
-                                    int(x[1]),
-                                    self.adjMat[x[0]][x[1]]))
-
-        # Filtering weights when with threshold_type of "edgePC" or "totalEdges"
-        if threshold_type in ["edgePC", "totalEdges"]:
-            # Sorting ascending
-            if use_absolute:
-                weights.sort(key=lambda x: abs(x[2]))
+    def threshold_sweep(self, values, threshold_type='edgePC', use_absolute=False, metric=None):
+        """
+        Generator which thresholds the adjacency matrix for several values, like calling
+        apply_threshold() for each of them. The edges are sorted only once, and from one value to
+        the next only the edges entering (or leaving) the graph are changed in G.
+
+        For each value, G has the same edges (and weights) that apply_threshold() would create,
+        though not necessarily in the same order. While G is not accessed (e.g. by `metric`), each
+        step just takes a slice of the sorted edges. G is the same object during the sweep, so the
+        caller must not change its edges; use G.copy() to keep a graph. In the end, G is
+        thresholded with the last value.
+
+        Parameters
+        ----------
+        values: list
+            The values used to threshold, in the order they are yielded
+        threshold_type: {'edgePC', 'totalEdges', 'tVal'}
+            The type of threshold applied, as in apply_threshold()
+        use_absolute: bool
+            Thresholding by absolute value, as in apply_threshold()
+        metric: function
+            If defined, it is called with this brain for each value, and its result is yielded
+
+        Yields
+        ------
+        value, result: tuple
+            Each value of `values`, and `metric(self)` if `metric` is defined, or G otherwise
+
+        Raises
+        ------
+        TypeError: Exception
+            If a not valid threshold type or value is passed
+        """
+        values = list(values)
+        if threshold_type not in ["edgePC", "totalEdges", "tVal"]:
+            raise TypeError("Not a valid threshold_type for threshold_sweep()")
+        if threshold_type == "edgePC" and any(v < 0 or v > 100 for v in values):
+            raise TypeError("Invalid value for edgePC in threshold_sweep()")
+        if not values:
+            return
+
+        # The edges of the loosest threshold, from the weakest to the strongest. The graph for each
+        # value has the strongest `count` of them, as apply_threshold() keeps ties in the same way
+        if threshold_type == 'tVal':
+            rows, cols, weights = self._threshold_edges('tVal', min(abs(v) for v in values) if use_absolute
+                                                        else min(values), use_absolute)
+            keys = np.absolute(weights) if use_absolute else weights
+            order = np.argsort(keys, kind='stable')
+            rows, cols, weights, keys = rows[order], cols[order], weights[order], keys[order]
+            counts = [len(keys) - np.searchsorted(keys, abs(v) if use_absolute else v, side='left')
+                      for v in values]
+        else:
+            if threshold_type == 'edgePC':
+                total = self._count_candidates()
+                counts = [int((v / 100.) * total) for v in values]
             else:
-                weights.sort(key=lambda x: x[2])
+                counts = [max(0, int(v)) for v in values]
+            rows, cols, weights = self._threshold_edges('totalEdges', max(counts), use_absolute)
+            counts = [min(c, len(weights)) for c in counts]
+
+        self._set_edge_arrays(rows, cols, weights)
+        current = 0
+        for value, count in zip(values, counts):
+            start, end = len(weights) - max(count, current), len(weights) - min(count, current)
+            if self._edges is not None:
+                # While G is not accessed, the edges are just views of the sorted arrays
+                self._edges = _EdgeArrays(rows[len(weights) - count:], cols[len(weights) - count:],
+                                          weights[len(weights) - count:])
+            elif count > current:
+                self._G.add_weighted_edges_from(zip(rows[start:end].tolist(), cols[start:end].tolist(),
+                                                    weights[start:end].tolist()), weight=ct.WEIGHT)
+            elif count < current:
+                self._G.remove_edges_from(zip(rows[start:end].tolist(), cols[start:end].tolist()))
+            current = count
+            self.invalidate_metrics()
+
+            # Apply existing properties
+            self._replay_properties()
+
+            yield value, (self.G if metric is None else metric(self))
+
+    def to_csr(self, nodelist=None, weight=ct.WEIGHT):
+        """
+        It returns the adjacency matrix of G as a sparse (CSR) matrix, using memory proportional
+        to the number of edges. Rows and columns follow the order of G.nodes() (or `nodelist`).
+        While the edges are in the compact store (e.g. right after apply_threshold()), the matrix
+        is created directly from its arrays, without going through G.
+
+        Parameters
+        ----------
+        nodelist: list
+            The nodes (and their order) in the matrix. If None, all the nodes of G
+        weight: str
+            The attribute of the edges with the values of the matrix. If None, or if an edge doesn't
+            have it, the value 1 is used
+
+        Returns
+        -------
+        matrix: scipy.sparse.csr_matrix
+            The adjacency matrix. Non-existing edges are missing elements
+        """
+        if self._edges is None:
+            return brain_utils.graph_to_csr(self.G, nodelist, weight)
+
+        nodes = list(self._G.nodes()) if nodelist is None else list(nodelist)
+        edges = self._edges
+        values = edges.values(weight)
+        rows, cols = _positions(edges.rows, nodes), _positions(edges.cols, nodes)
+        kept = (rows >= 0) & (cols >= 0)
+        return brain_utils.coo_to_csr(rows[kept], cols[kept], values[kept], len(nodes),
+                                      symmetric=not self.directed)
+
+    def _threshold_edges(self, threshold_type, value, use_absolute):
+        """
+        Scans adjMat by blocks of rows and returns the arrays (rows, columns, weights) with the
+        edges retained by apply_threshold(), in the order they are added to G.
+        Only the selected edges are kept in memory, so adjMat can be memory-mapped.
+        """
+        rows, cols, weights = np.empty(0, dtype=int), np.empty(0, dtype=int), np.empty(0)
 
+        if threshold_type in ["edgePC", "totalEdges"]:
             # Getting the number of edges to include
             if threshold_type == 'edgePC':
-                edgenum = int((value / 100.) * len(weights))
+                edgenum = int((value / 100.) * self._count_candidates())
             else:  # totalEdges
                 edgenum = int(value)
 
-            # Removing weak edges
             if edgenum <= 0:
-                weights = []
-            elif edgenum > len(weights):
-                pass  # include all weights
+                return rows, cols, weights
+
+            # Keeping the strongest edges seen so far, in the order they appear in adjMat. Blocks are
+            # accumulated until they reach 2*edgenum, so each selection is amortised, and once
+            # edgenum edges are kept, the weaker elements of the next blocks are not even extracted.
+            # In a directed brain, ties are broken as if the lower triangle came after the upper one
+            triangle = 0 if self.directed else 1
+            blocks = [(rows, cols, weights)]
+            pending = 0
+            weakest = None
+            for rows_slice in itertools.chain(self._row_slices(min(_BLOCK_ELEMENTS, max(4 * edgenum, 2 ** 16))),
+                                              [None]):
+                if rows_slice is not None:
+                    kept = None if weakest is None else _tval_filter(weakest, use_absolute)
+                    blocks.append(self._defined_elements(rows_slice, triangle, kept))
+                    pending += len(blocks[-1][2])
+                    if pending < 2 * edgenum:
+                        continue
+
+                rows, cols, weights = (np.concatenate(arrs) for arrs in zip(*blocks))
+                keys = np.absolute(weights) if use_absolute else weights
+                selected = _top_k(keys, edgenum, later=cols < rows if self.directed else None)
+                rows, cols, weights = rows[selected], cols[selected], weights[selected]
+                if len(selected) == edgenum:
+                    weakest = keys[selected].min()
+                blocks = [(rows, cols, weights)]
+                pending = len(weights)
+
+            # Edges are added from the weakest to the strongest, as a stable sort of all the edges
+            rows, cols, weights = self._upper_first(rows, cols, weights)
+            order = np.argsort(np.absolute(weights) if use_absolute else weights, kind='stable')
+            return rows[order], cols[order], weights[order]
+
+        blocks = list(self._candidate_edges(threshold_type, value, use_absolute))
+        if blocks:
+            rows, cols, weights = self._upper_first(*(np.concatenate(arrs) for arrs in zip(*blocks)))
+        return rows, cols, weights
+
+    def _upper_first(self, rows, cols, weights):
+        """
+        In a directed brain, it reorders the edges from _candidate_edges() (in row-major order) so
+        the upper triangle of adjMat comes before the lower triangle, keeping the order in each of them
+        """
+        if not self.directed:
+            return rows, cols, weights
+        lower = cols < rows
+        order = np.concatenate((np.flatnonzero(~lower), np.flatnonzero(lower)))
+        return rows[order], cols[order], weights[order]
+
+    def _candidate_edges(self, threshold_type=None, value=0., use_absolute=False):
+        """
+        Generator over blocks of rows of adjMat, yielding arrays (rows, columns, weights) of the
+        non-NaN values of the upper triangle of the matrix, or of all the values outside the diagonal
+        if the brain is directed (each block is scanned once, in row-major order). When
+        `threshold_type` is "tVal", only the values passing that threshold are yielded.
+        """
+        triangle = 0 if self.directed else 1
+        kept = _tval_filter(value, use_absolute) if threshold_type == 'tVal' else None
+        for rows_slice in self._row_slices():
+            yield self._defined_elements(rows_slice, triangle, kept)
+
+    def _count_candidates(self, threshold=None):
+        """
+        Number of values yielded by _candidate_edges(), or of those values above `threshold` if it
+        is defined. They are counted by blocks of rows, without extracting them.
+        """
+        triangle = 0 if self.directed else 1
+        kept = None if threshold is None else (lambda weights: weights > threshold)
+        return sum(self._defined_elements(rows_slice, triangle, kept, count=True)
+                   for rows_slice in self._row_slices())
+
+    def _defined_elements(self, rows_slice, triangle, kept=None, count=False):
+        """
+        It returns arrays (rows, columns, weights) with the non-NaN elements of adjMat in the rows
+        of `rows_slice`, either above (`triangle` = 1) or below (`triangle` = -1) the diagonal, or
+        outside it (`triangle` = 0), in row-major order.
+        If defined, `kept` is a function which receives an array of values and returns which of them
+        are returned (NaN must be false). If `count`, only the number of elements is returned.
+        """
+        if kept is None:
+            kept = lambda weights: ~np.isnan(weights)
+
+        if sparse.issparse(self.adjMat):
+            block = self.adjMat[rows_slice].tocoo()
+            i, j, weights = block.row + rows_slice.start, block.col, block.data
+            mask = kept(weights)
+            mask &= j > i if triangle == 1 else j < i if triangle == -1 else j != i
+            if count:
+                return np.count_nonzero(mask)
+            return i[mask], j[mask], weights[mask]
+
+        block = np.asarray(self.adjMat[rows_slice])
+        mask = kept(block)
+        if triangle == 0:
+            diagonal = np.arange(rows_slice.start, min(rows_slice.start + len(block), block.shape[1]))
+            mask[diagonal - rows_slice.start, diagonal] = False
+        else:
+            b_rows = np.arange(rows_slice.start, rows_slice.start + len(block))[:, np.newaxis]
+            b_cols = np.arange(block.shape[1])[np.newaxis, :]
+            mask &= b_cols > b_rows if triangle == 1 else b_cols < b_rows
+        if count:
+            return np.count_nonzero(mask)
+        positions = np.flatnonzero(mask)
+        i, j = positions // block.shape[1], positions % block.shape[1]
+        return i + rows_slice.start, j, block.ravel()[positions]
+
+    def _row_slices(self, elements=_BLOCK_ELEMENTS):
+        """ Generator of slices over the rows of adjMat, each one with at most (about) `elements` elements """
+        n_rows, n_cols = np.shape(self.adjMat)
+        step = max(1, elements // max(1, n_cols))
+        for start in range(0, n_rows, step):
+            yield slice(start, min(start + step, n_rows))
+
+    def threshold_to_percentage(self, threshold):
+        """
+        It returns a ratio between the edges on adjMat above a certain threshold value
+        and the total possible edges of adjMat.
+        In an unidrected graph, the total possible edges are the upper right
+        part elements of adjMat different from np.nan. In a directed graph, the total
+        possible edges are all the elements of adjMat except the diagonal and
+        np.nan
+
+        adjMat is scanned by blocks of rows, so it can be memory-mapped.
+
+        Parameters
+        ----------
+        threshold: number
+            The threshold value
+
+        Returns
+        -------
+        ratio: float
+            The final result
+        """
+        return self._count_candidates(threshold) / self._count_candidates()
+
+    def filtration(self, use_absolute=False):
+        """
+        It adds all the possible edges of adjMat one by one, from the strongest to the weakest, and
+        records how the connected components of the graph evolve. After the first k insertions, the
+        graph has the same edges that apply_threshold("totalEdges", k) creates.
+        The edges are sorted once, and the components are tracked with a union-find structure over the
+        edges which join two components (a maximum spanning forest), instead of checking the
+        connectivity of the graph for each threshold. G is not changed.
+        In a directed brain, the components are the weakly connected ones.
+
+        Parameters
+        ----------
+        use_absolute: bool
+            Whether the strength of an edge is the absolute value of its weight, as in apply_threshold()
+
+        Returns
+        -------
+        filtration: dict
+            With the following keys:
+            "edges" -> array with shape (M, 2) with the nodes of each edge, in the order they are added
+            "weights" -> the weight of each edge, i.e., the threshold reached with each insertion
+            "components" -> the number of connected components after each insertion, counting the
+                            nodes of G without edges
+            "largest_component" -> the number of nodes of the largest component after each insertion
+            "percolation_threshold" -> the weight of the edge which connects the whole graph, which is
+                                       the strongest threshold keeping it connected (None if it's never
+                                       connected)
+            "percolation_edges" -> the number of edges at that point (None if it's never connected)
+        """
+        rows, cols, weights = self._threshold_edges(None, 0., False)
+        order = np.argsort(np.absolute(weights) if use_absolute else weights, kind='stable')[::-1]
+        rows, cols, weights = rows[order], cols[order], weights[order]
+
+        # The nodes of G, and the nodes with edges, as indices of adjMat. Other nodes of G are isolated
+        n_adj = self.adjMat.shape[0]
+        nodes = [v for v in self._G.nodes() if _is_index(v, n_adj)]
+        in_graph = np.zeros(n_adj, dtype=bool)
+        in_graph[nodes] = True
+        in_graph[rows] = True
+        in_graph[cols] = True
+        n_nodes = np.count_nonzero(in_graph) + self._G.number_of_nodes() - len(nodes)
+        tree = _spanning_forest(rows, cols, n_adj)
+
+        # Only the edges of the spanning forest join two components
+        joins = np.zeros(len(weights), dtype=int)
+        joins[tree] = 1
+        components = n_nodes - np.cumsum(joins)
+        largest = np.ones(len(weights), dtype=int)
+        parent = list(range(n_adj))
+        size = [1] * n_adj
+
+        def find(node):
+            while parent[node] != node:
+                parent[node] = parent[parent[node]]
+                node = parent[node]
+            return node
+
+        for pos, source, target in zip(tree.tolist(), rows[tree].tolist(), cols[tree].tolist()):
+            source, target = find(source), find(target)
+            if size[source] < size[target]:
+                source, target = target, source
+            parent[target] = source
+            size[source] += size[target]
+            largest[pos] = size[source]
+        largest = np.maximum.accumulate(largest) if len(largest) else largest
+
+        connected = np.flatnonzero(components == 1)
+        return {"edges": np.column_stack((rows, cols)),
+                "weights": weights,
+                "components": components,
+                "largest_component": largest,
+                "percolation_threshold": weights[connected[0]] if connected.size else None,
+                "percolation_edges": int(connected[0]) + 1 if connected.size else None}
+
+    def metric(self, name, **params):
+        """
+        It calculates a measure of this brain, reusing the result from a previous call with the same
+        parameters while the edges haven't changed. The results are cached with a least recently used
+        policy, up to `metric_cache_size` bytes (0 disables the cache).
+
+        The cache is invalidated by the methods which change the edges (e.g. apply_threshold(),
+        local_thresholding(), binarise(), update_adj_mat()) and by the degeneration algorithms. Once
+        G has been accessed, edges and nodes added to (or removed from) it are also noticed, as the
+        results are then kept by a hash of the nodes and of the set of edges, but invalidate_metrics()
+        must be called after changing the properties of the edges of G directly.
+
+        Parameters
+        ----------
+        name: str or function
+            The name of a function of `maybrain.metrics` (e.g. "clustering", "path_length",
+            "betweenness"). It can also be a function, which is called with this brain and `params`
+        params
+            Keyword arguments passed to the function, e.g. weight=constants.DISTANCE. Results with
+            parameters which can't be hashed (e.g. lists) are not cached
+
+        Returns
+        -------
+        result:
+            The result of the function. Its arrays are read-only, as they are shared by the next calls
+
+        Raises
+        ------
+        TypeError: Exception
+            If `name` is not a valid measure
+        """
+        function = _metric_function(name)
+        try:
+            key = (name, tuple(sorted(params.items())), self._edges_fingerprint())
+            hash(key)
+        except TypeError:
+            return function(self, **params)
+
+        if key in self._metric_cache:
+            self._metric_cache.move_to_end(key)
+            return self._metric_cache[key][0]
+
+        result = function(self, **params)
+        size = _result_size(result)
+        # The result is not kept if the function itself changed the edges
+        if size <= self.metric_cache_size and key[2][0] == self._edges_version:
+            _make_read_only(result)
+            self._metric_cache[key] = (result, size)
+            self._metric_cache_bytes += size
+            while self._metric_cache_bytes > self.metric_cache_size:
+                _, (_, old_size) = self._metric_cache.popitem(last=False)
+                self._metric_cache_bytes -= old_size
+        return result
+
+    def path_lengths(self, weight=None, dtype=np.float64, mmap_file=None, n_jobs=None):
+        """
+        It returns the length of the shortest path between each pair of nodes (see
+        `metrics.shortest_paths()`), with the nodes in the order of G.nodes(). The matrix is kept
+        until the edges change, and when only some edges are removed (or made longer), e.g. by
+        update_adj_mat() or algorithms.random_degenerate(), only the rows of the nodes whose shortest
+        paths could go through them are calculated again.
+
+        Parameters
+        ----------
+        weight: str
+            If None, each edge has length 1. Otherwise, the property of the edges with their length
+            (e.g. `ct.DISTANCE`, see `weight_to_distance()`)
+        dtype: np.dtype
+            Type of the matrix. np.float32 halves its memory
+        mmap_file: str
+            If defined, the matrix is kept in this ".npy" file (a np.memmap) instead of in memory, and
+            it can be opened again with `np.load(mmap_file, mmap_mode='r')`
+        n_jobs: int
+            Number of processes among which the nodes are split. If None, the number of CPUs is used
+
+        Returns
+        -------
+        lengths: np.array
+            Read-only matrix (N, N) with the lengths, and np.inf between disconnected nodes
+
+        Raises
+        ------
+        TypeError: Exception
+            If the brain is directed
+        """
+        # Imported here, as metrics imports this module
+        from maybrain import metrics
+
+        settings = (weight, np.dtype(dtype), mmap_file)
+        cache = self._path_cache
+        fingerprint = self._edges_fingerprint()[1:]
+        if cache is None or cache.settings != settings or cache.fingerprint != fingerprint:
+            graph = metrics.edge_lengths(self, weight)
+            if mmap_file is None:
+                lengths = np.empty(graph.shape, dtype=dtype)
             else:
-                weights = weights[-edgenum:]
-
-        # remove previous edges
-        self.G.remove_edges_from(list(self.G.edges()))
-
-        # Adding the edges
-        for e in weights:
-            if threshold_type == 'tVal' and use_absolute:
-                if e[2] >= abs(value) or e[2] <= -abs(value):
-                    self.G.add_edge(e[0], e[1], weight=e[2])
-            elif threshold_type == 'tVal' and not use_absolute:
-                if e[2] >= value:
-                    self.G.add_edge(e[0], e[1], weight=e[2])
-            else:  # None, edgePC, totalEdges
-                self.G.add_edge(e[0], e[1], weight=e[2])
+                lengths = np.lib.format.open_memmap(mmap_file, mode='w+', dtype=dtype, shape=graph.shape)
+            metrics.shortest_paths(graph, weight=True, n_jobs=n_jobs, out=lengths)
+            cache = _PathLengths(settings, list(self._G.nodes()), graph, lengths, fingerprint)
+            self._path_cache = cache
+        elif cache.stale.any():
+            rows = np.flatnonzero(cache.stale)
+            cache.graph = metrics.edge_lengths(self, weight)
+            cache.lengths[rows] = metrics.shortest_paths(cache.graph, weight=True, n_jobs=n_jobs, sources=rows)
+            cache.changed.clear()
+            cache.stale[:] = False
+
+        lengths = cache.lengths.view()
+        lengths.flags.writeable = False
+        return lengths
+
+    def invalidate_metrics(self, edges=None):
+        """
+        It discards the results cached by metric() and path_lengths(). It is called by the methods
+        which change the edges, and it must be called after changing the properties of the edges of
+        G directly
 
-        # Apply existing properties
-        if self.update_props_after_threshold:
-            self._add_properties(self.node_properties)
-            self._add_properties(self.edge_properties)
+        Parameters
+        ----------
+        edges: list
+            If defined, the only edges of G that were changed (or removed). If they were only removed
+            or made longer, just the affected rows of path_lengths() are calculated again
+        """
+        self._edges_version += 1
+        self._metric_cache.clear()
+        self._metric_cache_bytes = 0
+        cache = self._path_cache
+        if cache is not None:
+            edges = None if edges is None else [tuple(edge) for edge in edges]
+            if edges is None or not cache.invalidate(edges, self._edge_lengths(edges, cache.settings[0])):
+                self._path_cache = None
+
+    def _edges_fingerprint(self):
+        """
+        (version, hash of the nodes, hash of the set of edges) of G, which changes whenever its nodes
+        or edges do, even if their number is the same. The edges of the compact store only change
+        with the version, so their hashes are only calculated once for each version
+        """
+        if self._edges is not None:
+            memo_key = (self._edges_version, self._G.number_of_nodes())
+            if self._fingerprint_memo[0] == memo_key:
+                return self._fingerprint_memo[1]
+
+        nodes = list(self._G.nodes())
+        if self._edges is not None:
+            rows, cols = _positions(self._edges.rows, nodes), _positions(self._edges.cols, nodes)
+            kept = (rows >= 0) & (cols >= 0)
+            rows, cols = rows[kept], cols[kept]
+            fingerprint = (self._edges_version, hash(tuple(nodes)),
+                           _edge_set_hash(rows, cols, len(nodes), not self.directed))
+            self._fingerprint_memo = (memo_key, fingerprint)
+            return fingerprint
+
+        index = {node: i for i, node in enumerate(nodes)}
+        rows, cols = (np.fromiter((index[edge[i]] for edge in self._G.edges()), int, self._G.number_of_edges())
+                      for i in (0, 1))
+        return self._edges_version, hash(tuple(nodes)), _edge_set_hash(rows, cols, len(nodes), not self.directed)
 
     def reconstruct_adj_mat(self):
         """
-        It redefines the adjacency matrix from the edges' weights of G
-        It assumes that size of adjMat is maintained
+        It redefines the adjacency matrix from the edges' weights of G, writing all of them at once
+        with fancy indexing. It assumes that size of adjMat is maintained.
+        With `defer_adj_mat_sync`, it is only done when adjMat is next read.
+
+        Raises
+        ------
+        KeyError: Exception
+            If an edge in G doesn't have constants.WEIGHT property
+        IndexError: Exception
+            If an edge does not exist in adjMat
         """
-        self.adjMat[:] = np.nan
+        self._adj_pending = []
+        self._adj_rebuild = self.defer_adj_mat_sync
+        if self._adj_rebuild:
+            return
+
+        if self._edges is not None:
+            rows, cols, weights = self._edges.rows, self._edges.cols, self._edges.weights
+        else:
+            # The view is iterated once (list() would also iterate it to find its length)
+            edges = [edge for edge in self._G.edges(data=ct.WEIGHT)]
+            missing = [edge[:2] for edge in edges if edge[2] is None]
+            if missing:
+                raise KeyError(missing[0], "Edge doesn't have constants.WEIGHT property")
+            rows, cols, weights = (np.fromiter((edge[i] for edge in edges), dtype, len(edges))
+                                   for i, dtype in enumerate([int, int, float]))
+
+        if sparse.issparse(self._adj_mat):
+            _check_bounds(rows, cols, self._adj_mat.shape)
+            self._adj_mat = brain_utils.coo_to_csr(rows, cols, weights, self._adj_mat.shape[0],
+                                                   symmetric=not self.directed)
+            return
 
-        for e in self.G.edges():
-            self.update_adj_mat(e)
+        for rows_slice in self._row_slices():
+            self._adj_mat[rows_slice] = np.nan
+        self._write_adj_mat(rows, cols, weights)
 
     def update_adj_mat(self, edge):
         """
         It updates the adjacency matrix by bringing the weight of an edge in G to
-        the adjacency matrix
+        the adjacency matrix. To update many edges, update_adj_mat_many() is faster.
+        With `defer_adj_mat_sync`, the edge is only written when adjMat is next read, and it is
+        removed from adjMat (np.nan) if it doesn't exist in G by then.
 
         Parameters
         ----------
@@ -444,6 +1437,10 @@ class Brain:
         IndexError: Exception
             If edge does not exist in adjMat
         """
+        self.invalidate_metrics(edges=[tuple(edge)])
+        if self.defer_adj_mat_sync:
+            self._adj_pending.append(tuple(edge))
+            return
 
         try:
             e_wei = self.G.edges[edge[0], edge[1]][ct.WEIGHT]
@@ -452,24 +1449,153 @@ class Brain:
             if not self.directed:
                 self.adjMat[edge[1], edge[0]] = e_wei
         except KeyError as error:
-            import sys
             _, _, tbb = sys.exc_info()
             error_msg = "Edge does not exist in G or doesn't have constants.WEIGHT property"
             raise KeyError(error, error_msg).with_traceback(tbb)
         except IndexError:
-            import sys
             _, _, tbb = sys.exc_info()
             raise IndexError("adjMat too small to have such an edge").with_traceback(tbb)
 
+    def update_adj_mat_many(self, edges, weights=None):
+        """
+        It writes the weights of many edges in the adjacency matrix at once, using fancy indexing.
+        In an undirected brain, the transposed elements are also written.
+
+        Parameters
+        ----------
+        edges: list or np.array
+            The edges, as pairs (node1, node2) of indices of adjMat, or an array with shape (M, 2)
+        weights: list or np.array
+            The weight of each edge, where np.nan removes it from adjMat. If None, the weights of
+            the edges in G are used, and with `defer_adj_mat_sync` they are only written when
+            adjMat is next read (like in update_adj_mat())
+
+        Raises
+        ------
+        KeyError: Exception
+            If `weights` is None and an edge does not exist in G or doesn't have constants.WEIGHT property
+        IndexError: Exception
+            If an edge does not exist in adjMat
+        ValueError: Exception
+            If `weights` doesn't have a value for each edge
+        """
+        edges = np.asarray(edges)
+        if edges.dtype.kind not in 'iu':
+            edges = _id_array(edges.tolist(), edges=True)
+        if edges.ndim != 2 or edges.shape[1:] != (2,):
+            raise IndexError("The nodes of the edges must be indices of adjMat")
+        self.invalidate_metrics(edges=edges.tolist())
+
+        if weights is None:
+            if self.defer_adj_mat_sync:
+                self._adj_pending.extend(_id_list(edges))
+                return
+            weights = self._edge_weights(edges)
+        else:
+            weights = np.asarray(weights, dtype=float).ravel()
+            if len(weights) != len(edges):
+                raise ValueError("update_adj_mat_many() expects a weight for each edge")
+
+        if self._adj_pending or self._adj_rebuild:
+            self._sync_adj_mat()
+        self._write_adj_mat(edges[:, 0], edges[:, 1], weights)
+
+    def _sync_adj_mat(self):
+        """ It writes in adjMat the changes of G marked while `defer_adj_mat_sync` was set """
+        pending, rebuild = self._adj_pending, self._adj_rebuild
+        self._adj_pending, self._adj_rebuild = [], False
+        if rebuild:
+            defer, self.defer_adj_mat_sync = self.defer_adj_mat_sync, False
+            try:
+                self.reconstruct_adj_mat()
+            finally:
+                self.defer_adj_mat_sync = defer
+        elif pending:
+            edges = _id_array(pending, edges=True)
+            if edges.ndim != 2:
+                raise IndexError("The nodes of the edges must be indices of adjMat")
+            self._write_adj_mat(edges[:, 0], edges[:, 1], self._edge_weights(edges, strict=False))
+
+    def _edge_weights(self, edges, strict=True):
+        """
+        Weights of `edges` (array with rows (node1, node2)) in G. Edges which don't exist in G raise
+        KeyError if `strict`, or have np.nan otherwise
+        """
+        if self._edges is not None:
+            positions = _lookup(edges, np.column_stack((self._edges.rows, self._edges.cols)), not self.directed)
+            if strict and (positions < 0).any():
+                raise KeyError(tuple(edges[positions < 0][0].tolist()), "Edge does not exist in G")
+            return np.where(positions >= 0, self._edges.weights[positions] if len(self._edges) else np.nan, np.nan)
+
+        weights = np.empty(len(edges))
+        for pos, (node1, node2) in enumerate(edges.tolist()):
+            attrs = self._G.get_edge_data(node1, node2)
+            if attrs is None and not strict:
+                weights[pos] = np.nan
+            elif attrs is None or ct.WEIGHT not in attrs:
+                raise KeyError((node1, node2), "Edge does not exist in G or doesn't have constants.WEIGHT property")
+            else:
+                weights[pos] = attrs[ct.WEIGHT]
+        return weights
+
+    def _edge_lengths(self, edges, weight):
+        """
+        Length of each edge of `edges` (list of pairs (node1, node2)) in the shortest paths: its
+        property `weight` (1 if it's None or the edge doesn't have it, like in to_csr()), or np.inf if
+        the edge doesn't exist in G. The compact store is used while the edges are there
+        """
+        if self._edges is not None:
+            positions = _lookup(_id_array(edges, edges=True), np.column_stack((self._edges.rows, self._edges.cols)),
+                                not self.directed)
+            values = self._edges.values(weight)
+            return np.where(positions >= 0, values[positions] if len(values) else np.inf, np.inf)
+
+        lengths = np.full(len(edges), np.inf)
+        for pos, (node1, node2) in enumerate(edges):
+            attrs = self._G.get_edge_data(node1, node2)
+            if attrs is not None:
+                lengths[pos] = 1 if weight is None else attrs.get(weight, 1)
+        return lengths
+
+    def _write_adj_mat(self, rows, cols, weights):
+        """
+        It sets the elements (rows, cols) of adjMat to `weights` in a single batch, including the
+        transposed elements in an undirected brain. np.nan removes an element of a sparse adjMat.
+        """
+        if not self.directed:
+            rows, cols, weights = (np.concatenate((rows, cols)), np.concatenate((cols, rows)),
+                                   np.concatenate((weights, weights)))
+        _check_bounds(rows, cols, self._adj_mat.shape)
+
+        if not sparse.issparse(self._adj_mat):
+            self._adj_mat[rows, cols] = weights
+            return
+
+        # Replacing the existing elements of the sparse matrix, where the last weight of an element is kept
+        n_nodes = self._adj_mat.shape[1]
+        keys = rows.astype(np.int64) * n_nodes + cols
+        _, last = np.unique(keys[::-1], return_index=True)
+        last = len(keys) - 1 - last[~np.isnan(weights[::-1][last])]
+        coo = self._adj_mat.tocoo()
+        kept = ~np.isin(coo.row.astype(np.int64) * n_nodes + coo.col, keys)
+        self._adj_mat = sparse.csr_matrix((np.concatenate((coo.data[kept], weights[last])),
+                                           (np.concatenate((coo.row[kept], rows[last])),
+                                            np.concatenate((coo.col[kept], cols[last])))),
+                                          shape=self._adj_mat.shape)
+
     def local_thresholding(self, threshold_type=None, value=0., remove_unconnected=True):
         """
         Threshold the adjacency matrix by building from the minimum spanning tree (MST) and adding
         successive N-nearest neighbour degree graphs.
         Thus, if you want to have a local thresholding of N edges when the MST has more than N edges, thresholding will
         retain the MST.
-        In order to generate the MST, `self.weight_to_distance()` will need to be called.
+        In order to generate the MST, `self.weight_to_distance()` is called over all the possible edges, so every
+        retained edge has a distance (constants.DISTANCE).
         It only works for undirected graphs.
 
+        The MST is found with scipy's sparse graph routines, and the neighbours of each node are ranked
+        once, so each N-nearest neighbour graph only adds the next neighbour of each node.
+
         Parameters
         ----------
         threshold_type: {'edgePC', 'totalEdges', None}
@@ -497,120 +1623,265 @@ class Brain:
         if threshold_type == "edgePC" and (value < 0 or value > 100):
             raise TypeError("Invalid value for edgePC for local_thresholding()")
 
-        # Putting all the edges in the G object for local thresholding
-        self.apply_threshold()
-        maximum_edges = self.G.number_of_edges()
+        rows, cols, weights, distances, counts = self._local_threshold_edges(threshold_type, [value],
+                                                                             remove_unconnected)
+        self._set_edge_arrays(rows[:counts[0]], cols[:counts[0]], weights[:counts[0]], distances[:counts[0]])
 
-        if not nx.is_connected(self.G):
-            if remove_unconnected:
-                self.remove_unconnected_nodes() 
-            else:
-                raise TypeError("Adjacency Matrix is not connected. Impossible to execute local_thresholding()")
+        # Apply existing properties
+        self._replay_properties()
 
-        # create minimum spanning tree
-        self.weight_to_distance()
-        min_t = nx.minimum_spanning_tree(self.G, weight="distance")
-
-        if not threshold_type:
-            self.G = min_t
-            return  # Nothing else to do, just return
-        elif threshold_type == 'edgePC':
-            # find threshold as a percentage of total possible edges
-            upper_values = np.triu_indices(np.shape(self.adjMat)[0], k=1)
-            # only flatten the upper right part of the matrix
-            weights = np.array(self.adjMat[upper_values])
-
-            # remove NaNs
-            weights = weights[~np.isnan(weights)]
-            # calculate percentage
-            edgenum = int(value / 100. * len(weights))
-        else:  # 'totalEdges' option
-            edgenum = value
-
-        len_edges = min_t.number_of_edges()
-        if len_edges > edgenum:
-            print("Warning: The minimum spanning tree already has: " + str(len_edges) + " edges, select more edges.",
-                  "Local Threshold will be applied by just retaining the Minimum Spanning Tree")
-            self.local_thresholding()
-            return
+    def local_threshold_sweep(self, values, threshold_type='edgePC', remove_unconnected=True, metric=None):
+        """
+        Generator which applies local_thresholding() for several values, finding the MST and the nearest
+        neighbours only once. The graphs are nested, so from one value to the next only the edges
+        entering (or leaving) the graph are changed in G.
 
-        k = 1  # number of degrees for NNG
-        while len_edges < edgenum:
-            # create nearest neighbour graph
-            nng = self._nng(k)
-            number_before = nng.number_of_edges()
+        As in threshold_sweep(), G is the same object during the sweep, so the caller must not change
+        its edges, and in the end G is thresholded with the last value.
 
-            # remove edges from the NNG that exist already in the new graph/MST
-            nng.remove_edges_from(min_t.edges())
+        Parameters
+        ----------
+        values: list
+            The values used to threshold, in the order they are yielded
+        threshold_type: {'edgePC', 'totalEdges'}
+            The type of threshold applied, as in local_thresholding()
+        remove_unconnected: bool
+            Whether unconnected nodes are removed, as in local_thresholding()
+        metric: function
+            If defined, it is called with this brain for each value, and its result is yielded
+
+        Yields
+        ------
+        value, result: tuple
+            Each value of `values`, and `metric(self)` if `metric` is defined, or G otherwise
 
-            # Ending condition. No more edges to add so break the cycle
-            if nng.number_of_edges() == 0 and number_before >= maximum_edges:
-                break
+        Raises
+        ------
+        TypeError: Exception
+            If a not valid threshold type or value is passed, the graph is directed, or G is not connected
+        """
+        values = list(values)
+        if threshold_type not in ["edgePC", "totalEdges"]:
+            raise TypeError("Not a valid threshold_type for local_threshold_sweep()")
+        if self.directed:
+            raise TypeError("local_threshold_sweep() not available for directed graphs")
+        if threshold_type == "edgePC" and any(v < 0 or v > 100 for v in values):
+            raise TypeError("Invalid value for edgePC for local_threshold_sweep()")
+        if not values:
+            return
 
-            # add weights to NNG
-            for e in nng.edges():
-                nng.edges[e[0], e[1]][ct.WEIGHT] = self.adjMat[e[0], e[1]]
+        rows, cols, weights, distances, counts = self._local_threshold_edges(threshold_type, values,
+                                                                             remove_unconnected)
+        self._set_edge_arrays(rows, cols, weights, distances)
+        current = 0
+        for value, count in zip(values, counts):
+            if self._edges is not None:
+                # While G is not accessed, the edges are just views of the ordered arrays
+                self._edges = _EdgeArrays(rows[:count], cols[:count], weights[:count], distances[:count])
+            elif count > current:
+                self._G.add_edges_from((i, j, {ct.WEIGHT: w, ct.DISTANCE: d}) for i, j, w, d in
+                                       zip(rows[current:count].tolist(), cols[current:count].tolist(),
+                                           weights[current:count].tolist(), distances[current:count].tolist()))
+            elif count < current:
+                self._G.remove_edges_from(zip(rows[count:current].tolist(), cols[count:current].tolist()))
+            current = count
+            self.invalidate_metrics()
+
+            # Apply existing properties
+            self._replay_properties()
+
+            yield value, (self.G if metric is None else metric(self))
+
+    def _local_threshold_edges(self, threshold_type, values, remove_unconnected):
+        """
+        It returns the arrays (rows, columns, weights, distances) with the edges of local thresholding,
+        in the order they are added to G: the MST, and then the new edges of each N-nearest neighbour
+        graph from the strongest. It also returns how many of them are retained for each of `values`,
+        as the graphs are nested. The edges are only found up to the biggest value.
+        """
+        # All the possible edges, in row-major order
+        rows, cols, weights = self._threshold_edges(None, 0., False)
+        self._set_edge_arrays(rows, cols, weights)
+
+        nodes = list(self._G.nodes())
+        connections = sparse.csr_matrix((np.ones(len(rows)), (_positions(rows, nodes), _positions(cols, nodes))),
+                                        shape=(len(nodes), len(nodes)))
+        if nodes and csgraph.connected_components(connections, directed=False)[0] > 1:
+            if remove_unconnected:
+                self.remove_unconnected_nodes()
+            else:
+                raise TypeError("Adjacency Matrix is not connected. Impossible to execute local_thresholding()")
 
-            # get a list of edges from the NNG in order of weight
-            edge_list = sorted(nng.edges(data=True), key=lambda t: t[2][ct.WEIGHT], reverse=True)
+        # create minimum spanning tree, with ties broken as in Kruskal's algorithm over the edges in
+        # row-major order
+        self.weight_to_distance()
+        distances = self._edges.distances
+        order = np.argsort(distances, kind='stable')
+        n_adj = self.adjMat.shape[0]
+        added = [order[_spanning_forest(rows[order], cols[order], n_adj)]]
+        len_edges = len(added[0])
+
+        if threshold_type == 'edgePC':
+            edgenums = [int(v / 100. * len(weights)) for v in values]
+        elif threshold_type == 'totalEdges':
+            edgenums = values
+        else:
+            edgenums = [len_edges] * len(values)
+        for edgenum in edgenums:
+            if len_edges > edgenum:
+                print("Warning: The minimum spanning tree already has: " + str(len_edges) + " edges, select more edges.",
+                      "Local Threshold will be applied by just retaining the Minimum Spanning Tree")
+        counts = [int(max(len_edges, np.ceil(edgenum))) for edgenum in edgenums]
+
+        in_graph = np.zeros(len(weights), dtype=bool)
+        in_graph[added[0]] = True
+        keys = rows * n_adj + cols  # increasing, as the edges are in row-major order
+        ranked, n_valid = np.empty((n_adj, 0), dtype=int), np.zeros(n_adj, dtype=int)
+        k = 0  # the k-th nearest neighbour of each node is added to the NNG
+        while len_edges < max(counts):
+            if k == ranked.shape[1]:
+                ranked, n_valid = self._neighbour_ranks(min(n_adj, max(2 * k, 2 * max(counts) // max(1, n_adj) + 2)))
+            sources = np.flatnonzero(n_valid > k)
+            if not sources.size:
+                break  # No more edges to add
+
+            # The new edges of the NNG, which are not in the graph yet
+            targets = ranked[sources, k]
+            low, high = np.minimum(sources, targets), np.maximum(sources, targets)
+            found = np.clip(np.searchsorted(keys, low * n_adj + high), 0, max(len(keys) - 1, 0))
+            new = (keys[found] == low * n_adj + high) & ~in_graph[found] if len(keys) else np.zeros(len(low), bool)
+            sources, low, high, found = sources[new], low[new], high[new], found[new]
+
+            # An edge found from both nodes is kept once. Edges with the same weight are added in the
+            # order of the NNG's edges: by their lowest node, first the one it chose and then by the
+            # other node
+            from_other = sources != low
+            unique = np.lexsort((from_other, found))
+            unique = unique[np.unique(found[unique], return_index=True)[1]]
+            unique = unique[np.lexsort((high[unique], from_other[unique], low[unique], -weights[found[unique]]))]
 
             # add edges to graph in order of connectivity strength
-            for edge in edge_list:
-                min_t.add_edges_from([edge])
-                len_edges = min_t.number_of_edges()
-                if len_edges >= edgenum:
-                    break
-
+            new_edges = found[unique][:max(counts) - len_edges]
+            in_graph[new_edges] = True
+            added.append(new_edges)
+            len_edges += len(new_edges)
             k += 1
 
-        self.G = min_t
-
-        # Apply existing properties
-        if self.update_props_after_threshold:
-            self._add_properties(self.node_properties)
-            self._add_properties(self.edge_properties)
+        added = np.concatenate(added)
+        counts = [min(count, len(added)) for count in counts]
+        return rows[added], cols[added], weights[added], distances[added], counts
 
     def binarise(self):
         """
         Removes weighting from edges by assigning a weight of 1 to the existing edges
         """
-        for edge in self.G.edges(data=True):
-            edge[2][ct.WEIGHT] = 1
+        self.transform_edges("binary")
 
     def make_edges_absolute(self):
         """
         Makes all the edges in self.G absolute
         """
-        for edge in self.G.edges(data=True):
-            edge[2][ct.WEIGHT] = abs(edge[2][ct.WEIGHT])
+        self.transform_edges("absolute")
 
-    def remove_unconnected_nodes(self):
-        """
-        Removes nodes with no connections
+    def transform_edges(self, transform, source=ct.WEIGHT, target=None):
         """
-        node_list = [v for v in self.G.nodes() if self.G.degree(v) == 0]
-        self.G.remove_nodes_from(node_list)
-
-    def _nng(self, k):
-        """ Private method to help local thresholding by creating a k-nearest neighbour graph"""
-        gra = nx.Graph()
-        nodes = list(range(len(self.adjMat[0])))
+        It applies a transform to a property of all the edges at once, on the array with their values,
+        and writes the results back in a single step. While the edges are in the compact store, its
+        arrays of weights and distances are transformed directly, without going through G.
 
-        gra.add_nodes_from(nodes)
+        Parameters
+        ----------
+        transform: str or function
+            One of the following transforms of each value v:
+                "binary" -> 1 (an int, also for the edges without the `source` property)
+                "absolute" -> |v|
+                "distance" -> max(v) + 1/N - v, where N is the number of nodes (see weight_to_distance())
+                "inverse" -> 1/v
+                "neg_log" -> -log(v)
+                "fisher_z" -> arctanh(v), the Fisher r-to-z transform of correlations
+                "rank" -> rank of v divided by the number of edges, in (0, 1], with average ranks for ties
+            Or a function receiving the array of values and the number of nodes, which returns the
+            array of transformed values. Values of zero become np.inf with "inverse" and "neg_log"
+        source: str
+            The property of the edges which is transformed
+        target: str
+            The property of the edges where the results are written. If None, it is `source`
 
-        for i in nodes:
-            line = np.ma.masked_array(self.adjMat[i, :], mask=np.isnan(self.adjMat[i]))
-            line.mask[i] = True
+        Raises
+        ------
+        KeyError: Exception
+            If `transform` is not one of the names above, or an edge doesn't have the `source` property
+            (except with "binary")
+        ValueError: Exception
+            If the function doesn't return a value for each edge
+        """
+        function = transform if callable(transform) else _EDGE_TRANSFORMS[transform]
+        binary = transform == "binary"
+        target = source if target is None else target
+        edges = self._edges
+        self.invalidate_metrics()
+
+        if edges is not None and (binary or source == ct.WEIGHT
+                                  or (source == ct.DISTANCE and edges.distances is not None)):
+            if binary:
+                results = np.ones(len(edges), dtype=int)
+            else:
+                values = edges.weights if source == ct.WEIGHT else edges.distances
+                results = _transformed(function, values, self._G.number_of_nodes())
+            if target == ct.WEIGHT:
+                edges.weights = results
+            elif target == ct.DISTANCE:
+                edges.distances = results
+            else:
+                edges.attrs.setdefault(target, []).append((np.arange(len(edges)), results))
+            return
 
-            for _ in range(k):
-                node = np.argmax(line)
+        attrs = [edge[2] for edge in self.G.edges(data=True)]
+        if binary:
+            for edge_attrs in attrs:
+                edge_attrs[target] = 1
+            return
+        try:
+            values = np.fromiter((edge_attrs[source] for edge_attrs in attrs), float, len(attrs))
+        except KeyError as error:
+            raise KeyError(error, "An edge doesn't have the property " + str(source)) from None
+        for edge_attrs, value in zip(attrs, _transformed(function, values, self._G.number_of_nodes()).tolist()):
+            edge_attrs[target] = value
 
-                if not np.isnan(self.adjMat[i, node]):
-                    gra.add_edge(i, node)
+    def remove_unconnected_nodes(self):
+        """
+        Removes nodes with no connections
+        """
+        self.invalidate_metrics()
+        if self._edges is not None:
+            connected = set(np.unique(np.concatenate((self._edges.rows, self._edges.cols))).tolist())
+            self._G.remove_nodes_from([v for v in self._G.nodes() if v not in connected])
+            return
 
-                line.mask[node] = True
+        node_list = [v for v in self.G.nodes() if self.G.degree(v) == 0]
+        self.G.remove_nodes_from(node_list)
 
-        return gra
+    def _neighbour_ranks(self, width):
+        """
+        It returns, for each row of adjMat, the columns of its `width` biggest non-NaN values outside
+        the diagonal (from the biggest, ties by column), and the number of such values in the row.
+        adjMat is sorted by blocks of rows, so it can be memory-mapped.
+        """
+        n_nodes = self.adjMat.shape[0]
+        ranked = np.empty((n_nodes, width), dtype=np.int32 if n_nodes < 2 ** 31 else np.int64)
+        n_valid = np.empty(n_nodes, dtype=int)
+        for rows_slice in self._row_slices():
+            block = self._adj_rows(rows_slice)
+            block[np.arange(len(block)), np.arange(rows_slice.start, rows_slice.stop)] = np.nan
+            ranked[rows_slice] = np.argsort(-block, axis=1, kind='stable')[:, :width]
+            n_valid[rows_slice] = np.count_nonzero(~np.isnan(block), axis=1)
+        return ranked, n_valid
+
+    def _adj_rows(self, rows_slice):
+        """ Copy of some rows of adjMat as a dense array, where missing elements of a sparse adjMat are np.nan """
+        if sparse.issparse(self.adjMat):
+            return brain_utils.csr_to_dense(self.adjMat[rows_slice])
+        return np.array(self.adjMat[rows_slice], dtype=float)
 
     def find_spatially_nearest(self, node_list, contra=False, midline=44.5, connected=True, threshold=None):
         """
@@ -621,50 +1892,29 @@ class Brain:
             duff_node = random.choice(node_list)
         else:
             duff_node = node_list
+            node_list = [node_list]
 
-        nodes = [v for v in self.G.nodes() if v != duff_node]
-        nodes = [v for v in nodes if v not in node_list]
-
-        shortestnode = (None, None)
-        tlist = []  # list of closest nodes according to threshold
-        if not threshold:
-            tval = 0.
+        nodes = [v for v in self.G.nodes() if v != duff_node and v not in node_list]
 
         # get the contralaterally closest node if desired
-        pos = [v for v in self.G.nodes[duff_node][ct.XYZ]]
-        if contra:
-            if pos[0] < midline:
-                pos[0] = midline + (midline - pos[0])
-            else:
-                pos[0] = midline + (pos[0] - midline)
-        pos = tuple(pos)
+        pos = self.node_coords([duff_node])[0]
+        if contra and pos[0] < midline:
+            pos[0] = midline + (midline - pos[0])
 
-        for node in nodes:
-            try:
-                distance = np.linalg.norm(np.array(pos - np.array(self.G.nodes[node][ct.XYZ])))
-                if distance < tval:
-                    tlist.append(node)
-            except BaseException:
-                print("Finding the spatially nearest node requires x,y,z values")
-
-            if shortestnode[0]:
-                if distance < shortestnode[1]:
-                    if connected:
-                        if self.G.degree(node) > 0:
-                            shortestnode = (node, distance)
-                    else:
-                        shortestnode = (node, distance)
-
-            else:
-                if connected:
-                    if self.G.degree(node) > 0:
-                        shortestnode = (node, distance)
-                else:
-                    shortestnode = (node, distance)
+        if np.isnan(pos).any() or np.isnan(self.node_coords(nodes)).any():
+            print("Finding the spatially nearest node requires x,y,z values")
+        with np.errstate(invalid='ignore'):
+            distances = np.linalg.norm(self.node_coords(nodes) - pos, axis=1)
 
         if threshold:
-            return tlist
-        return shortestnode[0]
+            return [n for n, dist in zip(nodes, distances) if dist < threshold]
+
+        valid = ~np.isnan(distances)
+        if connected:
+            valid &= np.array([self.G.degree(n) > 0 for n in nodes], dtype=bool)
+        if not valid.any():
+            return None
+        return nodes[np.flatnonzero(valid)[np.argmin(distances[valid])]]
 
     def find_linked_nodes(self):
         """
@@ -675,6 +1925,24 @@ class Brain:
         Be sure to call this method again if you threshold your brain instance again
         """
 
+        if self._edges is not None:
+            sources, targets = self._edges.rows, self._edges.cols
+            if self.directed:
+                order = np.argsort(sources, kind='stable')
+            else:
+                # As in G.edges(), a node is first linked to its neighbours which come before it
+                # in G.nodes(), and then to the others in the order of the edges
+                sources, targets = np.concatenate((sources, targets)), np.concatenate((targets, sources))
+                positions = _positions(np.concatenate((sources, targets)), list(self._G.nodes()))
+                source_pos, target_pos = positions[:len(sources)], positions[len(sources):]
+                before = target_pos < source_pos
+                order = np.lexsort((np.where(before, target_pos, np.tile(np.arange(len(self._edges)), 2)),
+                                    ~before, sources))
+            nodes, starts = np.unique(sources[order], return_index=True)
+            linked = dict(zip(nodes.tolist(), (arr.tolist() for arr in np.split(targets[order], starts[1:]))))
+            nx.set_node_attributes(self._G, {n: linked.get(n, []) for n in self._G.nodes()}, ct.LINKED_NODES)
+            return
+
         # Resetting all nodes from some past information (few edges might not
         #  be able to reset this field in all nodes)
         for n in self.G.nodes(data=True):
@@ -694,17 +1962,12 @@ class Brain:
         the "weaker" the connection.
         In this case there is no measurement unit for the distance, as it is just a conversion from the weights.
         The distances can be accessed in each node's property with constants.DISTANCE
+        Other conversions (e.g. "inverse" or "neg_log") are available with transform_edges().
         """
-        edge_list = [v[2][ct.WEIGHT] for v in self.G.edges(data=True)]
-
-        # get the maximum edge value, plus a small correction to keep the values above zero
-        # the correction is the inverse of the number of nodes - designed to keep
+        # The distance is the maximum edge value minus the weight, plus a small correction to keep the
+        # values above zero. The correction is the inverse of the number of nodes - designed to keep
         # calculations of efficiency sensible
-        emax = np.max(edge_list) + 1 / float(self.G.number_of_nodes())
-
-        for edge in self.G.edges():
-            self.G.edges[edge[0], edge[1]][ct.DISTANCE] = emax - self.G.edges[edge[0], edge[1]][
-                ct.WEIGHT]  # convert weights to a positive distance
+        self.transform_edges("distance", target=ct.DISTANCE)
 
     def copy_hemisphere(self, hsphere="R", midline=0):
         """
@@ -729,28 +1992,475 @@ class Brain:
         """
         if hsphere not in ['R', 'L']:
             raise TypeError("Wrong hemisphere defined")
+        self.invalidate_metrics()
 
-        nodes_to_remove = []
-        nodes_iter = dict(self.G.nodes(data=True))  # Copying current nodes so we can edit G
+        nodes = list(self.G.nodes())
+        positions = self.node_coords(nodes)
+        if hsphere == 'L':
+            to_copy = positions[:, 0] < midline
+            new_x = midline + (midline - positions[:, 0])
+        else:
+            to_copy = positions[:, 0] > midline
+            new_x = midline - (positions[:, 0] - midline)
 
         new_name = 'L' if hsphere == 'R' else 'R'
 
-        for n in nodes_iter.items():
-            pos = self.G.nodes[n[0]][ct.XYZ]
+        for pos in np.flatnonzero(to_copy):
+            # Adding new node and its attributes
+            node = nodes[pos]
+            new_node = str(node) + new_name
+            self.G.add_node(new_node, **self.G.nodes[node])
+            self.G.nodes[new_node][ct.XYZ] = (float(new_x[pos]), float(positions[pos, 1]), float(positions[pos, 2]))
 
-            if hsphere == 'L' and pos[0] < midline:
-                new_pos = (midline + (midline - pos[0]), pos[1], pos[2])
-            elif hsphere == 'R' and pos[0] > midline:
-                new_pos = (midline - (pos[0] - midline), pos[1], pos[2])
-            else:
-                nodes_to_remove.append(n[0])
+        self.G.remove_nodes_from([nodes[pos] for pos in np.flatnonzero(~to_copy)])
+
+
+class _EdgeArrays:
+    """
+    Compact storage of the edges of a brain: parallel arrays with the two nodes, the weight and
+    the distance (None until weight_to_distance() is called) of each edge, in the order the edges
+    are added to G. It uses tens of bytes per edge, instead of the hundreds of a networkx edge.
+    The arrays are never changed in place, so they can be views of other arrays.
+    """
+
+    def __init__(self, rows, cols, weights, distances=None):
+        self.rows = rows
+        self.cols = cols
+        self.weights = weights
+        self.distances = distances
+        # other attributes, as {attribute: [(positions, values), ...]}, where positions are
+        # indexes of the edges and the last value set for an edge is used
+        self.attrs = {}
+        # whether the stored edge properties of the brain are looked up for these edges
+        self.replay = False
+
+    def __len__(self):
+        return len(self.weights)
+
+    @classmethod
+    def empty(cls):
+        """ A store without edges """
+        return cls(np.empty(0, dtype=int), np.empty(0, dtype=int), np.empty(0))
+
+    def values(self, weight):
+        """ Values of the property `weight` of the edges, or 1 if they don't have it (see Brain.to_csr()) """
+        if weight == ct.WEIGHT:
+            return self.weights
+        if weight == ct.DISTANCE and self.distances is not None:
+            return self.distances
+        return np.ones(len(self))
+
+
+class _PathLengths:
+    """
+    Shortest path lengths cached by Brain.path_lengths(), with the rows which are stale because
+    edges were removed (or made longer) since they were calculated
+    """
+
+    def __init__(self, settings, nodes, graph, lengths, fingerprint):
+        self.settings = settings  # (weight, dtype, mmap_file)
+        self.index = {node: i for i, node in enumerate(nodes)}
+        self.graph = graph  # edge lengths when the rows which are not stale were calculated
+        self.lengths = lengths
+        self.stale = np.zeros(len(nodes), dtype=bool)
+        self.changed = {}  # lengths of the edges changed since `graph`, as {(i, j): length}
+        # (hash of the nodes, hash of the set of edges) of G expected by the cache, see Brain._edges_fingerprint()
+        self.fingerprint = fingerprint
+
+    def invalidate(self, edges, lengths):
+        """
+        It marks as stale the rows with a shortest path that could go through the changed `edges`,
+        given their new `lengths` (np.inf if they were removed). It returns False if all the rows must
+        be calculated again, because an edge is new, shorter, or between unknown nodes
+        """
+        tol = max(1e-10, 100 * np.finfo(self.lengths.dtype).eps)
+        for (u, v), new in zip(edges, lengths.tolist()):
+            if u not in self.index or v not in self.index:
+                return False
+            i, j = sorted((self.index[u], self.index[v]))
+            if i == j:
+                continue
+            old = self.changed.get((i, j), self._graph_length(i, j))
+            if new < old:
+                return False
+            if new == old:
                 continue
 
-            # Adding new node and its attributes
-            self.G.add_node(str(n[0]) + new_name)
-            for prop in n[1].items():
-                self.G.nodes[str(n[0]) + new_name][prop[0]] = prop[1]
+            if new == np.inf:
+                nodes_hash, edges_hash = self.fingerprint
+                removed = _edge_set_hash(np.array([i]), np.array([j]), len(self.index), True)
+                self.fingerprint = (nodes_hash, (edges_hash - removed) % 2 ** 64)
+            self.changed[(i, j)] = new
+            col_i, col_j = np.asarray(self.lengths[:, i]), np.asarray(self.lengths[:, j])
+            with np.errstate(invalid='ignore'):
+                self.stale |= np.abs(np.abs(col_i - col_j) - old) <= tol * np.maximum(col_i, col_j)
+        return True
+
+    def _graph_length(self, i, j):
+        """ Length of the edge (i, j) in `graph`, which can be 0, or np.inf if there isn't such edge """
+        start, end = self.graph.indptr[i], self.graph.indptr[i + 1]
+        found = np.flatnonzero(self.graph.indices[start:end] == j)
+        return float(self.graph.data[start + found[0]]) if found.size else np.inf
+
+
+class _PropertyColumn:
+    """
+    The values of a property of nodes or edges, kept as arrays: `ids` (nodes, or edges as rows
+    (node1, node2)) and `values`, in the order they were imported. The last value of an id is the
+    one which counts
+    """
+
+    def __init__(self, edges):
+        self.edges = edges
+        self._chunks = []
+        self._merged = None
+
+    def append(self, ids, values):
+        """ Adds the arrays of some ids and values, created by _id_array() and _value_array() (or typed) """
+        self._chunks.append((ids, values))
+        self._merged = None
+
+    @property
+    def ids(self):
+        return self._merge()[0]
+
+    @property
+    def values(self):
+        return self._merge()[1]
+
+    def _merge(self):
+        """ The chunks of ids and values are concatenated when they are needed """
+        if self._merged is None:
+            ids = [chunk[0] for chunk in self._chunks]
+            if all(arr.dtype.kind in 'iu' for arr in ids) and len({arr.ndim for arr in ids}) == 1:
+                ids = np.concatenate(ids)
+            else:
+                ids = _id_array(itertools.chain.from_iterable(map(_id_list, ids)), self.edges)
+            self._merged = (ids, _concat_values([chunk[1] for chunk in self._chunks]))
+            self._chunks = [self._merged]
+        return self._merged
+
+
+def _top_k(keys, k, later=None):
+    """
+    Positions (in increasing order) of the `k` elements of `keys` which a stable ascending sort
+    would put at the end. It uses np.partition, so it doesn't sort all the keys: the elements
+    above the k-th biggest key are taken, and ties with it are broken in favour of later positions.
+    If `later` (boolean array) is defined, the ties are broken as if the elements where it is True
+    were moved after all the others.
+    """
+    if k >= len(keys):
+        return np.arange(len(keys))
+
+    kth = np.partition(keys, len(keys) - k)[len(keys) - k]
+    above = np.flatnonzero(keys > kth)
+    ties = np.flatnonzero(keys == kth)
+    if later is not None:
+        ties = ties[np.argsort(later[ties], kind='stable')]
+    selected = np.concatenate((above, ties[len(ties) - (k - len(above)):]))
+    selected.sort()
+    return selected
+
+
+def _spanning_forest(rows, cols, n_nodes):
+    """
+    Positions (in increasing order) of the edges which Kruskal's algorithm puts in a spanning forest
+    when the edges (rows, cols), between nodes 0..n_nodes-1, are added in their order. The edges'
+    positions are used as weights of scipy's minimum spanning tree, so ties are broken the same way.
+    """
+    ranks = np.arange(1, len(rows) + 1, dtype=float)
+    tree = csgraph.minimum_spanning_tree(sparse.csr_matrix((ranks, (rows, cols)), shape=(n_nodes, n_nodes)))
+    return np.sort(tree.data).astype(int) - 1
+
+
+def _tval_filter(value, use_absolute):
+    """ Function which returns whether each value of an array passes a "tVal" threshold of `value` """
+    if use_absolute:
+        return lambda weights: (weights >= abs(value)) | (weights <= -abs(value))
+    return lambda weights: weights >= value
+
+
+def _transformed(function, values, n_nodes):
+    """ Result of an edge transform (see Brain.transform_edges()) over the array `values` """
+    results = np.asarray(function(values, n_nodes), dtype=float)
+    if results.shape != values.shape:
+        raise ValueError("The edge transform must return a value for each edge")
+    return results
+
+
+def _to_distance(values, n_nodes):
+    """ Distance of each weight, as max(values) + 1/n_nodes - values """
+    if not len(values):
+        return values.copy()
+    return np.max(values) + 1 / float(n_nodes) - values
 
-            self.G.nodes[str(n[0]) + new_name][ct.XYZ] = new_pos
 
-        self.G.remove_nodes_from(nodes_to_remove)
+def _inverse(values, _):
+    """ Inverse of each value, with np.inf for zero """
+    with np.errstate(divide='ignore'):
+        return 1 / values
+
+
+def _neg_log(values, _):
+    """ Negative logarithm of each value, with np.inf for zero """
+    with np.errstate(divide='ignore'):
+        return -np.log(values)
+
+
+def _fisher_z(values, _):
+    """ Fisher r-to-z transform of each value, with +-np.inf for +-1 """
+    with np.errstate(divide='ignore'):
+        return np.arctanh(values)
+
+
+def _rank(values, _):
+    """ Rank of each value (average rank for ties), divided by the number of values """
+    return stats.rankdata(values) / max(1, len(values))
+
+
+# Transforms which can be applied with Brain.transform_edges(), by name
+_EDGE_TRANSFORMS = {
+    "binary": lambda values, _: np.ones(len(values), dtype=int),
+    "absolute": lambda values, _: np.absolute(values),
+    "distance": _to_distance,
+    "inverse": _inverse,
+    "neg_log": _neg_log,
+    "fisher_z": _fisher_z,
+    "rank": _rank,
+}
+
+
+def _metric_function(name):
+    """
+    The function of the measure `name` for Brain.metric()
+
+    Raises
+    ------
+    TypeError: Exception
+        If `name` is not a valid measure
+    """
+    # Imported here, as metrics imports this module
+    from maybrain import metrics
+
+    if callable(name):
+        return name
+    function = getattr(metrics, str(name), None) if not str(name).startswith('_') else None
+    if getattr(function, '__module__', None) != metrics.__name__:
+        raise TypeError("Not a valid name for metric()")
+    return function
+
+
+def _edge_set_hash(rows, cols, n_nodes, symmetric):
+    """
+    Hash of the edges between the node positions `rows` and `cols` (in both directions if
+    `symmetric`), which doesn't depend on their order: the sum (modulo 2**64) of a hash of each
+    edge, so it can also be updated edge by edge
+    """
+    if symmetric:
+        rows, cols = np.minimum(rows, cols), np.maximum(rows, cols)
+    keys = rows.astype(np.uint64) * np.uint64(n_nodes) + cols.astype(np.uint64)
+    # splitmix64 finaliser, so that similar edges have unrelated hashes
+    keys ^= keys >> np.uint64(30)
+    keys *= np.uint64(0xbf58476d1ce4e5b9)
+    keys ^= keys >> np.uint64(27)
+    keys *= np.uint64(0x94d049bb133111eb)
+    keys ^= keys >> np.uint64(31)
+    return int(keys.sum(dtype=np.uint64))
+
+
+def _result_size(result):
+    """ Approximate memory (in bytes) used by a result of Brain.metric() """
+    if isinstance(result, np.ndarray):
+        return result.nbytes
+    if sparse.issparse(result):
+        return sum(getattr(result, attr).nbytes for attr in ['data', 'indices', 'indptr', 'row', 'col']
+                   if hasattr(result, attr))
+    if isinstance(result, (tuple, list)):
+        return sys.getsizeof(result) + sum(_result_size(value) for value in result)
+    if isinstance(result, dict):
+        return sys.getsizeof(result) + sum(_result_size(key) + _result_size(value) for key, value in result.items())
+    return sys.getsizeof(result)
+
+
+def _make_read_only(result):
+    """ It makes the arrays of a result of Brain.metric() read-only """
+    if isinstance(result, np.ndarray):
+        result.flags.writeable = False
+    elif isinstance(result, (tuple, list)):
+        for value in result:
+            _make_read_only(value)
+
+
+def _check_bounds(rows, cols, shape):
+    """ It raises IndexError if any element (rows, cols) is outside a matrix with `shape` """
+    if len(rows) and (min(rows.min(), cols.min()) < 0 or rows.max() >= shape[0] or cols.max() >= shape[1]):
+        raise IndexError("adjMat too small to have such an edge")
+
+
+def _is_index(node, length):
+    """ Whether `node` is an integer which can be used as index of an array with size `length` """
+    return isinstance(node, (int, np.integer)) and 0 <= node < length
+
+
+def _positions(ids, nodes):
+    """ Position of each element of `ids` (np.array) in the list `nodes`, or -1 if it's not there """
+    return _lookup(ids, _id_array(nodes))
+
+
+def _lookup(query, known, symmetric=False):
+    """
+    Position of the last occurrence in `known` of each element of `query`, or -1 if it's not there.
+    Both are arrays of nodes, or of edges (rows (node1, node2), or tuples in object arrays), created
+    with _id_array(). Edges are matched in both directions if `symmetric`. The search is done with
+    numpy when all the nodes are integers.
+    """
+    if not len(query) or not len(known):
+        return np.full(len(query), -1)
+
+    if query.dtype.kind in 'iu' and known.dtype.kind in 'iu':
+        if query.ndim == 2:
+            if symmetric:
+                query = np.sort(query, axis=1)
+                known = np.sort(known, axis=1)
+            # Each edge becomes a single integer key
+            low = min(query.min(), known.min())
+            base = max(query.max(), known.max()) - low + 1
+            query = (query[:, 0] - low) * base + (query[:, 1] - low)
+            known = (known[:, 0] - low) * base + (known[:, 1] - low)
+
+        keys, first = np.unique(known[::-1], return_index=True)
+        found = np.clip(np.searchsorted(keys, query), 0, len(keys) - 1)
+        return np.where(keys[found] == query, len(known) - 1 - first[found], -1)
+
+    def key(elem):
+        return frozenset(elem) if symmetric and isinstance(elem, tuple) else elem
+
+    index = {key(elem): pos for pos, elem in enumerate(_id_list(known))}
+    return np.array([index.get(key(elem), -1) for elem in _id_list(query)], dtype=int)
+
+
+def _id_array(ids, edges=False):
+    """
+    Array with the ids of nodes, or of edges if `edges`. It has integers when possible (with shape
+    (M, 2) for edges), or python objects otherwise (tuples for edges)
+    """
+    ids = list(ids)
+    if all(isinstance(elem, (int, np.integer)) for elem in (itertools.chain.from_iterable(ids) if edges else ids)):
+        return np.array(ids, dtype=int).reshape((-1, 2) if edges else (-1,))
+    array = np.empty(len(ids), dtype=object)
+    for pos, elem in enumerate(ids):
+        array[pos] = tuple(elem) if edges else elem
+    return array
+
+
+def _id_list(ids):
+    """ List with the ids of an array created by _id_array(), where edges are tuples """
+    return list(map(tuple, ids.tolist())) if ids.ndim == 2 else ids.tolist()
+
+
+def _value_array(values):
+    """ Array of python objects with the given values, which can be of any type """
+    values = list(values)
+    array = np.empty(len(values), dtype=object)
+    for pos, val in enumerate(values):
+        array[pos] = val
+    return array
+
+
+def _concat_values(arrays):
+    """ Concatenation of arrays of values, which become python objects if their types differ """
+    if len({arr.dtype.kind if arr.dtype.kind == 'U' else arr.dtype for arr in arrays}) > 1:
+        arrays = [arr.astype(object) for arr in arrays]
+    return np.concatenate(arrays)
+
+
+def _property_columns(properties):
+    """
+    It groups a sequence of properties in the format of `Brain.node_properties` and
+    `Brain.edge_properties` into columns, returning ({name: _PropertyColumn}, {name: _PropertyColumn})
+    for nodes and edges
+    """
+    columns = ({}, {})
+    grouped = ({}, {})
+    for prop in properties:
+        if len(prop) in [3, 4]:
+            edges = len(prop) == 4
+            ids, values = grouped[edges].setdefault(prop[0], ([], []))
+            ids.append((prop[1], prop[2]) if edges else prop[1])
+            values.append(prop[-1])
+
+    for edges in [False, True]:
+        for prop_name, (ids, values) in grouped[edges].items():
+            columns[edges][prop_name] = _PropertyColumn(edges)
+            columns[edges][prop_name].append(_id_array(ids, edges), _value_array(values))
+    return columns
+
+
+def _warn_unmatched(prop_name, kind, ids, shown=10):
+    """ Prints a single warning with (some of) the ids of nodes/edges which couldn't get a property """
+    print('Warning! Unable to process property %s for %d %s which are not in G: %s%s'
+          % (prop_name, len(ids), kind, ', '.join(map(str, ids[:shown])), ', ...' if len(ids) > shown else ''))
+
+
+def _image_data(image, labels=False):
+    """
+    It returns the data of a nibabel image, which is memory-mapped when the file is uncompressed
+    and not scaled, and the values already have the needed type: float32, or integers if `labels`
+    (otherwise converted to the smallest integer type which holds them)
+    """
+    data = np.asanyarray(image.dataobj)
+    if not labels:
+        return data if data.dtype == np.float32 else np.asarray(data).astype(np.float32)
+    if data.dtype.kind in 'iu':
+        return data
+
+    data = np.rint(np.nan_to_num(np.asarray(data)))
+    if not data.size:
+        return data.astype(np.uint8)
+    return data.astype(np.result_type(np.min_scalar_type(int(data.min())), np.min_scalar_type(int(data.max()))))
+
+
+def _map_labels(volume, labels, values):
+    """
+    It creates an array with the shape of `volume` where the elements with a value in `labels`
+    get the corresponding value in `values`, and the others are zero. The volume is read once.
+    """
+    out_dtype = np.result_type(values.dtype, volume.dtype) if values.size else volume.dtype
+    if not labels.size:
+        return np.zeros(volume.shape, dtype=out_dtype)
+
+    volume = np.asarray(volume)
+    integer_labels = np.all(labels == np.rint(labels)) and labels.min() >= 0
+    if volume.dtype.kind in 'iu' and integer_labels and volume.size and volume.min() >= 0 \
+            and max(labels.max(), volume.max()) <= 2 ** 24:
+        # A lookup table indexed by label
+        table = np.zeros(max(int(labels.max()), int(volume.max())) + 1, dtype=out_dtype)
+        table[labels.astype(int)] = values
+        return table[volume]
+
+    order = np.argsort(labels, kind='stable')
+    labels, values = labels[order], values[order]
+    positions = np.clip(np.searchsorted(labels, volume), 0, len(labels) - 1)
+    return np.where(labels[positions] == volume, values[positions], 0).astype(out_dtype)
+
+
+def _attr_columns(attr_dicts, ignore):
+    """
+    Converts a sequence of attribute dictionaries into {attribute: [positions, values]}, ignoring
+    the attributes in `ignore`
+    """
+    columns = {}
+    for pos, attrs in enumerate(attr_dicts):
+        for attr, val in attrs.items():
+            if attr not in ignore:
+                column = columns.setdefault(attr, [[], []])
+                column[0].append(pos)
+                column[1].append(val)
+    return columns
+
+
+def _to_builtin(obj):
+    """ Converts numpy scalars and arrays to python objects, so they can be serialised to JSON """
+    if isinstance(obj, (np.generic, np.ndarray)):
+        return obj.tolist()
+    raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
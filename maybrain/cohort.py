@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+Module which contains the definition of BrainCohort class.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from maybrain import brain as mbt
+from maybrain.utils import brain_utils, readers
+
+# Number of matrix elements read at once when scanning the stacked matrices
+_BLOCK_ELEMENTS = 2 ** 22
+
+
+class BrainCohort:
+    """
+    A class that defines a group of subjects whose adjacency matrices, all with the same size, are
+    stacked in one contiguous array of shape (subjects, N, N).
+    Instances of `Brain` for each subject are only created when asked for.
+    """
+
+    def __init__(self, directed=False):
+        """
+        Initialise the cohort object.
+        """
+        # whether the brains of this cohort are directed graphs or not
+        self.directed = directed
+        # stacked adjacency matrices, with shape (subjects, N, N)
+        self.adj_mats = None
+        # identification of each subject, in the same order as adj_mats
+        self.subjects = []
+
+    def __len__(self):
+        return 0 if self.adj_mats is None else len(self.adj_mats)
+
+    def __getitem__(self, index):
+        return self.brain(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.brain(index)
+
+    def import_adj_files(self, fnames, delimiter=None, na_vals=None, cache=False, mmap_file=None,
+                         n_jobs=None, subjects=None):
+        """
+        Imports the adjacency matrices of several subjects from files, parsing them in parallel.
+
+        Parameters
+        ----------
+        fnames: str or list of str
+            A list of file names, or a directory from which all the files (in alphabetical order)
+            are imported
+        delimiter: str
+            The delimiter of the values inside the matrices, like ","
+        na_vals: list of str
+            How the "Not a Number" values are represented in the files
+        cache: bool
+            Whether binary sidecar caches are used for each file. See `utils.read_adj_matrix()`
+        mmap_file: str
+            If defined, the stacked matrices are kept in this .npy file (created/overwritten) as a
+            memory-mapped array, instead of being fully held in memory
+        n_jobs: int
+            Number of processes parsing the files. If None, the number of CPUs is used
+        subjects: list
+            Identification of each subject. If None, the file names without extension are used
+
+        Raises
+        ------
+        ValueError: Exception
+            If the matrices don't have all the same size
+        """
+        if isinstance(fnames, str) and os.path.isdir(fnames):
+            fnames = [os.path.join(fnames, f) for f in sorted(os.listdir(fnames))
+                      if os.path.isfile(os.path.join(fnames, f)) and '.mbcache-' not in f]
+        fnames = list(fnames)
+        if subjects is None:
+            subjects = [os.path.splitext(os.path.basename(f))[0] for f in fnames]
+
+        args = [(f, delimiter, na_vals, cache) for f in fnames]
+        if n_jobs == 1:
+            adj_mats = _stack_matrices(map(_read_adj_matrix, args), fnames, mmap_file)
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                adj_mats = _stack_matrices(executor.map(_read_adj_matrix, args), fnames, mmap_file)
+
+        self.adj_mats = adj_mats
+        self.subjects = list(subjects)
+
+    def import_adj_stack(self, adj_mats, subjects=None):
+        """
+        Uses an existing array with shape (subjects, N, N) as the adjacency matrices of this
+        cohort. The array is not copied, so any change to it is seen by the cohort (and vice-versa).
+
+        Parameters
+        ----------
+        adj_mats: np.array
+            The stacked adjacency matrices (e.g. a np.memmap)
+        subjects: list
+            Identification of each subject. If None, the subjects are numbered from zero
+
+        Raises
+        ------
+        ValueError: Exception
+            If `adj_mats` does not have the shape (subjects, N, N)
+        """
+        if not isinstance(adj_mats, np.ndarray):
+            adj_mats = np.asarray(adj_mats)
+        if adj_mats.ndim != 3 or adj_mats.shape[1] != adj_mats.shape[2]:
+            raise ValueError("import_adj_stack() expects an array with shape (subjects, N, N)")
+        if subjects is None:
+            subjects = list(range(len(adj_mats)))
+
+        self.adj_mats = adj_mats
+        self.subjects = list(subjects)
+
+    def brain(self, index):
+        """
+        Creates an instance of `Brain` for one of the subjects. Its adjMat is a view of the
+        cohort's array, so it is neither copied nor read into memory (if memory-mapped).
+
+        Parameters
+        ----------
+        index: int
+            The position of the subject in the cohort
+
+        Returns
+        -------
+        brain: maybrain.brain.Brain
+            A brain with no edges, whose `subject` attribute is defined
+        """
+        brn = mbt.Brain(directed=self.directed)
+        brn.subject = self.subjects[index]
+        brn.import_adj_array(self.adj_mats[index])
+        return brn
+
+    def threshold_masks(self, threshold_type=None, value=0., use_absolute=False, as_csr=False):
+        """
+        It thresholds the adjacency matrices of all the subjects at once, selecting the same edges that
+        `Brain.apply_threshold()` would select in each of them (including how ties are broken).
+        The subjects are processed in batches, where the strongest edges of each subject are found with
+        a single np.partition along the edge axis.
+
+        Parameters
+        ----------
+        threshold_type: {'edgePC', 'totalEdges', 'tVal', None}
+            The type of threshold applied, as in `Brain.apply_threshold()`. With "edgePC", the number of
+            edges of each subject is a percentage of its own non-NaN elements
+        value: float
+            Value according to threshold_type
+        use_absolute: bool
+            Thresholding by absolute value, as in `Brain.apply_threshold()`
+        as_csr: bool
+            Whether the masks are returned as sparse matrices
+
+        Returns
+        -------
+        masks: np.array or list
+            A boolean array with shape (subjects, N, N) which is True in the elements of the edges of
+            each subject (in both directions if the cohort is not directed), or a list with a boolean
+            scipy.sparse.csr_matrix for each subject if `as_csr`
+
+        Raises
+        ------
+        TypeError: Exception
+            If a not valid threshold type is passed
+        """
+        if threshold_type not in ["edgePC", "totalEdges", "tVal", None]:
+            raise TypeError("Not a valid threshold_type for threshold_masks()")
+        if threshold_type == "edgePC" and (value < 0 or value > 100):
+            raise TypeError("Invalid value for edgePC in threshold_masks()")
+
+        # The possible edges, in the order Brain.apply_threshold() sees them
+        n_nodes = self.adj_mats.shape[1]
+        rows, cols = np.triu_indices(n_nodes, 1)
+        if self.directed:
+            lower = np.tril_indices(n_nodes, -1)
+            rows, cols = np.concatenate((rows, lower[0])), np.concatenate((cols, lower[1]))
+
+        masks = [] if as_csr else np.zeros((len(self), n_nodes, n_nodes), dtype=bool)
+        step = max(1, _BLOCK_ELEMENTS // max(1, len(rows)))
+        for start in range(0, len(self), step):
+            selected = _selected_edges(np.asarray(self.adj_mats[start:start + step][:, rows, cols]),
+                                       threshold_type, value, use_absolute)
+            if as_csr:
+                masks.extend(brain_utils.coo_to_csr(rows[sel], cols[sel], np.ones(np.count_nonzero(sel), dtype=bool),
+                                                    n_nodes, symmetric=not self.directed)
+                             for sel in selected)
+                continue
+            masks[start:start + step, rows, cols] = selected
+            if not self.directed:
+                masks[start:start + step, cols, rows] = selected
+        return masks
+
+    def mean_adj_mat(self):
+        """
+        It calculates the average adjacency matrix of the cohort, ignoring NaNs. Elements which are
+        NaN in every subject are NaN in the result. The array is read in blocks of rows.
+
+        Returns
+        -------
+        avg_matrix: np.array
+            The (N, N) averaged matrix
+        """
+        n_nodes = self.adj_mats.shape[1]
+        avg_matrix = np.empty((n_nodes, n_nodes))
+        step = max(1, _BLOCK_ELEMENTS // max(1, len(self) * n_nodes))
+        for start in range(0, n_nodes, step):
+            block = np.asarray(self.adj_mats[:, start:start + step])
+            elements = np.sum(~np.isnan(block), axis=0)
+            with np.errstate(invalid='ignore'):
+                avg_matrix[start:start + step] = np.nansum(block, axis=0) / elements
+        return avg_matrix
+
+
+def _selected_edges(values, threshold_type, value, use_absolute):
+    """
+    Boolean array with the edges selected by a threshold in each row of `values` (subjects, edges),
+    where the edges are in the order that Brain.apply_threshold() sees them
+    """
+    defined = ~np.isnan(values)
+    if threshold_type is None:
+        return defined
+    if threshold_type == 'tVal' and use_absolute:
+        return (values >= abs(value)) | (values <= -abs(value))
+    if threshold_type == 'tVal':
+        return values >= value
+
+    # Number of edges of each subject
+    counts = np.count_nonzero(defined, axis=1)
+    if threshold_type == 'edgePC':
+        edgenums = ((value / 100.) * counts).astype(int)
+    else:  # totalEdges
+        edgenums = np.full(len(values), int(value))
+    edgenums = np.clip(edgenums, 0, counts)
+
+    keys = np.where(defined, np.absolute(values) if use_absolute else values, -np.inf)
+    n_edges = keys.shape[1]
+    kth_positions = np.minimum(n_edges - edgenums, n_edges - 1)
+    kth = np.partition(keys, np.unique(kth_positions), axis=1)[np.arange(len(keys)), kth_positions]
+
+    # The edges above the k-th biggest key, and the latest of the ties with it, as in Brain._top_k()
+    above = keys > kth[:, np.newaxis]
+    ties = (keys == kth[:, np.newaxis]) & defined
+    needed = edgenums - np.count_nonzero(above, axis=1)
+    extra = np.count_nonzero(ties, axis=1) > needed
+    if extra.any():
+        ties_after = np.cumsum(ties[extra, ::-1], axis=1)[:, ::-1]
+        ties[extra] &= ties_after <= needed[extra, np.newaxis]
+    selected = above | ties
+    selected[edgenums == 0] = False
+    return selected
+
+
+def _read_adj_matrix(args):
+    """ Reads one adjacency matrix in a worker process. `args` is (fname, delimiter, na_vals, cache) """
+    fname, delimiter, na_vals, cache = args
+    return readers.read_adj_matrix(fname, delimiter=delimiter, na_vals=na_vals, cache=cache)
+
+
+def _stack_matrices(matrices, fnames, mmap_file):
+    """
+    Copies each matrix, as soon as it is available, into a new (subjects, N, N) array, which is
+    memory-mapped if `mmap_file` is defined
+    """
+    adj_mats = None
+    for i, adj_mat in enumerate(matrices):
+        if adj_mat.shape[0] != adj_mat.shape[1]:
+            raise ValueError('Adjacency matrix of "' + fnames[i] + '" is not square')
+        if adj_mats is None:
+            shape = (len(fnames),) + adj_mat.shape
+            if mmap_file is None:
+                adj_mats = np.empty(shape)
+            else:
+                adj_mats = np.lib.format.open_memmap(mmap_file, mode='w+', dtype=np.float64, shape=shape)
+        elif adj_mat.shape != adj_mats.shape[1:]:
+            raise ValueError('Adjacency matrix of "' + fnames[i] + '" has a different size')
+        adj_mats[i] = adj_mat
+
+    if adj_mats is None:
+        return np.empty((0, 0, 0))
+    if mmap_file is not None:
+        adj_mats.flush()
+    return adj_mats
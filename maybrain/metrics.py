@@ -0,0 +1,799 @@
+# -*- coding: utf-8 -*-
+"""
+Module with measures of the nodes computed straight from adjacency matrices with numpy, instead of
+going through the nodes and edges of a networkx graph.
+
+Each function accepts:
+    - a `Brain` or a networkx graph, whose nodes are in the order of G.nodes()
+    - a scipy.sparse matrix, where the stored elements (except NaN) are edges
+    - a 2D np.array with shape (N, N), where the elements different from 0 and NaN are edges
+    - a 3D np.array with shape (S, N, N), with a matrix for each of S graphs (e.g. random graphs)
+The results are arrays aligned with the nodes, with an extra first dimension for a stack of matrices.
+The graphs are treated as undirected, and the results match the ones from networkx.
+
+The measures based on shortest paths (efficiency, path length and betweenness) use
+`scipy.sparse.csgraph` on sparse matrices, by chunks of source nodes which can be split over a pool
+of processes (one for all the matrices of a stack). Small graphs are calculated in the same process.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import networkx as nx
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+
+from maybrain import brain as mbt
+from maybrain import constants as ct
+from maybrain.utils import brain_utils
+
+# Number of source nodes whose shortest paths are calculated at once
+_CHUNK_SOURCES = 256
+# Maximum number of (source, matrix element) pairs checked at once for being on shortest paths
+_BLOCK_ELEMENTS = 2 ** 22
+
+# Sparse matrix used by the functions run for each chunk, set in each worker process, and the blocks
+# of shared memory with its arrays (and their layout)
+_WORKER_GRAPH = None
+_WORKER_BLOCKS = []
+_WORKER_LAYOUT = None
+
+
+def degree(adj):
+    """
+    It calculates the degree of each node, like `networkx.degree()` (a self-loop counts twice)
+
+    Parameters
+    ----------
+    adj: maybrain.brain.Brain, networkx.Graph, scipy.sparse matrix or np.array
+        The graph, or the adjacency matrix (or a stack of them)
+
+    Returns
+    -------
+    degrees: np.array
+        The degree of each node (of each matrix)
+    """
+    edges, _ = _matrices(adj, None)
+    return np.count_nonzero(edges, axis=-1) + np.diagonal(edges, axis1=-2, axis2=-1)
+
+
+def strength(adj, weight=ct.WEIGHT):
+    """
+    It calculates the sum of the weights of the edges of each node, like
+    `networkx.degree(G, weight=weight)` (a self-loop counts twice)
+
+    Parameters
+    ----------
+    adj: maybrain.brain.Brain, networkx.Graph, scipy.sparse matrix or np.array
+        The graph, or the adjacency matrix (or a stack of them)
+    weight: str
+        The property of the edges of a `Brain` or graph with their weight. Edges without it weigh 1
+
+    Returns
+    -------
+    strengths: np.array
+        The strength of each node (of each matrix)
+    """
+    _, weights = _matrices(adj, weight)
+    return weights.sum(axis=-1) + np.diagonal(weights, axis1=-2, axis2=-1)
+
+
+def triangles(adj):
+    """
+    It calculates the number of triangles which include each node, like `networkx.triangles()`.
+    They are counted with the diagonal of the cube of the adjacency matrix.
+
+    Parameters
+    ----------
+    adj: maybrain.brain.Brain, networkx.Graph, scipy.sparse matrix or np.array
+        The graph, or the adjacency matrix (or a stack of them)
+
+    Returns
+    -------
+    triangles: np.array
+        The number of triangles of each node (of each matrix)
+    """
+    edges, _ = _matrices(adj, None)
+    binary = _without_loops(edges.astype(float))
+    return np.rint(_closed_walks(binary) / 2).astype(int)
+
+
+def clustering(adj, weight=None):
+    """
+    It calculates the clustering coefficient of each node, like `networkx.clustering()`.
+    The (weighted) triangles are counted with matrix products over all the nodes at once.
+
+    In the weighted version, each triangle counts with the geometric mean of its edges' weights,
+    normalised by the biggest weight in the graph (Onnela et al., 2005).
+
+    Parameters
+    ----------
+    adj: maybrain.brain.Brain, networkx.Graph, scipy.sparse matrix or np.array
+        The graph, or the adjacency matrix (or a stack of them)
+    weight: str
+        If None, the binary clustering is calculated. Otherwise the weighted one, with the property
+        `weight` of the edges of a `Brain` or graph (edges without it weigh 1), or with the values of
+        a matrix
+
+    Returns
+    -------
+    coefficients: np.array
+        The clustering coefficient of each node (of each matrix)
+    """
+    edges, weights = _matrices(adj, weight)
+    binary = _without_loops(edges.astype(float))
+    degrees = binary.sum(axis=-1)
+
+    if weight is None:
+        closed = _closed_walks(binary)
+    else:
+        # The weights are normalised by the biggest one of each matrix
+        max_weights = np.where(edges, weights, -np.inf).max(axis=(-2, -1), initial=-np.inf)
+        max_weights = np.where(np.isfinite(max_weights), max_weights, 1.)
+        closed = _closed_walks(np.cbrt(_without_loops(weights) / max_weights[..., np.newaxis, np.newaxis]))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coefficients = closed / (degrees * (degrees - 1))
+    return np.where(closed == 0, 0., coefficients)
+
+
+def shortest_paths(adj, weight=None, n_jobs=None, sources=None, out=None):
+    """
+    It calculates the length of the shortest path between each pair of nodes, like
+    `networkx.shortest_path_length()`, with `scipy.sparse.csgraph`
+
+    Parameters
+    ----------
+    adj: maybrain.brain.Brain, networkx.Graph, scipy.sparse matrix or np.array
+        The graph, or the adjacency matrix (or a stack of them)
+    weight: str
+        If None, each edge has length 1. Otherwise, the property of the edges of a `Brain` or graph with
+        their length (e.g. `ct.DISTANCE`, see `Brain.weight_to_distance()`), or the values of a matrix
+    n_jobs: int
+        Number of processes among which the source nodes are split. If None, the number of CPUs is used
+    sources: list
+        If defined, only the rows of these nodes (positions in the matrix) are calculated. It can't be
+        used with a stack of matrices
+    out: np.array
+        If defined, the rows are written in this array (e.g. a np.memmap), by chunks of source nodes as
+        they are calculated, and it is returned. It can't be used with a stack of matrices
+
+    Returns
+    -------
+    lengths: np.array
+        Matrix (or stack of matrices) with the length of each shortest path, and np.inf between
+        disconnected nodes
+
+    Raises
+    ------
+    TypeError: Exception
+        If `sources` or `out` are used with a stack of matrices, or `adj` is directed or has an invalid shape
+    """
+    graphs, stacked = _sparse_matrices(adj, weight)
+    if stacked and (sources is not None or out is not None):
+        raise TypeError("shortest_paths() can't use sources or out with a stack of matrices")
+
+    results = []
+    with _ChunkPool(n_jobs) as pool:
+        for graph in graphs:
+            nodes = np.arange(graph.shape[0]) if sources is None else np.asarray(sources, dtype=int)
+            lengths = np.empty((len(nodes), graph.shape[0])) if out is None else out
+            start = 0
+            for chunk, block in pool.iter_chunks(_path_lengths, graph, nodes):
+                lengths[start:start + len(chunk)] = block
+                start += len(chunk)
+            results.append(lengths)
+    return np.array(results) if stacked else results[0]
+
+
+def edge_lengths(adj, weight=None):
+    """
+    It returns the lengths of the edges used by the measures based on shortest paths, in a symmetric
+    sparse matrix (the shortest length of each edge, if its directions are different) without
+    self-loops. It can be passed again to these measures with `weight=True`
+
+    Parameters
+    ----------
+    adj: maybrain.brain.Brain, networkx.Graph, scipy.sparse matrix or np.array
+        The graph, or the adjacency matrix (or a stack of them)
+    weight: str
+        The length of the edges. See `shortest_paths()`
+
+    Returns
+    -------
+    lengths: scipy.sparse.csr_matrix
+        The length of each edge (a list of them for a stack of matrices)
+    """
+    graphs, stacked = _sparse_matrices(adj, weight)
+    return graphs if stacked else graphs[0]
+
+
+def path_length(adj, weight=None, n_jobs=None):
+    """
+    It calculates the characteristic path length, i.e., the average length of the shortest paths
+    between all the pairs of connected nodes. In a connected graph, this is equal to
+    `networkx.average_shortest_path_length()`
+
+    Parameters
+    ----------
+    adj: maybrain.brain.Brain, networkx.Graph, scipy.sparse matrix or np.array
+        The graph, or the adjacency matrix (or a stack of them)
+    weight: str
+        The length of the edges. See `shortest_paths()`
+    n_jobs: int
+        Number of processes among which the source nodes are split. If None, the number of CPUs is used
+
+    Returns
+    -------
+    length: float or np.array
+        The characteristic path length (of each matrix), np.nan if no nodes are connected
+    """
+    def _length(graph):
+        sums = np.vstack(_map_chunks(_path_sums, graph, pool) or [np.zeros((0, 3))])
+        with np.errstate(invalid='ignore'):
+            return sums[:, 1].sum() / sums[:, 2].sum()
+    with _ChunkPool(n_jobs) as pool:
+        return _per_matrix(adj, weight, _length)
+
+
+def global_efficiency(adj, weight=None, n_jobs=None):
+    """
+    It calculates the global efficiency, i.e., the average inverse length of the shortest paths
+    between all the pairs of nodes, like `networkx.global_efficiency()`
+
+    Parameters
+    ----------
+    adj: maybrain.brain.Brain, networkx.Graph, scipy.sparse matrix or np.array
+        The graph, or the adjacency matrix (or a stack of them)
+    weight: str
+        The length of the edges. See `shortest_paths()`
+    n_jobs: int
+        Number of processes among which the source nodes are split. If None, the number of CPUs is used
+
+    Returns
+    -------
+    efficiency: float or np.array
+        The global efficiency (of each matrix)
+    """
+    with _ChunkPool(n_jobs) as pool:
+        return _per_matrix(adj, weight, lambda graph: _nodal_efficiencies(graph, pool).mean()
+                           if graph.shape[0] > 1 else 0.)
+
+
+def nodal_efficiency(adj, weight=None, n_jobs=None):
+    """
+    It calculates the efficiency of each node, i.e., the average inverse length of its shortest paths
+    to all the other nodes
+
+    Parameters
+    ----------
+    adj: maybrain.brain.Brain, networkx.Graph, scipy.sparse matrix or np.array
+        The graph, or the adjacency matrix (or a stack of them)
+    weight: str
+        The length of the edges. See `shortest_paths()`
+    n_jobs: int
+        Number of processes among which the source nodes are split. If None, the number of CPUs is used
+
+    Returns
+    -------
+    efficiencies: np.array
+        The efficiency of each node (of each matrix)
+    """
+    with _ChunkPool(n_jobs) as pool:
+        return _per_matrix(adj, weight, lambda graph: _nodal_efficiencies(graph, pool))
+
+
+def local_efficiency(adj, weight=None, n_jobs=None):
+    """
+    It calculates the local efficiency of each node, i.e., the global efficiency of the subgraph
+    induced by its neighbours. Its average is `networkx.local_efficiency()`
+
+    Parameters
+    ----------
+    adj: maybrain.brain.Brain, networkx.Graph, scipy.sparse matrix or np.array
+        The graph, or the adjacency matrix (or a stack of them)
+    weight: str
+        The length of the edges. See `shortest_paths()`
+    n_jobs: int
+        Number of processes among which the nodes are split. If None, the number of CPUs is used
+
+    Returns
+    -------
+    efficiencies: np.array
+        The local efficiency of each node (of each matrix)
+    """
+    with _ChunkPool(n_jobs) as pool:
+        return _per_matrix(adj, weight,
+                           lambda graph: np.concatenate(_map_chunks(_local_efficiencies, graph, pool) or [[]]))
+
+
+def betweenness(adj, weight=None, normalised=True, n_samples=None, seed=None, confidence=0.95, n_jobs=None):
+    """
+    It calculates the betweenness centrality of each node with Brandes' algorithm, like
+    `networkx.betweenness_centrality()`. The source nodes are split over a pool of processes.
+
+    For big graphs, the betweenness can be estimated from the shortest paths of `n_samples` random
+    source nodes (Brandes & Pich, 2007). In that case, the error of each estimate is also returned,
+    which is a bound (from Hoeffding-Serfling inequality) holding with probability `confidence`.
+
+    Parameters
+    ----------
+    adj: maybrain.brain.Brain, networkx.Graph, scipy.sparse matrix or np.array
+        The graph, or the adjacency matrix (or a stack of them)
+    weight: str
+        The length of the edges, which can't be negative. See `shortest_paths()`. An edge of length 0
+        between two nodes which are also connected through other nodes at the same distance from a
+        source (a cycle) is only followed away from the source, so some of the shortest paths through
+        it are not counted (networkx miscounts the paths through any edge of length 0)
+    normalised: bool
+        Whether the values are divided by the number of pairs of nodes, (N-1)(N-2)/2
+    n_samples: int
+        If defined, the number of source nodes sampled to estimate the betweenness
+    seed: int
+        Seed of the random sampling of source nodes
+    confidence: float
+        The probability of the error bound of an estimate, when `n_samples` is defined
+    n_jobs: int
+        Number of processes among which the source nodes are split. If None, the number of CPUs is used
+
+    Returns
+    -------
+    centralities: np.array
+        The betweenness of each node (of each matrix)
+    error: float or np.array
+        Only returned if `n_samples` is defined. The maximum difference between each estimate and the
+        exact betweenness, with probability `confidence` (of each matrix)
+    """
+    graphs, stacked = _sparse_matrices(adj, weight)
+    centralities, errors = [], []
+    with _ChunkPool(n_jobs) as pool:
+        for graph in graphs:
+            n_nodes = graph.shape[0]
+            if normalised:
+                scale = 1. / ((n_nodes - 1) * (n_nodes - 2)) if n_nodes > 2 else 1.
+            else:
+                scale = 0.5
+            sums, _, n_sources = _brandes(graph, n_samples, seed, pool)
+            centralities.append(sums * (scale * n_nodes / max(n_sources, 1)))
+            errors.append(_sampling_error(n_nodes * scale * max(n_nodes - 2, 0), n_sources, n_nodes, confidence))
+
+    if stacked:
+        centralities, errors = np.array(centralities).reshape(len(graphs), -1), np.array(errors)
+    else:
+        centralities, errors = centralities[0], errors[0]
+    return centralities if n_samples is None else (centralities, errors)
+
+
+def edge_betweenness(adj, weight=None, normalised=True, n_samples=None, seed=None, confidence=0.95,
+                     n_jobs=None):
+    """
+    It calculates the betweenness centrality of each edge with Brandes' algorithm, like
+    `networkx.edge_betweenness_centrality()`. See `betweenness()` for the sampling of source nodes.
+
+    Parameters
+    ----------
+    adj: maybrain.brain.Brain, networkx.Graph, scipy.sparse matrix or np.array
+        The graph, or the adjacency matrix (or a stack of them)
+    weight: str
+        The length of the edges, which can't be negative. See `betweenness()` for edges of length 0
+    normalised: bool
+        Whether the values are divided by the number of ordered pairs of nodes, N(N-1)
+    n_samples: int
+        If defined, the number of source nodes sampled to estimate the betweenness
+    seed: int
+        Seed of the random sampling of source nodes
+    confidence: float
+        The probability of the error bound of an estimate, when `n_samples` is defined
+    n_jobs: int
+        Number of processes among which the source nodes are split. If None, the number of CPUs is used
+
+    Returns
+    -------
+    centralities: scipy.sparse.csr_matrix
+        Symmetric matrix with the betweenness of each edge (a list of them for a stack of matrices)
+    error: float
+        Only returned if `n_samples` is defined. The maximum difference between each estimate and the
+        exact betweenness, with probability `confidence` (a list of them for a stack of matrices)
+    """
+    graphs, stacked = _sparse_matrices(adj, weight)
+    centralities, errors = [], []
+    with _ChunkPool(n_jobs) as pool:
+        for graph in graphs:
+            n_nodes = graph.shape[0]
+            if normalised:
+                scale = 1. / (n_nodes * (n_nodes - 1)) if n_nodes > 1 else 1.
+            else:
+                scale = 0.5
+            _, sums, n_sources = _brandes(graph, n_samples, seed, pool)
+            # Both directions of each edge are summed (their elements are in the same order in the transpose)
+            transpose = sparse.csr_matrix((sums, graph.indices, graph.indptr), shape=graph.shape).T.tocsr()
+            centralities.append(sparse.csr_matrix(((sums + transpose.data) * (scale * n_nodes / max(n_sources, 1)),
+                                                   graph.indices, graph.indptr), shape=graph.shape))
+            errors.append(_sampling_error(n_nodes * scale * max(n_nodes - 1, 0), n_sources, n_nodes, confidence))
+
+    if not stacked:
+        centralities, errors = centralities[0], errors[0]
+    return centralities if n_samples is None else (centralities, errors)
+
+
+def _matrices(adj, weight):
+    """
+    It returns the dense matrices (edges, weights) of `adj`, where `edges` is a boolean array with
+    the existing edges and `weights` has their weights (0 where there is no edge)
+
+    Raises
+    ------
+    TypeError: Exception
+        If `adj` is a directed graph or an array with an invalid shape
+    """
+    if isinstance(adj, (mbt.Brain, nx.Graph)) or sparse.issparse(adj):
+        coo = _coo_matrix(adj, weight)
+        defined = ~np.isnan(coo.data)
+        edges = np.zeros(coo.shape, dtype=bool)
+        edges[coo.row[defined], coo.col[defined]] = True
+        weights = np.zeros(coo.shape)
+        weights[coo.row[defined], coo.col[defined]] = coo.data[defined]
+        return edges, weights
+
+    adj = _dense_array(adj)
+    edges = (adj != 0) & ~np.isnan(adj)
+    return edges, np.where(edges, adj, 0.)
+
+
+def _sparse_matrices(adj, weight):
+    """
+    It returns a list with a symmetric CSR matrix of `adj` (or of each matrix of a stack) with the
+    lengths of the edges (1 if `weight` is None), without self-loops, and whether `adj` is a stack
+
+    Raises
+    ------
+    TypeError: Exception
+        If `adj` is a directed graph or an array with an invalid shape
+    """
+    if isinstance(adj, (mbt.Brain, nx.Graph)) or sparse.issparse(adj):
+        coo = _coo_matrix(adj, weight)
+        stacked = False
+        elements = [(coo.row, coo.col, coo.data, coo.shape)]
+    else:
+        adj = _dense_array(adj)
+        stacked = adj.ndim == 3
+        elements = []
+        for matrix in adj if stacked else [adj]:
+            rows, cols = np.nonzero((matrix != 0) & ~np.isnan(matrix))
+            elements.append((rows, cols, matrix[rows, cols], matrix.shape))
+
+    graphs = []
+    for rows, cols, values, shape in elements:
+        kept = (rows != cols) & ~np.isnan(values)
+        lengths = np.ones(np.count_nonzero(kept)) if weight is None else values[kept]
+        # Each edge is set in both directions, with its shortest length if they are different
+        rows, cols = np.concatenate((rows[kept], cols[kept])), np.concatenate((cols[kept], rows[kept]))
+        lengths = np.concatenate((lengths, lengths))
+        order = np.lexsort((lengths, cols, rows))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (np.diff(rows[order]) != 0) | (np.diff(cols[order]) != 0)
+        order = order[first]
+        graphs.append(sparse.csr_matrix((lengths[order], (rows[order], cols[order])), shape=shape))
+    return graphs, stacked
+
+
+def _coo_matrix(adj, weight):
+    """
+    COO matrix with the values of the property `weight` (or ct.WEIGHT) of a `Brain`, graph or
+    sparse matrix
+
+    Raises
+    ------
+    TypeError: Exception
+        If `adj` is a directed graph
+    """
+    if isinstance(adj, mbt.Brain):
+        directed = adj.directed
+        matrix = adj.to_csr(weight=weight or ct.WEIGHT)
+    elif isinstance(adj, nx.Graph):
+        directed = adj.is_directed()
+        matrix = brain_utils.graph_to_csr(adj, weight=weight or ct.WEIGHT)
+    else:
+        directed = False
+        matrix = adj
+    if directed:
+        raise TypeError("maybrain.metrics is not available for directed graphs")
+    return sparse.coo_matrix(matrix)
+
+
+def _dense_array(adj):
+    """
+    `adj` as a float array with shape (N, N) or (S, N, N)
+
+    Raises
+    ------
+    TypeError: Exception
+        If `adj` has an invalid shape
+    """
+    adj = np.asarray(adj, dtype=float)
+    if adj.ndim not in [2, 3] or adj.shape[-1] != adj.shape[-2]:
+        raise TypeError("maybrain.metrics expects a matrix with shape (N, N) or a stack with shape (S, N, N)")
+    return adj
+
+
+def _without_loops(matrix):
+    """ Copy of a matrix (or stack of matrices) with zeros in the diagonal """
+    matrix = matrix.copy()
+    np.einsum('...ii->...i', matrix)[...] = 0
+    return matrix
+
+
+def _closed_walks(matrix):
+    """ Diagonal of the cube of a matrix (or of each matrix of a stack), i.e., its closed walks of length 3 """
+    return np.einsum('...ij,...ji->...i', matrix @ matrix, matrix)
+
+
+def _per_matrix(adj, weight, func):
+    """ Result of func() for the sparse matrix of `adj`, or an array with its result for each matrix of a stack """
+    graphs, stacked = _sparse_matrices(adj, weight)
+    if stacked:
+        return np.array([func(graph) for graph in graphs])
+    return func(graphs[0])
+
+
+def _nodal_efficiencies(graph, pool):
+    """ Average inverse length of the shortest paths from each node of the sparse matrix `graph` """
+    sums = np.vstack(_map_chunks(_path_sums, graph, pool) or [np.zeros((0, 3))])
+    return sums[:, 0] / max(graph.shape[0] - 1, 1)
+
+
+def _map_chunks(func, graph, pool, nodes=None):
+    """ List with the results of func() for each chunk of `nodes`. See `_ChunkPool.iter_chunks()` """
+    return [result for _, result in pool.iter_chunks(func, graph, nodes)]
+
+
+class _ChunkPool:
+    """
+    Context manager which runs a function for chunks of source nodes of sparse matrices, in this
+    process or over `n_jobs` processes. The pool of processes is only started when a matrix has more
+    than _CHUNK_SOURCES source nodes, and it is shared by all the matrices of one call
+    """
+
+    def __init__(self, n_jobs):
+        self.n_jobs = n_jobs
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def iter_chunks(self, func, graph, nodes=None):
+        """
+        Generator of each chunk of `nodes` (all the nodes if None) of the sparse matrix `graph` with the
+        result of func() for it, in order. The worker processes share `graph` through shared memory
+        instead of receiving a copy of it
+        """
+        nodes = np.arange(graph.shape[0]) if nodes is None else np.asarray(nodes)
+        if self.n_jobs == 1 or len(nodes) <= _CHUNK_SOURCES:
+            _init_worker(graph)
+            try:
+                for start in range(0, len(nodes), _CHUNK_SOURCES):
+                    chunk = nodes[start:start + _CHUNK_SOURCES]
+                    yield chunk, func(chunk)
+            finally:
+                _init_worker(None)
+            return
+
+        n_chunks = min(len(nodes), max(-(-len(nodes) // _CHUNK_SOURCES), self.n_jobs or os.cpu_count()))
+        chunks = np.array_split(nodes, n_chunks)
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.n_jobs)
+
+        arrays = [graph.data, graph.indices, graph.indptr]
+        blocks = [shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1)) for array in arrays]
+        try:
+            for block, array in zip(blocks, arrays):
+                np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            layout = tuple((block.name, array.shape, array.dtype.str) for block, array in zip(blocks, arrays))
+            tasks = [(func, layout, graph.shape, chunk) for chunk in chunks]
+            yield from zip(chunks, self._executor.map(_run_chunk, tasks))
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+
+def _init_worker(graph):
+    """ Sets the sparse matrix used by the functions run for each chunk in this process """
+    global _WORKER_GRAPH
+    _WORKER_GRAPH = graph
+
+
+def _run_chunk(task):
+    """
+    Result of func() for a chunk in a worker process, given as (func, layout, shape, chunk). The sparse
+    matrix is attached from the blocks of shared memory with its (data, indices, indptr), given in
+    `layout` as (name, shape, dtype), unless it is the one of the previous chunk
+    """
+    func, layout, shape, chunk = task
+    global _WORKER_LAYOUT
+    if layout != _WORKER_LAYOUT:
+        _init_worker(None)
+        for block in _WORKER_BLOCKS:
+            block.close()
+        # The blocks must stay open while the worker uses them
+        _WORKER_BLOCKS[:] = [shared_memory.SharedMemory(name=name) for name, _, _ in layout]
+        data, indices, indptr = [np.ndarray(array_shape, dtype=dtype, buffer=block.buf)
+                                 for block, (_, array_shape, dtype) in zip(_WORKER_BLOCKS, layout)]
+        _init_worker(sparse.csr_matrix((data, indices, indptr), shape=shape, copy=False))
+        _WORKER_LAYOUT = layout
+    return func(chunk)
+
+
+def _path_lengths(sources):
+    """ Rows of the shortest path lengths from `sources` """
+    return csgraph.dijkstra(_WORKER_GRAPH, indices=sources)
+
+
+def _path_sums(sources):
+    """
+    Array with shape (len(sources), 3) with, for each source, the sum of the inverse lengths of its
+    shortest paths, the sum of their (finite) lengths and the number of nodes reachable from it
+    """
+    lengths = _path_lengths(sources)
+    lengths[np.arange(len(sources)), sources] = np.inf
+    reachable = np.isfinite(lengths)
+    with np.errstate(divide='ignore'):
+        inverse = 1 / lengths
+    return np.column_stack((inverse.sum(axis=1), np.where(reachable, lengths, 0.).sum(axis=1),
+                            reachable.sum(axis=1)))
+
+
+def _local_efficiencies(nodes):
+    """ Global efficiency of the subgraph induced by the neighbours of each node """
+    graph = _WORKER_GRAPH
+    efficiencies = np.zeros(len(nodes))
+    for i, node in enumerate(nodes):
+        neighbours = graph.indices[graph.indptr[node]:graph.indptr[node + 1]]
+        if len(neighbours) < 2:
+            continue
+        lengths = csgraph.dijkstra(graph[neighbours][:, neighbours])
+        np.fill_diagonal(lengths, np.inf)
+        with np.errstate(divide='ignore'):
+            efficiencies[i] = (1 / lengths).sum() / (len(neighbours) * (len(neighbours) - 1))
+    return efficiencies
+
+
+def _brandes(graph, n_samples, seed, pool):
+    """
+    Sums of the dependencies of each node and of each element of the sparse matrix `graph` (in the
+    order of graph.data) on the shortest paths from all the nodes, or from `n_samples` random nodes,
+    and the number of source nodes
+    """
+    n_nodes = graph.shape[0]
+    sources = None
+    if n_samples is not None and n_samples < n_nodes:
+        sources = np.sort(np.random.default_rng(seed).choice(n_nodes, n_samples, replace=False))
+
+    node_sums = np.zeros(n_nodes)
+    edge_sums = np.zeros(graph.nnz)
+    for nodes, edges in _map_chunks(_dependencies, graph, pool, nodes=sources):
+        node_sums += nodes
+        edge_sums += edges
+    return node_sums, edge_sums, n_nodes if sources is None else len(sources)
+
+
+def _sampling_error(value_range, n_sources, n_nodes, confidence):
+    """
+    Bound of the error of the average of `n_sources` values (with range `value_range`) sampled without
+    replacement from `n_nodes` ones, with probability `confidence` (Hoeffding-Serfling inequality)
+    """
+    if n_sources >= n_nodes:
+        return 0.
+    return value_range * np.sqrt((1 - (n_sources - 1) / n_nodes) * np.log(2 / (1 - confidence)) / (2 * n_sources))
+
+
+def _dependencies(sources):
+    """
+    Brandes' algorithm from the `sources`, by batches of sources. The elements of the matrix on
+    shortest paths from each source (the edges of its shortest path DAG) are found at once. The number
+    of shortest paths to each node is counted in topological order of the DAG, level by level from the
+    sources, and the dependencies are accumulated in the reverse order, going through each edge of the
+    DAG once.
+    It returns the sums of the dependencies of each node and of each element of the matrix
+    """
+    graph = _WORKER_GRAPH
+    n_nodes = graph.shape[0]
+    tails = np.repeat(np.arange(n_nodes), np.diff(graph.indptr))
+    heads = graph.indices
+    node_sums = np.zeros(n_nodes)
+    edge_sums = np.zeros(graph.nnz)
+
+    batch_size = max(1, _BLOCK_ELEMENTS // max(graph.nnz, 1))
+    for start in range(0, len(sources), batch_size):
+        batch = sources[start:start + batch_size]
+        lengths = csgraph.dijkstra(graph, indices=batch)
+        through = lengths[:, tails]
+        through += graph.data
+        with np.errstate(invalid='ignore'):
+            rows, positions = np.nonzero(_on_shortest_path(through, lengths[:, heads]))
+        # Indices in the flattened (len(batch), n_nodes) arrays
+        origins = rows * n_nodes + tails[positions]
+        targets = rows * n_nodes + heads[positions]
+        roots = np.arange(len(batch)) * n_nodes + batch
+        flat_lengths = lengths.ravel()
+
+        # Edges between nodes at the same distance (e.g. of length 0) are only followed towards the
+        # node with more edges from the source, so that the DAG has no cycles
+        forward = flat_lengths[origins] < flat_lengths[targets]
+        if not forward.all():
+            hops = _hops(origins, targets, roots, len(flat_lengths))
+            forward |= hops[origins] < hops[targets]
+            origins, targets, positions = origins[forward], targets[forward], positions[forward]
+
+        # Number of shortest paths from each source to each node, and the edges out of each level
+        paths = np.zeros(len(flat_lengths))
+        paths[roots] = 1
+        levels = []
+        waiting = np.bincount(targets, minlength=len(flat_lengths))
+        out_edges = _EdgesByOrigin(origins, len(flat_lengths))
+        level = roots
+        while len(level):
+            edges = out_edges.of(level)
+            levels.append(edges)
+            paths += np.bincount(targets[edges], weights=paths[origins[edges]], minlength=len(paths))
+            reached = np.bincount(targets[edges], minlength=len(paths))
+            waiting -= reached
+            level = np.flatnonzero((reached > 0) & (waiting == 0))
+
+        # Dependencies of each source on each node, and the flows through each element
+        dependencies = np.zeros(len(flat_lengths))
+        flows = np.zeros(len(origins))
+        for edges in reversed(levels):
+            flows[edges] = paths[origins[edges]] / paths[targets[edges]] * (1 + dependencies[targets[edges]])
+            dependencies += np.bincount(origins[edges], weights=flows[edges], minlength=len(dependencies))
+
+        dependencies = dependencies.reshape(len(batch), n_nodes)
+        node_sums += dependencies.sum(axis=0)
+        node_sums[batch] -= dependencies[np.arange(len(batch)), batch]
+        edge_sums += np.bincount(positions, weights=flows, minlength=graph.nnz)
+    return node_sums, edge_sums
+
+
+def _hops(origins, targets, roots, size):
+    """
+    Minimum number of edges (origins -> targets) from the `roots` to each node, or -1 if it's not
+    reachable, with a breadth-first search from all of them at once
+    """
+    hops = np.full(size, -1)
+    hops[roots] = 0
+    out_edges = _EdgesByOrigin(origins, size)
+    level, distance = roots, 0
+    while len(level):
+        distance += 1
+        reached = np.zeros(size, dtype=bool)
+        reached[targets[out_edges.of(level)]] = True
+        level = np.flatnonzero(reached & (hops < 0))
+        hops[level] = distance
+    return hops
+
+
+class _EdgesByOrigin:
+    """ Positions of the edges going out of given nodes, from the array with the origin of each edge """
+
+    def __init__(self, origins, size):
+        self.order = np.argsort(origins, kind='stable')
+        self.counts = np.bincount(origins, minlength=size)
+        self.starts = np.cumsum(self.counts) - self.counts
+
+    def of(self, nodes):
+        """ Positions of the edges whose origin is in `nodes` """
+        counts = self.counts[nodes]
+        offsets = np.repeat(self.starts[nodes] - (np.cumsum(counts) - counts), counts)
+        return self.order[offsets + np.arange(counts.sum())]
+
+
+def _on_shortest_path(through, lengths):
+    """ Whether the lengths of the paths `through` an edge are equal to the shortest `lengths` """
+    # The shortest lengths are never bigger, so only the rounding errors are tolerated
+    return (through <= lengths * (1 + 1e-10)) & (through < np.inf)
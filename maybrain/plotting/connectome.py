@@ -5,8 +5,8 @@ import colorsys
 
 import matplotlib.pyplot as plt
 import numpy as np
-import networkx as nx
 from nilearn import plotting
+from scipy import sparse
 
 from maybrain import constants as ct
 
@@ -66,13 +66,9 @@ def plot_connectome(brain,
     KeyError: Exception
         If the edges don't have constants.XYZ property
     """
-    try:
-        if list(brain.G.nodes(data=True))[0][1][ct.XYZ]:
-            pass
-    except KeyError as error:
-        import sys
-        _, _, tbb = sys.exc_info()
-        raise KeyError(error, "Node doesn't have constants.XYZ property").with_traceback(tbb)
+    node_coords = brain.node_coords()
+    if np.isnan(node_coords).any():
+        raise KeyError(ct.XYZ, "Node doesn't have constants.XYZ property")
 
     # Some values to get better plots than nilearn's defaults
     if 'edge_cmap' not in kwargs:
@@ -80,9 +76,10 @@ def plot_connectome(brain,
     if 'node_color' not in kwargs:
         kwargs['node_color'] = 'red'
 
-    connection_matrix = np.copy(nx.to_numpy_matrix(brain.G, nonedge=0))
     if only_nodes:
-        connection_matrix[:] = 0
+        connection_matrix = sparse.csr_matrix((len(node_coords), len(node_coords)))
+    else:
+        connection_matrix = brain.to_csr()
 
     # If node_property is defined, let's create the custom colours
     if node_property:
@@ -121,6 +118,4 @@ def plot_connectome(brain,
         else:
             kwargs['node_size'] = node_size_min
 
-    return plotting.plot_connectome(connection_matrix,
-                                    list(dict(brain.G.nodes(data=ct.XYZ)).values()),
-                                    **kwargs)
+    return plotting.plot_connectome(connection_matrix, node_coords, **kwargs)
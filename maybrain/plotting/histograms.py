@@ -5,6 +5,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 import networkx as nx
 
+from maybrain.utils.brain_utils import graph_to_csr
+
 
 def show():
     """
@@ -36,17 +38,14 @@ def plot_weight_distribution(brain, output_file=None, **kwargs):
     fig, ax = plt.subplots()
 
     if isinstance(brain, nx.Graph):
-        arr = np.copy(nx.to_numpy_matrix(brain, nonedge=np.nan))
+        arr = graph_to_csr(brain).tocoo()
+        directed = brain.is_directed()
     else:
-        arr = np.copy(nx.to_numpy_matrix(brain.G, nonedge=np.nan))
-
-    upper_values = np.triu_indices(np.shape(arr)[0], k=1)
-    weights = np.array(arr[upper_values])
+        arr = brain.to_csr().tocoo()
+        directed = brain.directed
 
-    # If directed, also add the lower down part of the adjacency matrix
-    if not isinstance(brain, nx.Graph) and brain.directed:
-        below_values = np.tril_indices(np.shape(arr)[0], k=-1)
-        weights.extend(np.array(below_values))
+    # The upper triangle of the adjacency matrix, or everything outside the diagonal if directed
+    weights = arr.data[arr.row != arr.col if directed else arr.row < arr.col]
 
     # Removing NaNs for correct plotting
     weights = weights[~np.isnan(weights)]
@@ -8,6 +8,7 @@ import matplotlib.ticker as ticker
 import numpy as np
 
 from maybrain import brain as mbt
+from maybrain.cohort import BrainCohort
 from maybrain import resources as rr
 from maybrain import constants as ct
 
@@ -82,6 +83,35 @@ def _plot_array(arr, title, labels, output_file):
         return fig, ax
 
 
+def _avg_adj_mats(brains):
+    """ Averages the `adjMat`s of a dictionary of brains, ignoring NaNs """
+    # With empty dictionary, nothing to do
+    if not brains.values():
+        raise TypeError("brains is empty, nothing can be done")
+    # Check correct size of `brains`
+    size_brain = None
+    for brn in brains.values():
+        if not size_brain:
+            size_brain = brn.adjMat.shape[0]
+        elif brn.adjMat.shape != (size_brain, size_brain):
+            raise TypeError("The brains are not all with the same size")
+
+    # The sum of the connection strengths, ignoring NaNs
+    sum_matrix = np.zeros([size_brain, size_brain])
+    # For each edge, it says how many brains contain that edge.
+    # Used to calculate the mean (we have to divide by the total number)
+    elements = np.zeros([size_brain, size_brain], dtype=int)
+
+    for brn in brains.values():
+        not_nan = ~np.isnan(brn.adjMat)
+        sum_matrix[not_nan] += brn.adjMat[not_nan]
+        elements += not_nan
+
+    # Calculating the actual average (NaN when no brain has the edge)
+    with np.errstate(invalid='ignore'):
+        return sum_matrix / elements
+
+
 def plot_avg_matrix(brains, output_file=None, dummy_adj_file=rr.DUMMY_ADJ_FILE_500,
                     hemi_prop=rr.PROPERTIES_HEMISPHERES_500, hemi_name=ct.HEMISPHERE,
                     lobes_prop=rr.PROPERTIES_LOBES_500, lobes_name=ct.LOBE,
@@ -94,8 +124,9 @@ def plot_avg_matrix(brains, output_file=None, dummy_adj_file=rr.DUMMY_ADJ_FILE_5
 
     Parameters
     ----------
-    brains: dict
-        A dictionary where the values are instances of `Brain`s. The keys don't matter.
+    brains: dict or maybrain.cohort.BrainCohort
+        A dictionary where the values are instances of `Brain`s (the keys don't matter), or a
+        cohort of brains
     output_file: str
         If you want to create a file. It then calls fig.savefig(output_file) from matplotlib
     dummy_adj_file: str
@@ -119,44 +150,13 @@ def plot_avg_matrix(brains, output_file=None, dummy_adj_file=rr.DUMMY_ADJ_FILE_5
     fig, ax : tuple
         if output_file is None, this returns (fig, ax) from the figure created
     """
-    # With empty dictionary, nothing to do
-    if not brains.values():
-        raise TypeError("brains is empty, nothing can be done")
-    # Check correct size of `brains`
-    size_brain = None
-    for brn in brains.values():
-        if not size_brain:
-            size_brain = brn.adjMat.shape[0]
-        elif brn.adjMat.shape != (size_brain, size_brain):
-            raise TypeError("The brains are not all with the same size")
-
-    # The final matrix with the averaged connection strength
-    avg_matrix = np.empty([size_brain, size_brain])
-    # For each edge, it says how many brains contain that edge.
-    # Used to calculate the mean (we have to divide by the total number)
-    elements = np.zeros([size_brain, size_brain], dtype=int)
-
-    avg_matrix[:] = np.nan
-
-    for brn in brains.values():
-        for (x, y), value in np.ndenumerate(brn.adjMat):
-            if np.isnan(value):
-                continue
-
-            if np.isnan(avg_matrix[x][y]):
-                avg_matrix[x][y] = value
-            else:
-                avg_matrix[x][y] += value
-            elements[x][y] += 1
-
-    # Calculating the actual average
-    for x in range(size_brain):
-        for y in range(size_brain):
-            if np.isnan(avg_matrix[x][y]):
-                continue
-            if elements[x][y] == 0:
-                continue
-            avg_matrix[x][y] /= elements[x][y]
+    # A cohort already has all the matrices stacked
+    if isinstance(brains, BrainCohort):
+        if not len(brains):
+            raise TypeError("brains is empty, nothing can be done")
+        avg_matrix = brains.mean_adj_mat()
+    else:
+        avg_matrix = _avg_adj_mats(brains)
 
     arr, labels = _get_ordered_array_and_labels(avg_matrix, dummy_adj_file=dummy_adj_file,
                                                 hemi_prop=hemi_prop, lobes_prop=lobes_prop,
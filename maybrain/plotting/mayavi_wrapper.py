@@ -25,7 +25,7 @@ is available for others to use.
 """
 
 from mayavi import mlab
-from numpy import array, repeat, max, power
+from numpy import array, repeat, max, power, isnan
 from maybrain import constants as ct
 
 
@@ -71,23 +71,15 @@ class MayaviWrapper:
 
         # select some rows if necessary
         if not node_list:
-            node_list = brain.G.nodes()
+            node_list = list(brain.G.nodes())
 
-            # get coordinates
-            # make into array for easy output
-        #        coords = array([brain.G.nodes[x][ct.XYZ] for x in nodeList])
-
-        #        # get nodes from networkx object
-        #        else:
-        coords = []
-        for x in brain.G.nodes():
-            # put into list
-            try:
-                coords.append(brain.G.nodes[x][ct.XYZ])
-            except KeyError:
+        coords = brain.node_coords(node_list)
+        found = ~isnan(coords).any(axis=1)
+        for x, is_found in zip(node_list, found):
+            if not is_found:
                 print(('node ' + str(x) + ' not found in function coords_to_list'))
 
-        coords = array(coords)
+        coords = coords[found]
 
         # return x, y and z coordinates
         return coords[:, 0], coords[:, 1], coords[:, 2]
@@ -95,36 +87,16 @@ class MayaviWrapper:
     def edges_to_list(self, brain):
         """ Turn the edges of a brain into coordinates """
 
-        # initialise output
-        x1 = []
-        x2 = []
-
-        y1 = []
-        y2 = []
-
-        z1 = []
-        z2 = []
-
-        s = []
-
-        for e in brain.G.edges(data=True):
-            # get coord and vector from each edge
-            p1 = brain.G.nodes[e[0]][ct.XYZ]
-            p2 = brain.G.nodes[e[1]][ct.XYZ]
-
-            x1.append(p1[0])
-            x2.append(p2[0] - p1[0])
-
-            y1.append(p1[1])
-            y2.append(p2[1] - p1[1])
+        edges = list(brain.G.edges(data=True))
 
-            z1.append(p1[2])
-            z2.append(p2[2] - p1[2])
+        # get coord and vector from each edge
+        p1 = brain.node_coords([e[0] for e in edges])
+        p2 = brain.node_coords([e[1] for e in edges]) - p1
 
-            # set scalar value as edge weight
-            s.append(e[2][ct.WEIGHT])
+        # set scalar value as edge weight
+        s = [e[2][ct.WEIGHT] for e in edges]
 
-        return x1, y1, z1, x2, y2, z2, s
+        return p1[:, 0], p1[:, 1], p1[:, 2], p2[:, 0], p2[:, 1], p2[:, 2], s
 
     def plot_brain(self, brain, opacity=1.0, edge_opacity=None, label='plot', plot_highlights=True):
         """ plot all the coords, edges and highlights in a brain """
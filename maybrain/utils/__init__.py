@@ -6,4 +6,5 @@ Initialisation file for utils package
 from .brain_utils import *
 from .bct import *
 from .highlights import *
+from .readers import *
 from .writers import *
@@ -2,7 +2,8 @@
 Module with utility functions to integrate maybrain with bctpy
 """
 import numpy as np
-import networkx as nx
+
+from .brain_utils import csr_to_dense
 
 
 def makebctmat(brain, nonedge=np.nan):
@@ -27,7 +28,7 @@ def makebctmat(brain, nonedge=np.nan):
     array: np.array
         A connectivity array ready to be used by bctpy
     """
-    return np.copy(nx.to_numpy_matrix(brain.G, nonedge=nonedge))
+    return csr_to_dense(brain.to_csr(), nonedge)
 
 
 def assignbctresult(brain, bct_res):
@@ -4,6 +4,9 @@ Utility module with recipes to calculate some common measures
 """
 from os import path, rename
 import numpy as np
+from scipy import sparse
+
+from maybrain import constants as ct
 
 
 def threshold_to_percentage(brain, threshold):
@@ -15,6 +18,8 @@ def threshold_to_percentage(brain, threshold):
     possible edges are all the elements of adjMat except the diagonal and \
     np.nan
 
+    This is equivalent to `brain.threshold_to_percentage(threshold)`
+
     Parameters
     ----------
     brain: maybrain.brain.Brain
@@ -27,20 +32,7 @@ def threshold_to_percentage(brain, threshold):
     ratio: float
         The final result
     """
-    upper_values = np.triu_indices(np.shape(brain.adjMat)[0], k=1)
-    below_values = np.tril_indices(np.shape(brain.adjMat)[0], k=-1)
-    if not brain.directed:
-        # only flatten the upper right part of the matrix
-        weights = np.array(brain.adjMat[upper_values])
-    else:
-        weights = np.concatenate((brain.adjMat[upper_values], brain.adjMat[below_values]))
-    # remove NaNs
-    weights = weights[~np.isnan(weights)]
-
-    max_edges = len(weights)
-    len_edges = len(weights[weights > threshold])
-
-    return len_edges / max_edges
+    return brain.threshold_to_percentage(threshold)
 
 
 def percent_connected(brain):
@@ -65,6 +57,64 @@ def percent_connected(brain):
     return float(brain.G.number_of_edges()) / float(total_connections)
 
 
+def graph_to_csr(graph, nodelist=None, weight=ct.WEIGHT):
+    """
+    It creates a sparse (CSR) adjacency matrix from a networkx graph, in O(edges) memory.
+    Rows and columns follow the order of `nodelist`. Edges with a weight of zero are kept as
+    explicit elements of the matrix, so they can be distinguished from non-existing edges.
+
+    Parameters
+    ----------
+    graph: networkx.Graph
+        The graph (directed or not). In undirected graphs, each edge is set in both directions
+    nodelist: list
+        The nodes (and their order) in the matrix. If None, all the nodes of the graph
+    weight: str
+        The attribute of the edges with the values of the matrix. If None, or if an edge doesn't
+        have it, the value 1 is used
+
+    Returns
+    -------
+    matrix: scipy.sparse.csr_matrix
+        Matrix with shape (len(nodelist), len(nodelist))
+    """
+    nodes = list(graph.nodes()) if nodelist is None else list(nodelist)
+    index = {n: i for i, n in enumerate(nodes)}
+
+    edges = [(index[u], index[v], 1 if weight is None else data.get(weight, 1))
+             for u, v, data in graph.edges(data=True) if u in index and v in index]
+    rows = np.array([e[0] for e in edges], dtype=int)
+    cols = np.array([e[1] for e in edges], dtype=int)
+    values = np.array([e[2] for e in edges], dtype=float)
+
+    return coo_to_csr(rows, cols, values, len(nodes), symmetric=not graph.is_directed())
+
+
+def coo_to_csr(rows, cols, values, n_nodes, symmetric=False):
+    """
+    It creates a (n_nodes, n_nodes) CSR matrix from arrays with the row, column and value of
+    each element. If `symmetric`, the elements outside the diagonal are also set in the
+    transposed position.
+    """
+    if symmetric:
+        off_diagonal = rows != cols
+        rows, cols, values = (np.concatenate((rows, cols[off_diagonal])),
+                              np.concatenate((cols, rows[off_diagonal])),
+                              np.concatenate((values, values[off_diagonal])))
+    return sparse.csr_matrix((values, (rows, cols)), shape=(n_nodes, n_nodes))
+
+
+def csr_to_dense(matrix, nonedge=np.nan):
+    """
+    It converts a sparse matrix to a dense array, where the missing elements have the value
+    `nonedge`
+    """
+    coo = sparse.coo_matrix(matrix)
+    dense = np.full(coo.shape, nonedge, dtype=float)
+    dense[coo.row, coo.col] = coo.data
+    return dense
+
+
 def write_results(results, measure,
                   outfilebase="brain",
                   append=True,
@@ -0,0 +1,353 @@
+"""
+Utility functions for reading maybrain entities from files
+"""
+import bz2
+import gzip
+import hashlib
+import io
+import itertools
+import os
+import re
+from glob import escape, glob
+
+import numpy as np
+from scipy import io as spio
+from scipy import sparse
+
+__all__ = ['open_text', 'read_adj_matrix', 'read_edge_list', 'read_properties']
+
+# Number of text rows converted at once by the bulk parser
+_CHUNK_ROWS = 256
+# Number of lines of a properties file converted at once
+_CHUNK_LINES = 2 ** 16
+
+
+def open_text(fname, mode='r'):
+    """
+    Opens a text file which can be compressed with gzip or bzip2. When reading, the compression
+    is detected from the first bytes of the file, and the data is decompressed as it is read,
+    without temporary files. When writing, it is chosen from the extension (".gz" or ".bz2").
+
+    Parameters
+    ----------
+    fname: str
+        File name
+    mode: {'r', 'w', 'a'}
+        Whether the file is opened for reading, writing or appending
+
+    Returns
+    -------
+    file: file object
+        The opened file, in text mode
+    """
+    if mode == 'r':
+        with open(fname, 'rb') as file:
+            magic = file.read(3)
+        compressed = 'gz' if magic[:2] == b'\x1f\x8b' else 'bz2' if magic == b'BZh' else None
+    else:
+        compressed = 'gz' if fname.endswith('.gz') else 'bz2' if fname.endswith('.bz2') else None
+
+    if compressed == 'gz':
+        return gzip.open(fname, mode + 't')
+    if compressed == 'bz2':
+        return bz2.open(fname, mode + 't')
+    return open(fname, mode)
+
+
+def read_adj_matrix(fname, delimiter=None, na_vals=None, cache=False, mmap_file=None):
+    """
+    Reads an adjacency matrix from a text file, converting the values in bulk with numpy.
+    Files compressed with gzip or bzip2 are decompressed while they are parsed (see `open_text()`).
+
+    Parameters
+    ----------
+    fname: str
+        File name
+    delimiter: str
+        The delimiter of the values inside the matrix, like ","
+    na_vals: list of str
+        How the "Not a Number" values are represented in the file
+    cache: bool
+        If True, a binary sidecar file (`fname` + ".mbcache-<key>.npy") is written after parsing,
+        and reused in later calls while the path, size and modification time of `fname` do not
+        change
+    mmap_file: str
+        If defined, the matrix is written chunk by chunk to this .npy file and returned as a
+        memory-mapped array (mode "r+"), so it never needs to be fully held in memory. In this
+        case the matrix must be square
+
+    Returns
+    -------
+    matrix: np.array
+        A 2D array of floats (np.memmap if `mmap_file` is defined)
+
+    Raises
+    ------
+    ValueError: Exception
+        If the rows of the file have a different number of values, or a value is not a number
+    """
+    if na_vals is None:
+        na_vals = ["NA"]
+
+    cache_file = _cache_filename(fname, delimiter, na_vals) if cache else None
+    if cache_file is not None and os.path.exists(cache_file):
+        if mmap_file is None:
+            return np.load(cache_file)
+        return _write_memmap(mmap_file, _blocks_of(np.load(cache_file, mmap_mode='r')))
+
+    with open_text(fname) as file:
+        if mmap_file is None:
+            matrix = _join_chunks(_parse_chunks(file, delimiter, na_vals), 0, square=True)
+        else:
+            matrix = _write_memmap(mmap_file, _parse_chunks(file, delimiter, na_vals))
+
+    if cache_file is not None:
+        _write_cache(cache_file, fname, matrix)
+
+    return matrix
+
+
+def read_edge_list(fname, delimiter=None, na_vals=None):
+    """
+    Reads a sparse matrix from a file with one value per line, without creating the dense matrix.
+    The file can be compressed with gzip or bzip2 (see `open_text()`).
+    Two formats are recognised:
+        - MatrixMarket (.mtx) files, identified by their "%%MatrixMarket" header (1-based indices)
+        - Lists of edges (COO format), where each line has the 0-based row and column of a value,
+          followed by the value itself (1 if missing), e.g. "3 10 0.25"
+
+    Parameters
+    ----------
+    fname: str
+        File name
+    delimiter: str
+        The delimiter of the values in each line of an edge list, like ","
+    na_vals: list of str
+        How the "Not a Number" values are represented in an edge list
+
+    Returns
+    -------
+    rows, cols, values: tuple of np.array
+        The row, column and value of each element of the matrix, in the order they appear in the file
+    n_nodes: int
+        The size of the matrix, which is the biggest row/column index plus one for edge lists
+
+    Raises
+    ------
+    ValueError: Exception
+        If the lines have a different number of values, or they are not numbers
+    """
+    if na_vals is None:
+        na_vals = ["NA"]
+
+    with open_text(fname) as file:
+        if file.readline().startswith('%%MatrixMarket'):
+            file.seek(0)
+            matrix = spio.mmread(file)
+            matrix = sparse.coo_matrix(matrix)
+            return matrix.row.astype(int), matrix.col.astype(int), matrix.data.astype(float), \
+                max(matrix.shape)
+
+        file.seek(0)
+        values = _join_chunks(_parse_chunks(file, delimiter, na_vals), 3)
+
+    if values.shape[1] not in [2, 3]:
+        raise ValueError("Each line of an edge list must have 2 or 3 values")
+    rows = values[:, 0].astype(int)
+    cols = values[:, 1].astype(int)
+    if np.any(rows != values[:, 0]) or np.any(cols != values[:, 1]) or \
+            (len(rows) and min(rows.min(), cols.min()) < 0):
+        raise ValueError("The nodes of an edge list must be non-negative integers")
+    weights = values[:, 2] if values.shape[1] == 3 else np.ones(len(values))
+
+    return rows, cols, weights, int(max(rows.max(), cols.max()) + 1) if len(rows) else 0
+
+
+def read_properties(fname, dtype=str):
+    """
+    Reads a properties file (see `Brain.import_properties()`) into typed columns. The rows are
+    split and converted in bulk with numpy by chunks of lines, instead of one by one.
+    The file can be compressed with gzip or bzip2 (see `open_text()`).
+
+    Parameters
+    ----------
+    fname: str
+        File name
+    dtype: type
+        The type to which the values of the property are converted, like `float`
+
+    Returns
+    -------
+    prop_name: str
+        The name of the property, in the first line of the file
+    nodes: tuple
+        (ids, values), where `ids` is an int array with the nodes' identification and `values`
+        the array with their value of the property
+    edges: tuple
+        (ids, values), where `ids` is an int array with shape (M, 2) with the edges'
+        identification and `values` the array with their value of the property
+
+    Raises
+    ------
+    ValueError: Exception
+        If the file has some invalid structure, or a value can't be converted to `dtype`
+    """
+    chunks = []
+    with open_text(fname) as file:
+        prop_name = file.readline().strip()
+        line_number = 2
+        while True:
+            lines = [line.strip() for line in itertools.islice(file, _CHUNK_LINES)]
+            chunks.append(_parse_properties(lines, dtype, fname, line_number))
+            if not lines:
+                break
+            line_number += len(lines)
+
+    nodes = tuple(np.concatenate(column) for column in zip(*(node_columns for node_columns, _ in chunks)))
+    edges = tuple(np.concatenate(column) for column in zip(*(edge_columns for _, edge_columns in chunks)))
+    return prop_name, nodes, edges
+
+
+def _parse_properties(lines, dtype, fname, line_number):
+    """
+    Typed columns (node ids, values) and (edge ids, values) of some `lines` of a properties file, the
+    first of them being at `line_number`
+
+    Raises
+    ------
+    ValueError: Exception
+        If a line has an invalid structure, or a value can't be converted to `dtype`
+    """
+    # Each row has 2 (node) or 3 (edge) values separated by spaces
+    sizes = np.fromiter(map(str.count, lines, itertools.repeat(' ')), dtype=int, count=len(lines)) + 1
+    invalid = np.flatnonzero((sizes != 2) & (sizes != 3))
+    if invalid.size:
+        raise ValueError('Problem in parsing %s, it has an invalid structure at line %d'
+                         % (fname, invalid[0] + line_number))
+
+    tokens = np.array(' '.join(lines).split(' ')) if lines else np.empty(0, dtype=str)
+    starts = np.cumsum(sizes) - sizes
+    node_rows = starts[sizes == 2]
+    edge_rows = starts[sizes == 3]
+
+    nodes = (tokens[node_rows].astype(int), tokens[node_rows + 1].astype(dtype))
+    edges = (np.column_stack((tokens[edge_rows].astype(int), tokens[edge_rows + 1].astype(int))),
+             tokens[edge_rows + 2].astype(dtype))
+    return nodes, edges
+
+
+def _join_chunks(chunks, width, square=False):
+    """
+    Joins the row chunks of a 2D array (with `width` columns if there are none) in one array, which
+    grows as they are read, so that the chunks don't need to be kept until the end. If `square`, the
+    rows of a square matrix are allocated from the first chunk
+    """
+    out = None
+    n_rows = 0
+    for chunk in chunks:
+        if out is None:
+            out = np.empty((chunk.shape[1] if square else len(chunk), chunk.shape[1]))
+        if n_rows + len(chunk) > len(out):
+            out.resize((max(2 * len(out), n_rows + len(chunk)), out.shape[1]), refcheck=False)
+        out[n_rows:n_rows + len(chunk)] = chunk
+        n_rows += len(chunk)
+
+    if out is None:
+        return np.empty((0, width))
+    if n_rows != len(out):
+        out.resize((n_rows, out.shape[1]), refcheck=False)
+    return out
+
+
+def _write_memmap(mmap_file, chunks):
+    """
+    Writes the row chunks of a square matrix in a new .npy file, returning it memory-mapped
+
+    Raises
+    ------
+    ValueError: Exception
+        If the chunks do not form a square matrix
+    """
+    out = None
+    n_rows = 0
+    for chunk in chunks:
+        if out is None:
+            out = np.lib.format.open_memmap(mmap_file, mode='w+', dtype=np.float64,
+                                            shape=(chunk.shape[1], chunk.shape[1]))
+        if n_rows + len(chunk) > len(out):
+            raise ValueError("A memory-mapped adjacency matrix must be square")
+        out[n_rows:n_rows + len(chunk)] = chunk
+        n_rows += len(chunk)
+
+    if out is None or n_rows != len(out):
+        raise ValueError("A memory-mapped adjacency matrix must be square")
+    out.flush()
+    del out
+
+    return np.load(mmap_file, mmap_mode='r+')
+
+
+def _blocks_of(matrix, chunk_rows=_CHUNK_ROWS):
+    """ Generator over blocks of `chunk_rows` rows of `matrix` """
+    for start in range(0, len(matrix), chunk_rows):
+        yield np.asarray(matrix[start:start + chunk_rows])
+
+
+def _parse_chunks(lines, delimiter, na_vals, chunk_rows=_CHUNK_ROWS):
+    """
+    Generator which converts an iterable of text rows into 2D float arrays of (at most)
+    `chunk_rows` rows each, using numpy's C parser. Empty rows are ignored.
+    """
+    na_regex = _na_regex(delimiter, na_vals)
+    lines = iter(lines)
+    width = None
+    while True:
+        text = ''.join(itertools.islice(lines, chunk_rows))
+        if not text:
+            return
+        if na_regex is not None and any(na_val in text for na_val in na_vals):
+            text = na_regex.sub(r'\1nan', text)
+
+        values = np.loadtxt(io.StringIO(text), delimiter=delimiter, comments=None, ndmin=2)
+        if not values.size:
+            continue
+
+        if width is None:
+            width = values.shape[1]
+        elif values.shape[1] != width:
+            raise ValueError("All the rows of the matrix must have the same number of values")
+        yield values
+
+
+def _na_regex(delimiter, na_vals):
+    """ Regular expression matching the values of `na_vals` which are whole values in a row """
+    if not na_vals:
+        return None
+    separator = r'\s' if delimiter is None else re.escape(delimiter)
+    return re.compile(r'(^|%s)[^\S\n]*(?:%s)(?=[^\S\n]*(?:%s|$))' % (separator,
+                                                                      '|'.join(re.escape(v) for v in na_vals),
+                                                                      separator),
+                      re.MULTILINE)
+
+
+def _cache_filename(fname, delimiter, na_vals):
+    """ Name of the sidecar cache for `fname`, keyed on its path, size, mtime and parsing options """
+    stat = os.stat(fname)
+    key = repr((os.path.abspath(fname), stat.st_size, stat.st_mtime_ns, delimiter, sorted(na_vals)))
+    return '%s.mbcache-%s.npy' % (fname, hashlib.md5(key.encode()).hexdigest()[:16])
+
+
+def _write_cache(cache_file, fname, matrix):
+    """
+    Saves `matrix` in `cache_file`, removing outdated caches of `fname`.
+    Caching is just an optimisation, so problems writing the file are ignored.
+    """
+    try:
+        for old in glob(escape(fname) + '.mbcache-*.npy'):
+            os.remove(old)
+        tmp_file = cache_file[:-len('.npy')] + '.tmp.npy'
+        np.save(tmp_file, matrix)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        pass
+
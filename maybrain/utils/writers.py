@@ -1,9 +1,28 @@
 """
 Utility functions for writing maybrain entities to files
 """
-def output_adj_matrix(brain, filename):
+import numpy as np
+from scipy import sparse
+
+from .brain_utils import csr_to_dense
+from .readers import open_text
+
+# Number of matrix rows or edges formatted at once by the writers
+_CHUNK_ROWS = 256
+_CHUNK_EDGES = 2 ** 16
+# Default format of the values of a matrix, the shortest text which reads back the same number (as str())
+_DEFAULT_FMT = '%r'
+
+
+def output_adj_matrix(brain, filename, fmt=None, delimiter='\t'):
     """
-    Outputs the adjacency matrix to a file
+    Outputs the adjacency matrix to a file. The format depends on the extension of `filename`:
+        ".npy" -> numpy binary file, which can be imported with `Brain.import_adj_npy()`
+        ".gz" or ".bz2" -> compressed text file
+        any other -> text file, with a row of the matrix per line
+
+    Text is formatted by blocks of rows. A sparse adjMat is written as a dense matrix where the
+    missing elements are "nan" (np.nan in ".npy").
 
     Parameters
     ----------
@@ -11,22 +30,41 @@ def output_adj_matrix(brain, filename):
         An instance of the `Brain` class
     filename: str
         The filename to which the adjacency matrix will be written
+    fmt: str
+        Format of each value in a text file, like "%.6g". If None, the shortest text which reads back
+        the same number is used, as in `output_edges()`
+    delimiter: str
+        The delimiter of the values in a text file
     """
-
     try:
-        with open(filename, "w") as file:
-            for line in brain.adjMat:
-                for num in line[:-1]:
-                    file.write(str(num) + '\t')
-                file.write(str(line[-1]) + '\n')
+        if filename.endswith('.npy'):
+            adj_mat = brain.adjMat
+            np.save(filename, csr_to_dense(adj_mat) if sparse.issparse(adj_mat) else adj_mat)
+            return
+
+        with open_text(filename, "w") as file:
+            for start in range(0, brain.adjMat.shape[0], _CHUNK_ROWS):
+                block = brain.adjMat[start:start + _CHUNK_ROWS]
+                if sparse.issparse(block):
+                    block = csr_to_dense(block)
+                file.write(_format_rows(np.asarray(block), fmt, delimiter))
     except IOError as error:
         error.strerror = 'Problem with opening file "' + filename + '": ' + error.strerror
         raise error
 
 
-def output_edges(brain, filename, properties=None):
+def output_edges(brain, filename, properties=None, header=True, delimiter='\t'):
     """
-    Outputs the edges of a brain to file
+    Outputs the edges of a brain to file, with a column for each node and for each property.
+    The format depends on the extension of `filename`:
+        ".npz" -> numpy binary file, with the array "edges" with shape (M, 2) and an array for
+                  each property (NaN, or "NA" in non-numeric properties, where an edge doesn't
+                  have it)
+        ".gz" or ".bz2" -> compressed text file
+        any other -> text file, where "NA" is written if an edge doesn't have a property
+
+    Writing `properties=['weight']` and `header=False` to a text file creates an edge list which
+    can be imported by `Brain.import_edge_list()`.
 
     Parameters
     ----------
@@ -36,30 +74,50 @@ def output_edges(brain, filename, properties=None):
         The filename to which the edges will be written
     properties: list
         The list of properties you want to save from each edge
+    header: bool
+        Whether the first line of a text file has the names of the columns
+    delimiter: str
+        The delimiter of the columns in a text file
     """
     if properties is None:
         properties = []
+    edges = list(brain.G.edges(data=True))
+
     try:
-        with open(filename, "w") as file:
+        if filename.endswith('.npz'):
+            columns = {prop: _property_column(edges, prop) for prop in properties}
+            columns['edges'] = np.array([(e[0], e[1]) for e in edges]).reshape(-1, 2)
+            np.savez(filename, **columns)
+            return
+
+        with open_text(filename, "w") as file:
             # write column headers
-            line = 'n1' + '\t' + 'n2'
-            for prop in properties:
-                line = line + '\t' + prop
-            line = line + '\n'
-            file.write(line)
-
-            for e in brain.G.edges(data=True):
-                # add coordinates
-                line = str(e[0]) + '\t' + str(e[1])
-                # add other properties
-                for prop in properties:
-                    try:
-                        line = line + '\t' + str(e[2][prop])
-                    except BaseException:
-                        continue  # Property doesn't exist, just continue
-                line = line + '\n'
-                # write out
-                file.write(line)
+            if header:
+                file.write(delimiter.join(['n1', 'n2'] + list(properties)) + '\n')
+
+            for start in range(0, len(edges), _CHUNK_EDGES):
+                chunk = edges[start:start + _CHUNK_EDGES]
+                columns = [map(str, [e[0] for e in chunk]), map(str, [e[1] for e in chunk])]
+                columns.extend(map(str, [e[2].get(prop, 'NA') for e in chunk]) for prop in properties)
+                file.write(''.join(delimiter.join(line) + '\n' for line in zip(*columns)))
     except IOError as error:
         error.strerror = 'Problem with opening file "' + filename + '": ' + error.strerror
         raise error
+
+
+def _format_rows(block, fmt, delimiter):
+    """ Text of a 2D array, with a line per row """
+    if not block.size:
+        return '\n' * len(block)
+    if fmt is None:
+        fmt = _DEFAULT_FMT
+    line = delimiter.join([fmt] * block.shape[1]) + '\n'
+    return (line * len(block)) % tuple(block.ravel().tolist())
+
+
+def _property_column(edges, prop):
+    """ Array with the values of a property in `edges`, numeric if possible """
+    values = [e[2].get(prop) for e in edges]
+    if all(isinstance(v, (int, float, np.number)) or v is None for v in values):
+        return np.array([np.nan if v is None else v for v in values], dtype=float)
+    return np.array(['NA' if v is None else str(v) for v in values])
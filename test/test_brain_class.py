@@ -1,10 +1,19 @@
+import bz2
+import glob
+import gzip
+import os
+import shutil
+import tempfile
 import unittest
 
 from maybrain import brain as mbt
+from maybrain import cohort as mbc
 from maybrain import constants as ct
 from maybrain import utils
 import networkx as nx
 import numpy as np
+import scipy.io as spio
+import scipy.sparse as sp
 
 
 class TestBrainObj(unittest.TestCase):
@@ -52,6 +61,162 @@ class TestBrainObj(unittest.TestCase):
         self.assertTrue(all(np.isnan(x) for x in b.adjMat[2, :]))
         self.assertTrue(all(np.isnan(x) for x in b.adjMat[4, :]))
 
+    def test_import_adj_file_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fname = os.path.join(tmp_dir, "adj.txt")
+            shutil.copy(self.MODIF_FILE, fname)
+            b = mbt.Brain()
+            b.import_adj_file(fname, delimiter=",", cache=True)
+            self.assertEqual(len(glob.glob(fname + ".mbcache-*.npy")), 1)
+
+            c = mbt.Brain()
+            c.import_adj_file(fname, delimiter=",", nodes_to_exclude=[2], cache=True)
+            np.testing.assert_array_equal(b.adjMat[0, 3:], c.adjMat[0, 3:])
+            self.assertTrue(all(np.isnan(x) for x in c.adjMat[2, :]))
+            self.assertEqual(c.G.number_of_nodes(), 14)
+
+            # A different parsing option must not reuse the same cache
+            self.assertRaises(ValueError, c.import_adj_file, fname, cache=True)
+
+    def test_compressed_files(self):
+        self.a.import_adj_file(self.MODIF_FILE, delimiter=",")
+        self.a.import_spatial_info(self.COORD_FILE)
+        self.a.apply_threshold()
+        self.a.import_properties(self.PROPS_FILE)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for opener, ext in [(gzip.open, '.gz'), (bz2.open, '.bz2')]:
+                for fname in [self.MODIF_FILE, self.COORD_FILE, self.PROPS_FILE]:
+                    with open(fname, 'rb') as file, opener(os.path.join(tmp_dir, os.path.basename(fname) + ext),
+                                                           'wb') as file2:
+                        file2.write(file.read())
+
+                b = mbt.Brain()
+                b.import_adj_file(os.path.join(tmp_dir, os.path.basename(self.MODIF_FILE) + ext), delimiter=",",
+                                  mmap_file=os.path.join(tmp_dir, 'adj' + ext + '.npy'))
+                b.import_spatial_info(os.path.join(tmp_dir, os.path.basename(self.COORD_FILE) + ext))
+                b.apply_threshold()
+                b.import_properties(os.path.join(tmp_dir, os.path.basename(self.PROPS_FILE) + ext))
+
+                np.testing.assert_array_equal(self.a.adjMat, b.adjMat)
+                np.testing.assert_array_equal(self.a.coords, b.coords)
+                self.assertEqual(list(self.a.G.nodes(data=True)), list(b.G.nodes(data=True)))
+                self.assertEqual(list(self.a.G.edges(data=True)), list(b.G.edges(data=True)))
+                del b
+
+    def test_memory_mapped_adj_mat(self):
+        block_elements = mbt._BLOCK_ELEMENTS
+        mbt._BLOCK_ELEMENTS = 40  # Forcing the matrix to be scanned in several blocks
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                npy_file = os.path.join(tmp_dir, "adj.npy")
+                self.a.import_adj_file(self.MODIF_FILE, delimiter=",", nodes_to_exclude=[2, 4])
+                b = mbt.Brain()
+                b.import_adj_file(self.MODIF_FILE, delimiter=",", nodes_to_exclude=[2, 4],
+                                  mmap_file=npy_file)
+                self.assertIsInstance(b.adjMat, np.memmap)
+                np.testing.assert_array_equal(self.a.adjMat, b.adjMat)
+                self.assertEqual(self.a.G.number_of_nodes(), b.G.number_of_nodes())
+
+                for th_type, val in [(None, 0), ("edgePC", 10.5), ("totalEdges", 7), ("tVal", 0.3)]:
+                    for use_abs in [True, False]:
+                        self.a.apply_threshold(threshold_type=th_type, value=val, use_absolute=use_abs)
+                        b.apply_threshold(threshold_type=th_type, value=val, use_absolute=use_abs)
+                        self.assertEqual(sorted(self.a.G.edges(data=True)), sorted(b.G.edges(data=True)))
+                self.assertEqual(utils.threshold_to_percentage(self.a, 0.2),
+                                 utils.threshold_to_percentage(b, 0.2))
+
+                b.reconstruct_adj_mat()
+                self.assertEqual(np.count_nonzero(~np.isnan(b.adjMat)), 2 * b.G.number_of_edges())
+                b.adjMat.flush()
+
+                # The changes were written into the file
+                c = mbt.Brain()
+                c.import_adj_npy(npy_file, mmap_mode='r')
+                self.assertEqual(np.count_nonzero(~np.isnan(c.adjMat)), 2 * b.G.number_of_edges())
+                self.assertRaises(IOError, c.import_adj_npy, "sdfasdf")
+                del b, c
+        finally:
+            mbt._BLOCK_ELEMENTS = block_elements
+
+    def test_import_edge_list(self):
+        dense = mbt.Brain()
+        dense.import_adj_file(self.MODIF_FILE, delimiter=",", nodes_to_exclude=[2])
+        upper = np.triu_indices(len(dense.adjMat), k=1)
+        rows, cols = np.nonzero(~np.isnan(dense.adjMat) & np.triu(np.ones(dense.adjMat.shape, dtype=bool), k=1))
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            # Edges are written in the lower triangle and read into a symmetric sparse matrix
+            fname = os.path.join(tmp_dir, 'edges.txt')
+            with open(fname, 'w') as file:
+                file.writelines('%d,%d,%r\n' % (j, i, dense.adjMat[i, j]) for i, j in zip(rows, cols))
+            self.a.import_edge_list(fname, delimiter=",", n_nodes=len(dense.adjMat))
+            self.assertTrue(sp.isspmatrix_csr(self.a.adjMat))
+            self.assertEqual(self.a.adjMat.nnz, 2 * len(rows))
+            self.assertTrue(np.array_equal(utils.csr_to_dense(self.a.adjMat)[upper], dense.adjMat[upper],
+                                           equal_nan=True))
+
+            for threshold_type, value in [("edgePC", 20), ("totalEdges", 7), ("tVal", 0.4), (None, 0)]:
+                dense.apply_threshold(threshold_type, value)
+                self.a.apply_threshold(threshold_type, value)
+                self.assertEqual(list(dense.G.edges(data=True)), list(self.a.G.edges(data=True)))
+
+            # MatrixMarket
+            mm_brain = mbt.Brain()
+            spio.mmwrite(os.path.join(tmp_dir, 'mat.mtx'), sp.coo_matrix(self.a.adjMat))
+            mm_brain.import_edge_list(os.path.join(tmp_dir, 'mat.mtx'), nodes_to_exclude=[0])
+            self.assertNotIn(0, mm_brain.G.nodes())
+            self.assertEqual(mm_brain.adjMat[:, 0].nnz, 0)
+            self.assertEqual(mm_brain.adjMat[1, 3], self.a.adjMat[1, 3])
+
+            with open(fname, 'w') as file:
+                file.write('0 1 0.5\n1 2.5 0.3\n')
+            self.assertRaises(ValueError, self.a.import_edge_list, fname)
+            self.assertRaises(ValueError, self.a.import_edge_list, fname, n_nodes=2)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_to_csr(self):
+        self.a.import_adj_file(self.MODIF_FILE, delimiter=",", nodes_to_exclude=[2, 4])
+        self.a.apply_threshold(threshold_type="totalEdges", value=6)
+        expected = nx.to_numpy_array(self.a.G, nonedge=np.nan)
+
+        self.a.apply_threshold(threshold_type="totalEdges", value=6)
+        self.assertTrue(np.array_equal(utils.csr_to_dense(self.a.to_csr()), expected, equal_nan=True))
+        self.a.G.remove_edge(*list(self.a.G.edges())[0])
+        self.assertEqual(self.a.to_csr().nnz, 10)
+        self.assertTrue(np.array_equal(utils.makebctmat(self.a, nonedge=0), nx.to_numpy_array(self.a.G)))
+
+    def test_edge_arrays(self):
+        # The operations on the compact edges give the same G as the operations on G itself
+        for method in ["binarise", "make_edges_absolute", "weight_to_distance", "remove_unconnected_nodes",
+                       "find_linked_nodes"]:
+            brains = []
+            for access_g in [False, True]:
+                brn = mbt.Brain()
+                brn.import_adj_file(self.SMALL_NEG_FILE)
+                brn.apply_threshold(threshold_type="totalEdges", value=5)
+                if access_g:
+                    brn.G.number_of_edges()
+                getattr(brn, method)()
+                brains.append(brn)
+            self.assertEqual(list(brains[0].G.nodes(data=True)), list(brains[1].G.nodes(data=True)))
+            self.assertEqual(list(brains[0].G.edges(data=True)), list(brains[1].G.edges(data=True)))
+
+        # Saving and loading keeps the compact edges
+        self.a.import_adj_file(self.MODIF_FILE, delimiter=",")
+        self.a.apply_threshold(threshold_type="edgePC", value=50)
+        self.a.weight_to_distance()
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            self.a.save(os.path.join(tmp_dir, "brain.npz"))
+            b = mbt.Brain.load(os.path.join(tmp_dir, "brain.npz"))
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual((b.to_csr(weight=ct.DISTANCE) != self.a.to_csr(weight=ct.DISTANCE)).nnz, 0)
+        self.assertEqual(list(b.G.edges(data=True)), list(self.a.G.edges(data=True)))
+
     def test_import_spatial_info(self):
         self.assertRaises(FileNotFoundError, self.a.import_spatial_info, "sdfasdf")
         self.a.import_adj_file(self.SMALL_FILE)
@@ -71,6 +236,61 @@ class TestBrainObj(unittest.TestCase):
         self.assertEqual(attrs2[0], '0')
         self.assertEqual(attrs2[3], '3')
 
+    def test_spatial_arrays(self):
+        self.a.import_adj_file(self.SMALL_FILE)
+        self.a.import_spatial_info(self.COORD_FILE)
+        self.assertEqual(self.a.coords.shape[1], 3)
+        self.assertEqual(len(self.a.coords), len(self.a.anat_labels))
+        self.assertTrue(np.array_equal(self.a.coords[3], [2, 2, 0]))
+        self.assertEqual(self.a.anat_labels[3], '3')
+
+        # node_coords() also looks into G and returns NaN for unknown nodes
+        self.a.G.add_node('extra', **{ct.XYZ: (1., 2., 3.)})
+        positions = self.a.node_coords([3, 'extra', 'unknown'])
+        self.assertTrue(np.array_equal(positions[:2], [[2, 2, 0], [1, 2, 3]]))
+        self.assertTrue(np.isnan(positions[2]).all())
+        self.assertTrue(np.array_equal(self.a.node_coords(), self.a.node_coords(self.a.G.nodes())))
+        self.a.G.remove_node('extra')
+
+        # Changes of the coordinates in G are used
+        self.a.G.nodes[0][ct.XYZ] = (9., 9., 9.)
+        self.assertTrue(np.array_equal(self.a.node_coords([0, 3]), [[9, 9, 9], [2, 2, 0]]))
+        self.assertEqual(self.a.find_spatially_nearest(1, connected=False), 3)
+        self.a.G.nodes[0][ct.XYZ] = (0., 0., 0.)
+
+        # Closest node to node 0, with and without edges
+        self.assertEqual(self.a.find_spatially_nearest(0, connected=False), 1)
+        self.assertEqual(self.a.find_spatially_nearest(0), None)
+        self.assertEqual(self.a.find_spatially_nearest(0, connected=False, threshold=2.5), [1, 2])
+
+        # MNI conversion
+        mni = mbt.Brain()
+        mni.import_adj_file(self.SMALL_FILE)
+        mni.import_spatial_info(self.COORD_FILE, convert_mni=True)
+        self.assertTrue(np.array_equal(mni.coords[3], [44, 64, 36]))
+        self.assertEqual(mni.G.nodes[3][ct.XYZ], (44., 64., 36.))
+
+    def test_nifti_images(self):
+        import nibabel as nb
+        labels = np.arange(24, dtype=np.float32).reshape((2, 3, 4)) % 5
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            nb.save(nb.Nifti1Image(labels, np.eye(4)), os.path.join(tmp_dir, 'iso.nii'))
+            nb.save(nb.Nifti1Image(labels * 10, np.eye(4)), os.path.join(tmp_dir, 'bg.nii'))
+
+            self.a.import_iso(os.path.join(tmp_dir, 'iso.nii'))
+            self.a.import_background(os.path.join(tmp_dir, 'bg.nii'))
+            self.assertIsNone(self.a._iso)  # not read yet
+            self.assertEqual(self.a.iso.dtype.kind, 'u')
+            self.assertIs(self.a.iso, self.a.iso)
+            self.assertIsInstance(self.a.background, np.memmap)
+            self.assertEqual(self.a.background.dtype, np.float32)
+
+            self.a.parcels([0, 3])
+            np.testing.assert_array_equal(self.a.parcel_list.filled(0), np.where(np.isin(labels, [1, 4]), labels, 0))
+            self.a.export_parcels_nii(os.path.join(tmp_dir, 'out'), value_dict={1: 0.5, 2: 7})
+            out = nb.load(os.path.join(tmp_dir, 'out.nii')).get_fdata()
+            np.testing.assert_array_equal(out, np.select([labels == 2, labels == 3], [0.5, 7]))
+
     def test_apply_threshold(self):
         self.a.import_adj_file(self.MODIF_FILE, delimiter=",", nodes_to_exclude=[2, 4])
         self.a.import_spatial_info(self.COORD_FILE)  # making sure this doesn't influence the rest
@@ -150,11 +370,52 @@ class TestBrainObj(unittest.TestCase):
         self.assertTrue(b.G.edges[1, 2][ct.WEIGHT] == -0.843798947781)
         self.assertEqual(b.G.number_of_edges(), 1)
 
+    def test_threshold_ties(self):
+        # With equal weights, the last edges of the upper triangle (row by row) are retained
+        self.a.import_adj_array(np.ones((5, 5)))
+        self.a.apply_threshold(threshold_type="totalEdges", value=3)
+        self.assertEqual(sorted(self.a.G.edges()), [(2, 3), (2, 4), (3, 4)])
+
+        adj = np.array([[0, -3, 1, 3], [-3, 0, 2, -1], [1, 2, 0, 3], [3, -1, 3, 0]], dtype=float)
+        b = mbt.Brain(directed=True)
+        b.import_adj_array(adj)
+        b.apply_threshold(threshold_type="totalEdges", value=4, use_absolute=True)
+        # |3| is in (0,1), (0,3), (2,3) above the diagonal and (1,0), (3,0), (3,2) below
+        self.assertEqual(sorted(b.G.edges()), [(1, 0), (2, 3), (3, 0), (3, 2)])
+
+    def test_threshold_sweep(self):
+        self.a.import_adj_file(self.MODIF_FILE, delimiter=",")
+        b = mbt.Brain()
+        b.import_adj_file(self.MODIF_FILE, delimiter=",")
+
+        for threshold_type, values in [("edgePC", [5, 50, 20, 100]), ("totalEdges", [3, 1, 10]),
+                                       ("tVal", [0.5, -1, 0.8])]:
+            for use_absolute in [False, True]:
+                sweep = b.threshold_sweep(values, threshold_type, use_absolute)
+                for (value, graph), expected in zip(sweep, values):
+                    self.assertEqual(value, expected)
+                    self.a.apply_threshold(threshold_type, value, use_absolute)
+                    self.assertEqual(sorted(graph.edges(data=True)), sorted(self.a.G.edges(data=True)))
+
+        counts = dict(b.threshold_sweep([10, 20], metric=lambda brn: brn.G.number_of_edges()))
+        self.a.apply_threshold(threshold_type="edgePC", value=20)
+        self.assertEqual(counts[20], self.a.G.number_of_edges())
+        self.assertRaises(TypeError, list, b.threshold_sweep([110]))
+        self.assertRaises(TypeError, list, b.threshold_sweep([1], threshold_type="other"))
+
     def test_binarise(self):
         self.a.import_adj_file(self.MODIF_FILE, delimiter=",")
         self.a.apply_threshold()
         self.a.binarise()
         self.assertTrue(all(e[2][ct.WEIGHT] == 1 for e in self.a.G.edges(data=True)))
+        self.assertTrue(all(type(e[2][ct.WEIGHT]) is int for e in self.a.G.edges(data=True)))
+
+        # Edges without weight are also binarised
+        self.a.G.add_edge(0, 1)
+        del self.a.G[2][3][ct.WEIGHT]
+        self.a.binarise()
+        self.assertTrue(all(e[2][ct.WEIGHT] == 1 and type(e[2][ct.WEIGHT]) is int
+                            for e in self.a.G.edges(data=True)))
 
     def test_make_absolute(self):
         c = mbt.Brain(directed=True)
@@ -163,6 +424,33 @@ class TestBrainObj(unittest.TestCase):
         c.make_edges_absolute()
         self.assertTrue(all(e[2][ct.WEIGHT] >= 0 for e in c.G.edges(data=True)))
 
+    def test_transform_edges(self):
+        weights = {}
+        for access_g in [False, True]:
+            brn = mbt.Brain()
+            brn.import_adj_file(self.SMALL_NEG_FILE)
+            brn.apply_threshold(threshold_type="totalEdges", value=5)
+            if access_g:
+                brn.G.number_of_edges()
+            brn.transform_edges("rank", target="rank")
+            brn.transform_edges("absolute")
+            brn.transform_edges("inverse", target=ct.DISTANCE)
+            brn.transform_edges(lambda values, n_nodes: values * n_nodes, source=ct.DISTANCE, target="scaled")
+            weights[access_g] = sorted(brn.G.edges(data=True))
+
+        self.assertEqual(weights[False], weights[True])
+        n_nodes = brn.G.number_of_nodes()
+        for _, _, attrs in weights[True]:
+            self.assertAlmostEqual(attrs[ct.DISTANCE], 1 / attrs[ct.WEIGHT])
+            self.assertAlmostEqual(attrs["scaled"], attrs[ct.DISTANCE] * n_nodes)
+        self.assertEqual(sorted(attrs["rank"] for _, _, attrs in weights[True]), [0.2, 0.4, 0.6, 0.8, 1])
+
+        brn.transform_edges("fisher_z", source="rank", target="z")
+        self.assertEqual(brn.G.edges[weights[True][0][:2]]["z"], np.arctanh(weights[True][0][2]["rank"]))
+        self.assertRaises(KeyError, brn.transform_edges, "other")
+        self.assertRaises(KeyError, brn.transform_edges, "neg_log", source="other")
+        self.assertRaises(ValueError, brn.transform_edges, lambda values, n_nodes: values[1:])
+
     def test_local_threshold(self):
         self.a.import_adj_file(self.MODIF_FILE, delimiter=",")
         self.a.apply_threshold()
@@ -197,6 +485,24 @@ class TestBrainObj(unittest.TestCase):
         self.a.local_thresholding(threshold_type="edgePC", value=20)
         self.assertEqual(self.a.G.number_of_edges(), int(0.2 * all_edges))
         self.assertTrue(nx.is_connected(self.a.G))
+        self.assertTrue(all(ct.DISTANCE in e[2] for e in self.a.G.edges(data=True)))
+
+    def test_local_threshold_sweep(self):
+        self.a.import_adj_file(self.MODIF_FILE, delimiter=",")
+        b = mbt.Brain()
+        b.import_adj_file(self.MODIF_FILE, delimiter=",")
+
+        values = [20, 5, 100, 50]
+        for (value, graph), expected in zip(b.local_threshold_sweep(values), values):
+            self.assertEqual(value, expected)
+            self.a.local_thresholding(threshold_type="edgePC", value=value)
+            self.assertEqual(sorted(graph.edges(data=True)), sorted(self.a.G.edges(data=True)))
+
+        counts = dict(b.local_threshold_sweep([20, 30], threshold_type="totalEdges",
+                                              metric=lambda brn: brn.G.number_of_edges()))
+        self.assertEqual(counts, {20: 20, 30: 30})
+        self.assertRaises(TypeError, list, b.local_threshold_sweep([20], threshold_type=None))
+        self.assertRaises(TypeError, list, mbt.Brain(directed=True).local_threshold_sweep([20]))
 
     def test_adj_mat(self):
         self.a.import_adj_file(self.MODIF_FILE, delimiter=",")
@@ -223,6 +529,48 @@ class TestBrainObj(unittest.TestCase):
         self.a.G.edges[50, 50][ct.WEIGHT] = 12
         self.assertRaises(IndexError, self.a.update_adj_mat, (50, 50))
 
+    def test_update_adj_mat_many(self):
+        self.a.import_adj_file(self.MODIF_FILE, delimiter=",")
+        self.a.apply_threshold(threshold_type="totalEdges", value=3)
+        expected = self.a.adjMat.copy()
+
+        self.a.G[1][12][ct.WEIGHT] = 5
+        self.a.G.add_edge(3, 4, weight=-1)
+        self.a.update_adj_mat_many([(1, 12), (3, 4)])
+        self.a.update_adj_mat_many(np.array([[2, 5]]), weights=[np.nan])
+        expected[[1, 12], [12, 1]] = 5
+        expected[[3, 4], [4, 3]] = -1
+        expected[[2, 5], [5, 2]] = np.nan
+        np.testing.assert_array_equal(self.a.adjMat, expected)
+
+        # Deferred synchronisation
+        self.a.defer_adj_mat_sync = True
+        self.a.G[1][12][ct.WEIGHT] = 6
+        self.a.update_adj_mat((1, 12))
+        self.a.G.remove_edge(3, 4)
+        self.a.update_adj_mat_many([(3, 4)])
+        self.assertEqual(self.a._adj_mat[1, 12], 5)
+        expected[[1, 12], [12, 1]] = 6
+        expected[[3, 4], [4, 3]] = np.nan
+        np.testing.assert_array_equal(self.a.adjMat, expected)
+
+        self.a.reconstruct_adj_mat()
+        self.assertEqual(self.a._adj_mat[1, 12], 6)
+        self.assertEqual(np.count_nonzero(~np.isnan(self.a.adjMat)), 2 * self.a.G.number_of_edges())
+
+        # Sparse adjMat
+        b = mbt.Brain()
+        b.import_adj_array(sp.csr_matrix(np.nan_to_num(expected)))
+        b.update_adj_mat_many([(1, 12), (0, 2)], weights=[np.nan, 3])
+        dense = b.adjMat.toarray()
+        self.assertEqual((dense[1, 12], dense[12, 1], dense[0, 2], dense[2, 0]), (0, 0, 3, 3))
+
+        # Error handling
+        self.a.defer_adj_mat_sync = False
+        self.assertRaises(KeyError, self.a.update_adj_mat_many, [(3, 4)])
+        self.assertRaises(IndexError, self.a.update_adj_mat_many, [(0, 50)], weights=[1])
+        self.assertRaises(ValueError, self.a.update_adj_mat_many, [(1, 12)], weights=[1, 2])
+
     def test_remove_unconnected_nodes(self):
         self.a.import_adj_file(self.MODIF_FILE, delimiter=",")
         self.a.apply_threshold(threshold_type="totalEdges", value=1)
@@ -252,6 +600,178 @@ class TestBrainObj(unittest.TestCase):
         c.apply_threshold(threshold_type="totalEdges", value=0)
         self.assertEqual(utils.percent_connected(c), 0)
 
+    def test_directed_threshold(self):
+        # The off-diagonal elements are scanned once, with the upper triangle's order and ties as before
+        rng = np.random.RandomState(0)
+        adj = rng.randint(0, 20, size=(60, 60)).astype(float)
+        adj[rng.rand(60, 60) < 0.1] = np.nan
+        upper, lower = np.triu_indices(60, 1), np.tril_indices(60, -1)
+        rows, cols = np.concatenate((upper[0], lower[0])), np.concatenate((upper[1], lower[1]))
+        defined = ~np.isnan(adj[rows, cols])
+        rows, cols = rows[defined], cols[defined]
+        order = np.argsort(adj[rows, cols], kind='stable')
+
+        i, j = np.nonzero(~np.isnan(adj))
+        for adj_mat in [adj, sp.csr_matrix((adj[i, j], (i, j)), shape=adj.shape)]:
+            c = mbt.Brain(directed=True)
+            c.import_adj_array(adj_mat.copy())
+            for value in [1, 100, 1000]:
+                c.apply_threshold(threshold_type="totalEdges", value=value)
+                self.assertEqual(sorted(c.G.edges()), sorted(zip(rows[order][-value:].tolist(),
+                                                                 cols[order][-value:].tolist())))
+            self.assertEqual(c.threshold_to_percentage(10), np.count_nonzero(adj[rows, cols] > 10) / len(rows))
+            c.apply_threshold(threshold_type="tVal", value=15)
+            self.assertEqual(sorted(c.G.edges()), sorted(zip(rows[adj[rows, cols] >= 15].tolist(),
+                                                             cols[adj[rows, cols] >= 15].tolist())))
+
+    def test_filtration(self):
+        self.a.import_adj_file(self.MODIF_FILE, delimiter=",")
+        filtration = self.a.filtration()
+        self.assertEqual(self.a.G.number_of_edges(), 0)
+        for k in [1, 10, 30, len(filtration["weights"])]:
+            self.a.apply_threshold(threshold_type="totalEdges", value=k)
+            self.assertEqual(sorted(map(tuple, filtration["edges"][:k].tolist())), sorted(self.a.G.edges()))
+            self.assertEqual(filtration["components"][k - 1], nx.number_connected_components(self.a.G))
+            self.assertEqual(filtration["largest_component"][k - 1],
+                             max(len(c) for c in nx.connected_components(self.a.G)))
+
+        # The percolation point is the first edge connecting the graph
+        n_edges = filtration["percolation_edges"]
+        self.a.apply_threshold(threshold_type="totalEdges", value=n_edges)
+        self.assertTrue(nx.is_connected(self.a.G))
+        self.assertEqual(filtration["percolation_threshold"], filtration["weights"][n_edges - 1])
+        self.a.apply_threshold(threshold_type="totalEdges", value=n_edges - 1)
+        self.assertFalse(nx.is_connected(self.a.G))
+
+    def test_metric_cache(self):
+        self.a.import_adj_file(self.MODIF_FILE, delimiter=",")
+        self.a.apply_threshold(threshold_type="totalEdges", value=30)
+        clustering = self.a.metric("clustering")
+        self.assertIs(self.a.metric("clustering"), clustering)
+        self.assertFalse(clustering.flags.writeable)
+        # While the edges are in the compact store, they are only hashed once for each version
+        edge_set_hash = mbt._edge_set_hash
+        mbt._edge_set_hash = None
+        try:
+            self.assertIs(self.a.metric("clustering"), clustering)
+        finally:
+            mbt._edge_set_hash = edge_set_hash
+        self.assertIsNotNone(self.a._edges)
+        nodes = list(self.a.G.nodes())
+        np.testing.assert_allclose(clustering, [nx.clustering(self.a.G)[n] for n in nodes])
+        weighted = self.a.metric("clustering", weight=ct.WEIGHT)
+        self.assertIsNot(weighted, clustering)
+        self.assertIs(self.a.metric("clustering", weight=ct.WEIGHT), weighted)
+
+        # Changes of the edges invalidate the results
+        self.a.binarise()
+        self.assertIsNot(self.a.metric("clustering", weight=ct.WEIGHT), weighted)
+        clustering = self.a.metric("clustering")
+        self.a.apply_threshold(threshold_type="totalEdges", value=20)
+        self.assertIsNot(self.a.metric("clustering"), clustering)
+        np.testing.assert_allclose(self.a.metric("clustering"), [nx.clustering(self.a.G)[n] for n in nodes])
+        clustering = self.a.metric("clustering")
+        self.a.G.remove_edge(*next(iter(self.a.G.edges())))
+        np.testing.assert_allclose(self.a.metric("clustering"), [nx.clustering(self.a.G)[n] for n in nodes])
+        clustering = self.a.metric("clustering")
+        self.a.update_adj_mat_many([next(iter(self.a.G.edges()))])
+        self.assertIsNot(self.a.metric("clustering"), clustering)
+
+        # Swapping an edge of G for another one keeps the number of edges, but it is also noticed
+        degrees = self.a.metric("degree")
+        u, v = next(iter(self.a.G.edges()))
+        new_edge = next((u, w) for w in nodes if w != u and not self.a.G.has_edge(u, w))
+        self.a.G.remove_edge(u, v)
+        self.a.G.add_edge(*new_edge, **{ct.WEIGHT: 1})
+        self.assertIsNot(self.a.metric("degree"), degrees)
+        np.testing.assert_array_equal(self.a.metric("degree"), [d for _, d in nx.degree(self.a.G, nodes)])
+
+        # The least recently used results are discarded above the memory limit
+        self.a.metric_cache_size = 2 * clustering.nbytes
+        degrees = self.a.metric("degree")
+        clustering = self.a.metric("clustering")
+        self.assertIs(self.a.metric("degree"), degrees)
+        self.a.metric("triangles")
+        self.assertIs(self.a.metric("degree"), degrees)
+        self.assertIsNot(self.a.metric("clustering"), clustering)
+
+        self.assertEqual(self.a.metric(lambda brain, k: k * brain.G.number_of_edges(), k=2),
+                         2 * self.a.G.number_of_edges())
+        self.assertRaises(TypeError, self.a.metric, "not_a_metric")
+        self.assertRaises(TypeError, self.a.metric, "_matrices")
+        self.assertRaises(TypeError, self.a.metric, "modularity")
+
+    def test_path_lengths(self):
+        adj_mat = np.random.RandomState(0).rand(40, 40)
+        self.a.import_adj_array((adj_mat + adj_mat.T) / 2)
+        self.a.apply_threshold(threshold_type="edgePC", value=10)
+        self.a.weight_to_distance()
+        # The invalidation of some edges doesn't add the compact store of edges to G
+        self.a.path_lengths(n_jobs=1)
+        self.a.invalidate_metrics(edges=[(0, 1)])
+        self.assertIsNotNone(self.a._edges)
+        self.assertIsNotNone(self.a._path_cache)
+        nodes = list(self.a.G.nodes())
+
+        def expected():
+            lengths = dict(nx.all_pairs_dijkstra_path_length(self.a.G, weight=ct.DISTANCE))
+            return [[lengths[u].get(v, np.inf) for v in nodes] for u in nodes]
+
+        lengths = self.a.path_lengths(weight=ct.DISTANCE, n_jobs=1)
+        np.testing.assert_allclose(lengths, expected())
+        self.assertFalse(lengths.flags.writeable)
+        self.assertIs(self.a.path_lengths(weight=ct.DISTANCE, n_jobs=1).base, lengths.base)
+        hops = dict(nx.all_pairs_shortest_path_length(self.a.G))
+        np.testing.assert_allclose(self.a.path_lengths(n_jobs=1),
+                                   [[hops[u].get(v, np.inf) for v in nodes] for u in nodes])
+
+        # Removing edges only recalculates the rows of the paths through them
+        self.a.path_lengths(weight=ct.DISTANCE, dtype=np.float32, n_jobs=1)
+        cache = self.a._path_cache
+        edge = next(iter(self.a.G.edges()))
+        self.a.G.remove_edge(*edge)
+        self.a.update_adj_mat_many([edge], weights=[np.nan])
+        self.assertIs(self.a._path_cache, cache)
+        self.assertTrue(0 < np.count_nonzero(cache.stale) < len(nodes))
+        lengths = self.a.path_lengths(weight=ct.DISTANCE, dtype=np.float32, n_jobs=1)
+        self.assertEqual(lengths.dtype, np.float32)
+        np.testing.assert_allclose(lengths, expected(), rtol=1e-6)
+
+        # Other changes recalculate all the rows
+        self.a.G.add_edge(*edge, **{ct.WEIGHT: 1, ct.DISTANCE: 1})
+        self.a.update_adj_mat(edge)
+        self.assertIsNone(self.a._path_cache)
+        self.a.path_lengths(weight=ct.DISTANCE, dtype=np.float32, n_jobs=1)
+        self.a.G.remove_edge(*edge)
+        np.testing.assert_allclose(self.a.path_lengths(weight=ct.DISTANCE, dtype=np.float32, n_jobs=1),
+                                   expected(), rtol=1e-6)
+
+        # Swapping an edge of G for another one keeps the number of edges, but it is also noticed
+        u, v = next(iter(self.a.G.edges()))
+        w = next(w for w in nodes if w != u and not self.a.G.has_edge(u, w))
+        self.a.G.remove_edge(u, v)
+        self.a.G.add_edge(u, w, **{ct.WEIGHT: 1, ct.DISTANCE: 0.01})
+        np.testing.assert_allclose(self.a.path_lengths(weight=ct.DISTANCE, dtype=np.float32, n_jobs=1),
+                                   expected(), rtol=1e-6)
+
+        # An edge with length 0 is not mistaken for a missing one when it is removed
+        self.a.G[u][w][ct.DISTANCE] = 0.
+        self.a.invalidate_metrics()
+        self.a.path_lengths(weight=ct.DISTANCE, n_jobs=1)
+        cache = self.a._path_cache
+        self.a.G.remove_edge(u, w)
+        self.a.invalidate_metrics(edges=[(u, w)])
+        self.assertIs(self.a._path_cache, cache)
+        self.assertTrue(cache.stale[nodes.index(u)])
+        np.testing.assert_allclose(self.a.path_lengths(weight=ct.DISTANCE, n_jobs=1), expected())
+
+        # The matrix can be kept in a file
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            mmap_file = os.path.join(tmp_dir, "lengths.npy")
+            lengths = self.a.path_lengths(weight=ct.DISTANCE, mmap_file=mmap_file, n_jobs=2)
+            np.testing.assert_allclose(lengths, expected())
+            np.testing.assert_allclose(np.load(mmap_file, mmap_mode='r'), lengths)
+
     def test_linked_nodes(self):
         self.a.import_adj_file(self.SMALL_FILE)
         self.a.apply_threshold()
@@ -324,6 +844,167 @@ class TestBrainObj(unittest.TestCase):
         self.assertTrue(self.a.G.edges[0, 1]['own_property'], 'edge_val1')
         self.assertTrue(self.a.G.edges[2, 3]['own_property'], 3.4)
 
+    def test_typed_properties(self):
+        self.a.import_adj_file(self.SMALL_FILE)
+        self.a.apply_threshold()
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmp_dir, 'lengths.txt')
+            with open(fname, 'w') as file:
+                file.write('length\n0 1.5\n7 2\n2 0 10.25\n3 1 4\n0 9 1\n')
+            self.a.import_properties(fname, dtype=float)
+
+            self.assertEqual(self.a.G.nodes[0]['length'], 1.5)
+            self.assertNotIn(7, self.a.G.nodes())
+            self.assertEqual(self.a.G.edges[0, 2]['length'], 10.25)
+            self.assertEqual(self.a.G.edges[1, 3]['length'], 4.)
+            self.assertFalse(self.a.G.has_edge(0, 9))
+            self.assertEqual(len(self.a.node_properties), 2)
+            self.assertEqual(len(self.a.edge_properties), 3)
+
+            # The file is read by chunks of lines
+            expected = utils.read_properties(fname, dtype=float)
+            chunk_lines = utils.readers._CHUNK_LINES
+            utils.readers._CHUNK_LINES = 2
+            try:
+                prop_name, nodes, edges = utils.read_properties(fname, dtype=float)
+                self.assertEqual(prop_name, expected[0])
+                for column, expected_column in zip(nodes + edges, expected[1] + expected[2]):
+                    np.testing.assert_array_equal(column, expected_column)
+                with open(fname, 'w') as file:
+                    file.write('length\n0 1.5\n1 2\n0\n')
+                self.assertRaisesRegex(ValueError, 'line 4', utils.read_properties, fname)
+            finally:
+                utils.readers._CHUNK_LINES = chunk_lines
+
+            with open(fname, 'w') as file:
+                file.write('length\n0 1.5\n0\n')
+            self.assertRaises(ValueError, self.a.import_properties, fname)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_properties_after_threshold(self):
+        self.a.import_adj_file(self.MODIF_FILE, delimiter=",")
+        self.a.apply_threshold()
+        self.a.import_edge_props_from_dict("length", {(1, 0): 2.5, (0, 2): 1, (3, 4): 4})
+        self.a.import_node_props_from_dict("label", {0: "a", 1: "b"})
+        self.a.import_edge_props_from_dict("length", {(0, 1): 3})
+        self.assertEqual(self.a.edge_properties, (("length", 1, 0, 2.5), ("length", 0, 2, 1),
+                                                  ("length", 3, 4, 4), ("length", 0, 1, 3)))
+        self.assertEqual(self.a.G.edges[0, 1]["length"], 3)
+
+        # The properties are looked up for the edges of each threshold
+        self.a.update_props_after_threshold = True
+        self.a.G.nodes[0]["label"] = "changed"
+        for value, graph in self.a.threshold_sweep([100, 50, 10]):
+            self.assertEqual(graph.nodes[0]["label"], "a")
+            expected = {(0, 1): 3, (0, 2): 1, (3, 4): 4}
+            self.assertEqual(nx.get_edge_attributes(graph, "length"),
+                             {e: val for e, val in expected.items() if graph.has_edge(*e)})
+
+        b = mbt.Brain()
+        b.node_properties = self.a.node_properties
+        b.edge_properties = self.a.edge_properties
+        self.assertEqual(b.node_properties, (("label", 0, "a"), ("label", 1, "b")))
+        self.assertEqual(b.edge_properties, self.a.edge_properties)
+        # They are only changed by assigning them
+        with self.assertRaises(AttributeError):
+            b.node_properties.append(("label", 2, "c"))
+        b.node_properties += (("label", 2, "c"),)
+        self.assertEqual(b.node_properties[-1], ("label", 2, "c"))
+
+    def test_save_load(self):
+        self.a.import_adj_file(self.SMALL_FILE)
+        self.a.import_spatial_info(self.COORD_FILE)
+        self.a.apply_threshold(threshold_type="totalEdges", value=4)
+        self.a.import_properties(self.PROPS_FILE)
+        self.a.import_node_props_from_dict("degree", dict(nx.degree(self.a.G)))
+        self.a.weight_to_distance()
+        self.a.subject = "subj1"
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for compressed in [True, False]:
+                fname = os.path.join(tmp_dir, "brain.npz")
+                self.a.save(fname, compressed=compressed)
+                b = mbt.Brain.load(fname)
+
+                np.testing.assert_array_equal(self.a.adjMat, b.adjMat)
+                self.assertFalse(b.directed)
+                self.assertEqual(b.subject, "subj1")
+                self.assertEqual(list(self.a.G.nodes(data=True)), list(b.G.nodes(data=True)))
+                self.assertEqual(sorted(self.a.G.edges(data=True)), sorted(b.G.edges(data=True)))
+                self.assertEqual(self.a.node_properties, b.node_properties)
+
+            # Nodes which are not integers
+            self.a.copy_hemisphere("R", midline=0)
+            self.a.save(fname)
+            b = mbt.Brain.load(fname)
+            self.assertEqual(list(self.a.G.nodes(data=True)), list(b.G.nodes(data=True)))
+            self.assertEqual(sorted(self.a.G.edges(data=True)), sorted(b.G.edges(data=True)))
+            self.assertRaises(IOError, mbt.Brain.load, "sdfasdf")
+
+            # Tuples come back as lists, and other objects can't be saved
+            node = list(self.a.G.nodes())[0]
+            self.a.G.nodes[node]["pair"] = (1, 2)
+            self.a.save(fname)
+            self.assertEqual(mbt.Brain.load(fname).G.nodes[node]["pair"], [1, 2])
+            self.a.G.nodes[node]["bad"] = object()
+            with self.assertRaisesRegex(TypeError, "'bad'"):
+                self.a.save(fname)
+
+    def test_writers(self):
+        self.a.import_adj_file(self.MODIF_FILE, delimiter=",", nodes_to_exclude=[2])
+        self.a.apply_threshold(threshold_type="totalEdges", value=10)
+        self.a.import_edge_props_from_dict("label", {e: 'lab' for e in list(self.a.G.edges())[:4]})
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for fname in ['adj.txt', 'adj.npy']:
+                utils.output_adj_matrix(self.a, os.path.join(tmp_dir, fname))
+                b = mbt.Brain()
+                if fname.endswith('.npy'):
+                    b.import_adj_npy(os.path.join(tmp_dir, fname))
+                else:
+                    b.import_adj_file(os.path.join(tmp_dir, fname))
+                np.testing.assert_array_equal(self.a.adjMat, b.adjMat)
+            utils.output_adj_matrix(self.a, os.path.join(tmp_dir, 'adj.txt.gz'))
+            with gzip.open(os.path.join(tmp_dir, 'adj.txt.gz'), 'rt') as file, \
+                    open(os.path.join(tmp_dir, 'adj.txt')) as file2:
+                self.assertEqual(file.read(), file2.read())
+            # The values are written as str() does
+            with open(os.path.join(tmp_dir, 'adj.txt')) as file:
+                self.assertEqual(file.readline().rstrip('\n').split('\t'), [str(v) for v in self.a.adjMat[0].tolist()])
+
+            utils.output_edges(self.a, os.path.join(tmp_dir, 'edges.txt'), properties=['label', ct.WEIGHT])
+            with open(os.path.join(tmp_dir, 'edges.txt')) as file:
+                lines = file.read().splitlines()
+            self.assertEqual(lines[0], 'n1\tn2\tlabel\tweight')
+            self.assertEqual(len(lines), 11)
+            self.assertTrue(all(len(line.split('\t')) == 4 for line in lines))
+            self.assertEqual(sum(line.split('\t')[2] == 'NA' for line in lines), 6)
+
+            utils.output_edges(self.a, os.path.join(tmp_dir, 'edges.npz'), properties=['label', ct.WEIGHT])
+            bundle = np.load(os.path.join(tmp_dir, 'edges.npz'))
+            self.assertEqual(bundle['edges'].shape, (10, 2))
+            self.assertEqual(list(bundle['label']).count('NA'), 6)
+            np.testing.assert_array_equal(bundle[ct.WEIGHT], [e[2] for e in self.a.G.edges(data=ct.WEIGHT)])
+
+            # A compact edge list can be imported again
+            utils.output_edges(self.a, os.path.join(tmp_dir, 'edges.txt'), properties=[ct.WEIGHT], header=False)
+            b = mbt.Brain()
+            b.import_edge_list(os.path.join(tmp_dir, 'edges.txt'))
+            b.apply_threshold()
+            self.assertEqual(utils.graph_to_csr(self.a.G, range(15)).nnz, b.to_csr(range(15)).nnz)
+
+            # The missing elements of a sparse adjMat are written as nan
+            for fname in ['sparse.txt', 'sparse.npy']:
+                utils.output_adj_matrix(b, os.path.join(tmp_dir, fname))
+                c = mbt.Brain()
+                if fname.endswith('.npy'):
+                    c.import_adj_npy(os.path.join(tmp_dir, fname))
+                else:
+                    c.import_adj_file(os.path.join(tmp_dir, fname))
+                np.testing.assert_array_equal(utils.csr_to_dense(b.adjMat), c.adjMat)
+
     def test_highlights(self):
         self.a.import_adj_file(self.SMALL_FILE)
         self.a.apply_threshold()
@@ -417,5 +1098,80 @@ class TestBrainObj(unittest.TestCase):
         self.assertRaises(KeyError, lambda: self.a.G.nodes[3])
 
 
+class TestBrainCohort(unittest.TestCase):
+    """
+    Test BrainCohort class from maybrain
+    """
+
+    def setUp(self):
+        self.coh = mbc.BrainCohort()
+        self.SMALL_FILE = "test/data/3d_grid_adj.txt"
+        self.SMALL_NEG_FILE = "test/data/3d_grid_adj_neg.txt"
+        self.MODIF_FILE = "test/data/3d_grid_adj2.txt"
+
+    def test_import_adj_files(self):
+        self.assertEqual(len(self.coh), 0)
+        for n_jobs in [1, 2]:
+            self.coh.import_adj_files([self.SMALL_FILE, self.SMALL_NEG_FILE], n_jobs=n_jobs)
+            self.assertEqual(self.coh.adj_mats.shape, (2, 4, 4))
+            self.assertEqual(self.coh.subjects, ["3d_grid_adj", "3d_grid_adj_neg"])
+            self.assertEqual(self.coh.adj_mats[1][1][2], -0.843798947781)
+
+        self.assertRaises(ValueError, self.coh.import_adj_files, [self.SMALL_FILE, self.MODIF_FILE],
+                          delimiter=",", n_jobs=1)
+        self.assertRaises(IOError, self.coh.import_adj_files, ["sdfasdf"], n_jobs=1)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            shutil.copy(self.SMALL_FILE, os.path.join(tmp_dir, "b.txt"))
+            shutil.copy(self.SMALL_NEG_FILE, os.path.join(tmp_dir, "a.txt"))
+            self.coh.import_adj_files(tmp_dir, mmap_file=os.path.join(tmp_dir, "stack.npy"))
+            self.assertIsInstance(self.coh.adj_mats, np.memmap)
+            self.assertEqual(self.coh.subjects, ["a", "b"])
+            self.assertEqual(self.coh.adj_mats[0][1][2], -0.843798947781)
+            del self.coh
+
+    def test_stack_and_brains(self):
+        stack = np.random.rand(3, 5, 5)
+        stack[0, 1, 2] = np.nan
+        stack[:, 3, 4] = np.nan
+        self.coh.import_adj_stack(stack, subjects=["s1", "s2", "s3"])
+        self.assertTrue(np.shares_memory(stack, self.coh.adj_mats))
+        self.assertRaises(ValueError, self.coh.import_adj_stack, np.zeros((3, 4, 5)))
+
+        brn = self.coh[1]
+        self.assertIsInstance(brn, mbt.Brain)
+        self.assertEqual(brn.subject, "s2")
+        self.assertTrue(np.shares_memory(stack, brn.adjMat))
+        self.assertEqual(brn.G.number_of_nodes(), 5)
+        brn.apply_threshold(threshold_type="totalEdges", value=3)
+        self.assertEqual(brn.G.number_of_edges(), 3)
+        self.assertEqual(len(list(self.coh)), 3)
+
+        avg = self.coh.mean_adj_mat()
+        self.assertTrue(np.isnan(avg[3, 4]))
+        self.assertAlmostEqual(avg[1, 2], np.mean(stack[1:, 1, 2]))
+        self.assertAlmostEqual(avg[0, 0], np.mean(stack[:, 0, 0]))
+
+    def test_threshold_masks(self):
+        stack = np.random.RandomState(0).randint(0, 10, size=(4, 8, 8)).astype(float)
+        stack[:, 2, 3] = np.nan
+        stack[1, :, :] = np.nan
+        for directed in [False, True]:
+            coh = mbc.BrainCohort(directed=directed)
+            coh.import_adj_stack(stack)
+            for kwargs in [dict(threshold_type="edgePC", value=30), dict(threshold_type="totalEdges", value=5),
+                           dict(threshold_type="tVal", value=6), dict(threshold_type=None)]:
+                masks = coh.threshold_masks(**kwargs)
+                csr_masks = coh.threshold_masks(as_csr=True, **kwargs)
+                self.assertEqual(masks.shape, (4, 8, 8))
+                for brn, mask, csr_mask in zip(coh, masks, csr_masks):
+                    brn.apply_threshold(**kwargs)
+                    expected = nx.to_numpy_array(brn.G, nodelist=range(8), weight=None) > 0
+                    self.assertTrue(np.array_equal(mask, expected))
+                    self.assertTrue(np.array_equal(csr_mask.toarray(), expected))
+
+        self.assertRaises(TypeError, coh.threshold_masks, threshold_type="other")
+        self.assertRaises(TypeError, coh.threshold_masks, threshold_type="edgePC", value=101)
+
 if __name__ == '__main__':
     unittest.main()
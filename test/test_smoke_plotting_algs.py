@@ -1,11 +1,16 @@
+import itertools
+import random
 import unittest
 
 import networkx as nx
+import numpy as np
 
 from maybrain import brain as mbt
+from maybrain import metrics
 from maybrain import resources as rt
 import maybrain.plotting as mpt
 import maybrain.algorithms as mba
+from maybrain.algorithms import normalisation
 import maybrain.constants as ct
 import matplotlib.pyplot as plt
 
@@ -43,6 +48,33 @@ class TestPlottingAndAlgs(unittest.TestCase):
         self.a.apply_threshold()
         mba.robustness(self.a)
 
+    def test_degeneration(self):
+        adj_mat = np.random.RandomState(0).rand(40, 40)
+        self.a.import_adj_array((adj_mat + adj_mat.T) / 2)
+        self.a.apply_threshold(threshold_type="edgePC", value=10)
+        nodes = list(self.a.G.nodes())
+        edges = set(self.a.G.edges())
+        self.a.path_lengths(n_jobs=1)
+        cache = self.a._path_cache
+
+        # The weights are lower than 1, so each degenerated edge is removed
+        random.seed(0)
+        mba.random_degenerate(self.a, weight_loss=1, edges_removed_limit=3)
+        removed = edges - set(self.a.G.edges())
+        self.assertEqual(len(removed), 3)
+        self.assertFalse(self.a.defer_adj_mat_sync)
+        for node1, node2 in removed:
+            self.assertTrue(np.isnan(self.a.adjMat[node1, node2]))
+        self.assertIs(self.a._path_cache, cache)
+        hops = dict(nx.all_pairs_shortest_path_length(self.a.G))
+        np.testing.assert_allclose(self.a.path_lengths(n_jobs=1),
+                                   [[hops[u].get(v, np.inf) for v in nodes] for u in nodes])
+
+        # The adjMat synchronisation is restored after an error
+        self.a.risk_edges = [(0, 0)]
+        self.assertRaises(KeyError, mba.random_degenerate, self.a)
+        self.assertFalse(self.a.defer_adj_mat_sync)
+
     def test_normalisation(self):
         self.a.import_adj_file(self.SMALL_NEG_FILE)
         self.a.apply_threshold()
@@ -73,6 +105,150 @@ class TestPlottingAndAlgs(unittest.TestCase):
         self.assertEqual(sum(dict(nx.degree(rand, weight=ct.WEIGHT)).values()),
                          sum(dict(nx.degree(self.a.G, weight=ct.WEIGHT)).values()))
 
+    def test_metrics(self):
+        adj_mat = np.random.RandomState(0).rand(40, 40)
+        self.a.import_adj_array((adj_mat + adj_mat.T) / 2)
+        self.a.apply_threshold(threshold_type="edgePC", value=15)
+        nodes = list(self.a.G.nodes())
+        matrix = self.a.to_csr().toarray()
+
+        for adj in [self.a, self.a.G, self.a.to_csr(), matrix]:
+            np.testing.assert_array_equal(metrics.degree(adj), [d for _, d in nx.degree(self.a.G, nodes)])
+            np.testing.assert_allclose(metrics.strength(adj),
+                                       [d for _, d in nx.degree(self.a.G, nodes, weight=ct.WEIGHT)])
+            np.testing.assert_array_equal(metrics.triangles(adj), [nx.triangles(self.a.G)[n] for n in nodes])
+            clustering = nx.clustering(self.a.G)
+            np.testing.assert_allclose(metrics.clustering(adj), [clustering[n] for n in nodes])
+        clustering = nx.clustering(self.a.G, weight=ct.WEIGHT)
+        np.testing.assert_allclose(metrics.clustering(self.a, weight=ct.WEIGHT), [clustering[n] for n in nodes])
+        np.testing.assert_allclose(metrics.clustering(matrix, weight=True), [clustering[n] for n in nodes])
+
+        # A stack of matrices has a result for each one
+        stack = np.stack([matrix, np.zeros_like(matrix)])
+        self.assertEqual(metrics.clustering(stack, weight=True).shape, (2, len(nodes)))
+        np.testing.assert_allclose(metrics.clustering(stack, weight=True)[0], [clustering[n] for n in nodes])
+        np.testing.assert_array_equal(metrics.degree(stack)[1], 0)
+
+        # Normalising with all the random graphs at once
+        normalised = mba.normalise_node_wise(self.a, metrics.degree, init_vals=dict(nx.degree(self.a.G)),
+                                             n_iter=5, exact_random=True, stacked=True)
+        self.assertTrue(all(i == 1 for i in normalised.values()))
+        normalised = mba.normalise(self.a, metrics.degree, n_iter=5, exact_random=True, stacked=True)
+        self.assertTrue(all(i == 1 for i in normalised.values()))
+        self.assertEqual(len(mba.normalise_single(self.a, metrics.strength, init_val=1., n_iter=3,
+                                                  ret_normalised=False,
+                                                  stacked=True)), 3)
+
+        # The random graphs are given in batches, with the same degrees and weights as the brain
+        stack_elements = normalisation._STACK_ELEMENTS
+        normalisation._STACK_ELEMENTS = 2 * len(nodes) ** 2
+        try:
+            stacks = []
+            strengths = mba.normalise_node_wise(self.a, lambda stack: stacks.append(stack) or metrics.strength(stack),
+                                                init_vals=dict(nx.degree(self.a.G, weight=ct.WEIGHT)), n_iter=5,
+                                                ret_normalised=False, exact_random=True, stacked=True)
+        finally:
+            normalisation._STACK_ELEMENTS = stack_elements
+        self.assertEqual([len(stack) for stack in stacks], [2, 2, 1])
+        self.assertEqual(len(strengths[nodes[0]]), 5)
+        upper = np.triu_indices(len(nodes), 1)
+        for stack in stacks:
+            for rand in stack:
+                np.testing.assert_array_equal(metrics.degree(rand), metrics.degree(matrix))
+                np.testing.assert_allclose(np.sort(rand[upper]), np.sort(matrix[upper]))
+
+        self.assertRaises(TypeError, metrics.degree, nx.DiGraph(self.a.G))
+        self.assertRaises(TypeError, metrics.degree, np.zeros((3, 4)))
+
+    def test_path_metrics(self):
+        adj_mat = np.random.RandomState(0).rand(40, 40)
+        self.a.import_adj_array((adj_mat + adj_mat.T) / 2)
+        self.a.apply_threshold(threshold_type="edgePC", value=10)
+        self.a.weight_to_distance()
+        nodes = list(self.a.G.nodes())
+        lengths = dict(nx.all_pairs_dijkstra_path_length(self.a.G, weight=ct.DISTANCE))
+
+        # Small graphs are calculated in this process, so the chunks are made smaller to use the processes
+        chunk_sources = metrics._CHUNK_SOURCES
+        try:
+            for n_jobs, metrics._CHUNK_SOURCES in [(None, chunk_sources), (1, 8), (2, 8)]:
+                np.testing.assert_allclose(metrics.shortest_paths(self.a, weight=ct.DISTANCE, n_jobs=n_jobs),
+                                           [[lengths[u].get(v, np.inf) for v in nodes] for u in nodes])
+                self.assertAlmostEqual(metrics.global_efficiency(self.a, n_jobs=n_jobs),
+                                       nx.global_efficiency(self.a.G))
+                np.testing.assert_allclose(metrics.local_efficiency(self.a.G, n_jobs=n_jobs),
+                                           [nx.global_efficiency(self.a.G.subgraph(self.a.G[n])) for n in nodes])
+                # The matrices of a stack share the pool of processes
+                stack = np.stack([self.a.to_csr(weight=ct.DISTANCE).toarray(), np.ones((len(nodes), len(nodes)))])
+                np.testing.assert_allclose(metrics.shortest_paths(stack, weight=True, n_jobs=n_jobs)[0],
+                                           [[lengths[u].get(v, np.inf) for v in nodes] for u in nodes])
+                np.testing.assert_allclose(metrics.global_efficiency(stack, n_jobs=n_jobs),
+                                           [nx.global_efficiency(self.a.G), 1])
+        finally:
+            metrics._CHUNK_SOURCES = chunk_sources
+        self.assertAlmostEqual(metrics.local_efficiency(self.a).mean(), nx.local_efficiency(self.a.G))
+        hops = dict(nx.all_pairs_shortest_path_length(self.a.G))
+        np.testing.assert_allclose(metrics.nodal_efficiency(self.a, n_jobs=1) * (len(nodes) - 1),
+                                   [sum(1 / d for d in hops[n].values() if d) for n in nodes])
+
+        # The path length only considers the connected nodes
+        component = self.a.G.subgraph(max(nx.connected_components(self.a.G), key=len))
+        self.assertAlmostEqual(metrics.path_length(component, weight=ct.DISTANCE, n_jobs=1),
+                               nx.average_shortest_path_length(component, weight=ct.DISTANCE))
+        stack = np.stack([self.a.to_csr().toarray(), np.zeros((len(nodes), len(nodes)))])
+        np.testing.assert_allclose(metrics.global_efficiency(stack, n_jobs=1), [nx.global_efficiency(self.a.G), 0])
+        self.assertTrue(np.isnan(metrics.path_length(stack, n_jobs=1)[1]))
+
+    def test_betweenness(self):
+        adj_mat = np.random.RandomState(0).rand(40, 40)
+        self.a.import_adj_array((adj_mat + adj_mat.T) / 2)
+        self.a.apply_threshold(threshold_type="edgePC", value=10)
+        self.a.weight_to_distance()
+        nodes = list(self.a.G.nodes())
+        index = {n: i for i, n in enumerate(nodes)}
+
+        chunk_sources = metrics._CHUNK_SOURCES
+        try:
+            for weight, n_jobs, metrics._CHUNK_SOURCES in [(None, 1, chunk_sources), (ct.DISTANCE, 1, chunk_sources),
+                                                           (ct.DISTANCE, 2, 8)]:
+                expected = nx.betweenness_centrality(self.a.G, weight=weight)
+                np.testing.assert_allclose(metrics.betweenness(self.a, weight=weight, n_jobs=n_jobs),
+                                           [expected[n] for n in nodes])
+                expected = nx.edge_betweenness_centrality(self.a.G, weight=weight, normalized=False)
+                centralities = metrics.edge_betweenness(self.a, weight=weight, normalised=False, n_jobs=n_jobs)
+                self.assertEqual(centralities.nnz, 2 * len(expected))
+                for (u, v), value in expected.items():
+                    self.assertAlmostEqual(centralities[index[u], index[v]], value)
+                    self.assertAlmostEqual(centralities[index[v], index[u]], value)
+        finally:
+            metrics._CHUNK_SOURCES = chunk_sources
+
+        # Estimates from some sources are within the error bound
+        exact = metrics.betweenness(self.a, n_jobs=1)
+        estimates, error = metrics.betweenness(self.a, n_samples=20, seed=0, n_jobs=1)
+        self.assertTrue(0 < error < 1)
+        self.assertTrue(np.all(np.abs(estimates - exact) <= error))
+        estimates, error = metrics.betweenness(self.a, n_samples=len(nodes), n_jobs=1)
+        np.testing.assert_allclose(estimates, exact)
+        self.assertEqual(error, 0)
+
+        # An edge of length 0 between two cycles. networkx.betweenness_centrality() miscounts the
+        # shortest paths through it, so they are enumerated instead
+        graph = nx.disjoint_union(nx.cycle_graph(5), nx.cycle_graph(4))
+        nx.set_edge_attributes(graph, {edge: length for edge, length in zip(graph.edges(), [1, 2, 1, 3, 2, 1, 1, 2, 1])},
+                               ct.DISTANCE)
+        graph.add_edge(0, 5, **{ct.DISTANCE: 0})
+        expected = dict.fromkeys(graph, 0.)
+        for source, target in itertools.combinations(graph, 2):
+            paths = list(nx.all_simple_paths(graph, source, target))
+            lengths = [nx.path_weight(graph, path, ct.DISTANCE) for path in paths]
+            shortest = [path for path, length in zip(paths, lengths) if length == min(lengths)]
+            for path in shortest:
+                for node in path[1:-1]:
+                    expected[node] += 1 / len(shortest)
+        np.testing.assert_allclose(metrics.betweenness(graph, weight=ct.DISTANCE, normalised=False, n_jobs=1),
+                                   [expected[n] for n in graph])
+
     def test_connectome(self):
         self.a.import_adj_file(self.SMALL_FILE)
         self.a.import_spatial_info(self.COORD_FILE)